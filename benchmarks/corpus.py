@@ -0,0 +1,217 @@
+"""
+Generate a synthetic corpus of XLSForms and instance XML files.
+
+The corpus has the same shape as the test fixtures: XLSForms with survey,
+choices and settings sheets, one per form version, and instance XML files
+for each form, in a tree of site / device / date folders.
+"""
+import os
+import random
+import zipfile
+from collections import OrderedDict, namedtuple
+from datetime import date, timedelta
+from typing import Dict, List, Union
+from xml.sax.saxutils import escape, quoteattr
+
+
+corpus_spec = namedtuple('CorpusSpec', [
+    'forms', 'versions', 'variables', 'instances', 'repeats', 'duplicates',
+    'depth', 'seed'])
+DEFAULT_SPEC = corpus_spec(
+    forms=2, versions=2, variables=20, instances=1000, repeats=0,
+    duplicates=0.01, depth=2, seed=0)
+# Cycled through for each form's variables, like the fixture forms.
+VARIABLE_TYPES = ['integer', 'text', 'select_one', 'date', 'text']
+CHOICES_PER_LIST = 5
+
+Cell = Union[str, int, float, None]
+
+
+def write_xlsx(file_path: str, sheets: Dict[str, List[List[Cell]]]) -> None:
+    """
+    Write a minimal XLSX workbook with the given sheets of rows.
+
+    Strings are written inline rather than in a shared strings part, and
+    there is no styles part, which is enough for xlrd to read it.
+    """
+    def part(body):
+        return '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' \
+               '\n{0}'.format(body)
+
+    ns = 'http://schemas.openxmlformats.org'
+    rel_type = ns + '/officeDocument/2006/relationships'
+    content_types = ''.join(
+        '<Override PartName="/xl/worksheets/sheet{0}.xml" ContentType="'
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.'
+        'worksheet+xml"/>'.format(i) for i in range(1, len(sheets) + 1))
+    with zipfile.ZipFile(file_path, mode='w',
+                         compression=zipfile.ZIP_DEFLATED) as xlsx:
+        xlsx.writestr('[Content_Types].xml', part(
+            '<Types xmlns="{0}/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/'
+            'vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"'
+            '/>{1}</Types>'.format(ns, content_types)))
+        xlsx.writestr('_rels/.rels', part(
+            '<Relationships xmlns="{0}/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="{1}/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>'.format(
+                ns, rel_type)))
+        xlsx.writestr('xl/workbook.xml', part(
+            '<workbook xmlns="{0}/spreadsheetml/2006/main" xmlns:r="{1}">'
+            '<sheets>{2}</sheets></workbook>'.format(
+                ns, rel_type, ''.join(
+                    '<sheet name={0} sheetId="{1}" r:id="rId{1}"/>'.format(
+                        quoteattr(name), i)
+                    for i, name in enumerate(sheets, start=1)))))
+        xlsx.writestr('xl/_rels/workbook.xml.rels', part(
+            '<Relationships xmlns="{0}/package/2006/relationships">{1}'
+            '</Relationships>'.format(ns, ''.join(
+                '<Relationship Id="rId{0}" Type="{1}/worksheet" '
+                'Target="worksheets/sheet{0}.xml"/>'.format(i, rel_type)
+                for i in range(1, len(sheets) + 1)))))
+        for i, rows in enumerate(sheets.values(), start=1):
+            xlsx.writestr('xl/worksheets/sheet{0}.xml'.format(i), part(
+                '<worksheet xmlns="{0}/spreadsheetml/2006/main"><sheetData>'
+                '{1}</sheetData></worksheet>'.format(
+                    ns, ''.join(sheet_row(i, row)
+                                for i, row in enumerate(rows, start=1)))))
+
+
+def sheet_row(row_number: int, row: List[Cell]) -> str:
+    """Return a worksheet row element, with a cell for each value."""
+    cells = list()
+    for col_number, value in enumerate(row):
+        ref = '{0}{1}'.format(column_letters(col_number), row_number)
+        if value is None:
+            continue
+        elif isinstance(value, (int, float)):
+            cells.append('<c r="{0}"><v>{1}</v></c>'.format(ref, value))
+        else:
+            cells.append('<c r="{0}" t="inlineStr"><is><t>{1}</t></is>'
+                         '</c>'.format(ref, escape(value)))
+    return '<row r="{0}">{1}</row>'.format(row_number, ''.join(cells))
+
+
+def column_letters(col_number: int) -> str:
+    """Return the spreadsheet column letters for a 0-based column number."""
+    letters = ''
+    col_number += 1
+    while col_number > 0:
+        col_number, remainder = divmod(col_number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def form_variables(spec: corpus_spec, version: int) -> OrderedDict:
+    """Return the variable name and XLSForm type for a form version."""
+    # Later versions add variables, as form revisions tend to.
+    count = spec.variables + version - 1
+    variables = OrderedDict()
+    for i in range(count):
+        var_type = VARIABLE_TYPES[i % len(VARIABLE_TYPES)]
+        name = 'var_{0}'.format(i)
+        if var_type == 'select_one':
+            var_type = 'select_one {0}_choices'.format(name)
+        variables[name] = var_type
+    return variables
+
+
+def write_xlsform(file_path: str, form_id: str, version: int,
+                  variables: OrderedDict) -> None:
+    """Write an XLSForm for the form version, with the variables."""
+    survey = [['type', 'name', 'label']]
+    survey.append(['start', 'start', None])
+    survey.append(['end', 'end', None])
+    survey.append(['deviceid', 'deviceid', None])
+    for name, var_type in variables.items():
+        survey.append([var_type, name, 'Question {0}?'.format(name)])
+    choices = [['list_name', 'name', 'label']]
+    for name, var_type in variables.items():
+        if var_type.startswith('select_one'):
+            list_name = var_type.split(' ')[1]
+            for value in range(1, CHOICES_PER_LIST + 1):
+                choices.append(
+                    [list_name, value, 'Choice {0}'.format(value)])
+    settings = [['form_title', 'form_id', 'version'],
+                ['Form {0}'.format(form_id), form_id, version]]
+    write_xlsx(file_path=file_path, sheets=OrderedDict([
+        ('survey', survey), ('choices', choices), ('settings', settings)]))
+
+
+def instance_xml(form_id: str, version: int, variables: OrderedDict,
+                 number: int, repeats: int, rng: random.Random) -> str:
+    """Return the XML text of an instance of the form version."""
+    start = date(2015, 1, 1) + timedelta(days=number % 365)
+    values = ['<start>{0}T09:00:00.000+10</start>'.format(start),
+              '<end>{0}T09:30:00.000+10</end>'.format(start),
+              '<deviceid>imei:{0:015d}</deviceid>'.format(number % 97)]
+    for name, var_type in variables.items():
+        if var_type == 'integer':
+            value = str(rng.randint(0, 30000))
+        elif var_type == 'date':
+            value = str(start - timedelta(days=rng.randint(0, 30000)))
+        elif var_type.startswith('select_one'):
+            value = str(rng.randint(1, CHOICES_PER_LIST))
+        else:
+            value = escape('Answer {0} to {1}'.format(number, name))
+        values.append('<{0}>{1}</{0}>'.format(name, value))
+    for i in range(repeats):
+        values.append('<rep><rep_n>{0}</rep_n><rep_t>Repeat {0}</rep_t>'
+                      '</rep>'.format(i))
+    values.append('<meta><instanceID>uuid:{0}-{1:08d}</instanceID></meta>'
+                  .format(form_id, number))
+    return "<?xml version='1.0' ?><{0} id={1} version=\"{2}\">{3}</{0}>" \
+           "".format(form_id, quoteattr(form_id), version, ''.join(values))
+
+
+def instance_dir(root_dir: str, number: int, depth: int) -> str:
+    """Return a site / device / date (etc.) folder path for an instance."""
+    parts = ['site_{0}'.format(number % 5), 'device_{0}'.format(number % 17),
+             'day_{0}'.format(number % 31)]
+    while len(parts) < depth:
+        parts.append('part_{0}'.format(number % (7 + len(parts))))
+    return os.path.join(root_dir, *parts[:depth])
+
+
+def generate_corpus(root_dir: str, spec: corpus_spec = DEFAULT_SPEC
+                    ) -> Dict[str, str]:
+    """
+    Write a synthetic corpus to root_dir, and return the xlsforms and
+    instances paths.
+
+    The instances are spread across the forms and versions. A spec.duplicates
+    fraction of the instance files are written twice, in different folders.
+    """
+    rng = random.Random(spec.seed)
+    paths = dict(xlsforms=os.path.join(root_dir, 'xlsforms'),
+                 instances=os.path.join(root_dir, 'instances'))
+    os.makedirs(paths['xlsforms'], exist_ok=True)
+    form_versions = list()
+    for f in range(spec.forms):
+        form_id = 'FORM_{0}'.format(f)
+        for version in range(1, spec.versions + 1):
+            variables = form_variables(spec=spec, version=version)
+            write_xlsform(
+                file_path=os.path.join(paths['xlsforms'], '{0}_v{1}.xlsx'
+                                       .format(form_id, version)),
+                form_id=form_id, version=version, variables=variables)
+            form_versions.append((form_id, version, variables))
+    for number in range(spec.instances):
+        form_id, version, variables = form_versions[
+            number % len(form_versions)]
+        xml = instance_xml(form_id=form_id, version=version,
+                           variables=variables, number=number,
+                           repeats=spec.repeats, rng=rng)
+        dirs = [instance_dir(paths['instances'], number, spec.depth)]
+        if rng.random() < spec.duplicates:
+            dirs.append(os.path.join(paths['instances'], 'resent'))
+        for dir_path in dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            file_name = '{0}_{1:08d}.xml'.format(form_id, number)
+            with open(os.path.join(dir_path, file_name), mode='w',
+                      encoding='UTF-8') as f:
+                f.write(xml)
+    return paths
@@ -0,0 +1,303 @@
+"""
+Time each stage of the aggregation over a synthetic corpus.
+
+Usage (from the repository root):
+python -m benchmarks.run --instances 10000 --forms 2 --versions 2
+
+Each run's timings are appended to a results file (one JSON object per
+line), and compared with the last run in that file with the same corpus
+and options.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from typing import Callable, Iterable, List, Tuple, Union
+
+import xmltodict
+
+from benchmarks import corpus
+from odk_aggregation_tool import __version__
+from odk_aggregation_tool.aggregation import readers, to_stata_xml, writers, \
+    metrics, cache
+
+
+DEFAULT_RESULTS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+stage_result = namedtuple('StageResult', ['stage', 'seconds', 'items'])
+
+
+class StageTimer:
+    """
+    Collect the wall time and item count for each stage, in order.
+
+    Usage:
+    timer = StageTimer()
+    files = timer.time("discovery", find_files)
+    """
+
+    def __init__(self):
+        self.results = list()
+
+    def time(self, stage: str, func: Callable, *args, items: Callable = len,
+             **kwargs):
+        """Call func, record how long it took, and return its result."""
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.results.append(stage_result(
+            stage=stage, seconds=seconds, items=items(result)))
+        return result
+
+
+def read_instances(file_paths: List[str], workers: int, chunk_size: int,
+                   io_threads: int) -> List[OrderedDict]:
+    """Return the flattened instances read from each file (or archive)."""
+    results = to_stata_xml.map_in_workers(
+        func=to_stata_xml.read_xform_item,
+        iterable=to_stata_xml.iter_xform_items(file_paths=file_paths),
+        workers=workers, chunk_size=chunk_size, io_threads=io_threads)
+    return [flat for flat, _ in results]
+
+
+def spool_instances(spool: cache.Spool, instances: List[OrderedDict],
+                    form_ids: Iterable[str]) -> int:
+    """Add the instances for form_ids to the spool, return how many."""
+    spool.extend(items=(x for x in instances if x["@id"] in form_ids),
+                 key=lambda x: x["@id"])
+    return sum(spool.counts.values())
+
+
+def prepare_forms(spool: cache.Spool, form_defs: OrderedDict) -> List[Tuple]:
+    """Return the prepared data for each form, from its spooled instances."""
+    return [to_stata_xml.prepare_form_data(
+        form_id=form_id, form_def=form_def,
+        xform_instances=spool.get(key=form_id))
+        for form_id, form_def in form_defs.items()]
+
+
+def run_stages(xlsform_path: str, instances_path: str, output_path: str,
+               output_format_name: str = "xml", workers: int = 1,
+               chunk_size: int = 1000,
+               io_threads: int = readers.IO_THREADS) -> List[stage_result]:
+    """
+    Run the aggregation one stage at a time, and return the stage timings.
+
+    The stages are the same steps that to_stata_xml.iter_form_instances and
+    writers.write_forms go through, with the same names as metrics.STAGES,
+    but each one is run to completion before the next starts, so they can
+    be timed separately. The "serialize" stage renders each form's Stata XML
+    document in memory (as to_stata_xml does), and the "write" stage writes
+    each form's output file in the given format, so for XML output the
+    document is rendered again while writing.
+    """
+    timer = StageTimer()
+    form_defs = timer.time(
+        "xlsforms", to_stata_xml.collate_xlsforms_by_form_id,
+        xlsform_path=xlsform_path)
+    file_paths = timer.time("discovery", lambda: list(
+        readers.find_instance_files(path=instances_path, threads=io_threads)))
+    instances = timer.time(
+        "read", read_instances, file_paths=file_paths, workers=workers,
+        chunk_size=chunk_size, io_threads=io_threads)
+    instances = timer.time(
+        "dedupe", to_stata_xml.remove_duplicate_instances,
+        instances=instances)
+    with cache.Spool() as spool:
+        timer.time(
+            "partition", spool_instances, spool=spool, instances=instances,
+            form_ids=form_defs, items=lambda x: x)
+        # Only the spooled copy is kept from here, as for iter_form_instances.
+        instances = None
+        prepared = timer.time(
+            "prepare", prepare_forms, spool=spool, form_defs=form_defs,
+            items=lambda x: sum(len(data) for _, _, data in x))
+    timer.time("serialize", lambda: [
+        xmltodict.unparse(to_stata_xml.prepare_stata_doc(
+            form_id=form_id, form_def=form_def, xform_data=data,
+            stream=True))
+        for form_id, form_def, data in prepared],
+        items=lambda x: sum(len(doc) for doc in x))
+    timer.time("write", lambda: [
+        writers.write_form_data(
+            form_id=form_id, form_def=form_def, xform_data=data,
+            output_path=output_path, output_format_name=output_format_name)
+        for form_id, form_def, data in prepared])
+    return timer.results
+
+
+def summarise(spec: corpus.corpus_spec, args: argparse.Namespace,
+              stages: List[stage_result], file_count: int) -> OrderedDict:
+    """Return the run's results as a dict, ready to be saved as JSON."""
+    total = sum(x.seconds for x in stages)
+    return OrderedDict([
+        ("timestamp", datetime.now().isoformat(timespec="seconds")),
+        ("version", __version__),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("spec", spec._asdict()),
+        ("options", OrderedDict([
+            ("format", args.output_format), ("workers", args.workers),
+            ("io_threads", args.io_threads),
+            ("chunk_size", args.chunk_size)])),
+        ("files", file_count),
+        ("stages", [OrderedDict([
+            ("stage", x.stage), ("seconds", round(x.seconds, 4)),
+            ("items", x.items)]) for x in stages]),
+        ("total_seconds", round(total, 4)),
+        ("files_per_second", round(file_count / total, 1) if total else None),
+        ("peak_rss_mb", metrics.peak_rss_mb()),
+    ])
+
+
+def read_previous_result(results_path: str, summary: OrderedDict
+                         ) -> Union[OrderedDict, None]:
+    """Return the last saved result with the same spec and options, if any."""
+    previous = None
+    if not os.path.isfile(results_path):
+        return previous
+    with open(results_path, encoding="UTF-8") as results_file:
+        for line in results_file:
+            if not line.strip():
+                continue
+            result = json.loads(line, object_pairs_hook=OrderedDict)
+            if result.get("spec") == summary["spec"] and \
+                    result.get("options") == summary["options"]:
+                previous = result
+    return previous
+
+
+def save_result(results_path: str, summary: OrderedDict) -> None:
+    """Append the result to the results file."""
+    with open(results_path, mode="a", encoding="UTF-8") as results_file:
+        results_file.write(json.dumps(summary) + "\n")
+
+
+def format_report(summary: OrderedDict, previous: OrderedDict = None
+                  ) -> str:
+    """Return a table of the stage timings, compared to previous if given."""
+    before = dict()
+    if previous is not None:
+        before = {x["stage"]: x["seconds"] for x in previous["stages"]}
+        before["total"] = previous["total_seconds"]
+    rows = [(x["stage"], x["seconds"], x["items"]) for x in summary["stages"]]
+    rows.append(("total", summary["total_seconds"], summary["files"]))
+    lines = ["{0:<10} {1:>10} {2:>10} {3:>9}".format(
+        "stage", "seconds", "items", "change")]
+    for stage, seconds, items in rows:
+        change = ""
+        if before.get(stage):
+            change = "{0:+.1%}".format(seconds / before[stage] - 1)
+        lines.append("{0:<10} {1:>10.3f} {2:>10} {3:>9}".format(
+            stage, seconds, items, change))
+    lines.append("Files per second: {0}".format(summary["files_per_second"]))
+    lines.append("Peak RSS (MB): {0}".format(summary["peak_rss_mb"]))
+    if previous is not None:
+        lines.append("Compared with the run at {0}.".format(
+            previous["timestamp"]))
+    return "\n".join(lines)
+
+
+def prepare_corpus(corpus_dir: str, spec: corpus.corpus_spec) -> dict:
+    """
+    Generate the corpus in corpus_dir, unless it already has one for spec.
+
+    Generating a large corpus takes a while, so if the same corpus_dir is
+    given for later runs, the corpus is re-used.
+    """
+    spec_path = os.path.join(corpus_dir, "corpus.json")
+    if os.path.isfile(spec_path):
+        with open(spec_path, encoding="UTF-8") as spec_file:
+            if json.load(spec_file) == spec._asdict():
+                return dict(
+                    xlsforms=os.path.join(corpus_dir, "xlsforms"),
+                    instances=os.path.join(corpus_dir, "instances"))
+        raise ValueError(
+            "The corpus directory has a corpus for a different spec: "
+            "{0}".format(corpus_dir))
+    paths = corpus.generate_corpus(root_dir=corpus_dir, spec=spec)
+    with open(spec_path, mode="w", encoding="UTF-8") as spec_file:
+        json.dump(spec._asdict(), spec_file)
+    return paths
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Prepare the command line argument parser."""
+    defaults = corpus.DEFAULT_SPEC
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Time each stage of the aggregation over a synthetic "
+                    "corpus of XLSForms and instance XML files.")
+    corpus_args = parser.add_argument_group("corpus")
+    corpus_args.add_argument("--forms", type=int, default=defaults.forms)
+    corpus_args.add_argument(
+        "--versions", type=int, default=defaults.versions,
+        help="Versions per form, each adding a variable.")
+    corpus_args.add_argument(
+        "--variables", type=int, default=defaults.variables,
+        help="Variables in the first version of each form.")
+    corpus_args.add_argument(
+        "--instances", type=int, default=defaults.instances,
+        help="Instance XML files, before duplicates.")
+    corpus_args.add_argument(
+        "--repeats", type=int, default=defaults.repeats,
+        help="Repeat group entries per instance.")
+    corpus_args.add_argument(
+        "--duplicates", type=float, default=defaults.duplicates,
+        help="Fraction of instances written twice.")
+    corpus_args.add_argument(
+        "--depth", type=int, default=defaults.depth,
+        help="Directory depth of the instance files.")
+    corpus_args.add_argument("--seed", type=int, default=defaults.seed)
+    corpus_args.add_argument(
+        "--corpus-dir", default=None,
+        help="Where to generate (or re-use) the corpus. A temporary "
+             "directory is used otherwise.")
+    parser.add_argument(
+        "--format", dest="output_format", default="xml",
+        choices=list(writers.output_formats.keys()))
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--io-threads", type=int, default=readers.IO_THREADS)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument(
+        "--results", dest="results_path", default=DEFAULT_RESULTS_PATH,
+        help="File to append results to (default: %(default)s).")
+    parser.add_argument(
+        "--no-save", action="store_true",
+        help="Compare with previous results, but don't save this one.")
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    """Generate the corpus, time the stages, report and save the results."""
+    args = build_parser().parse_args(argv)
+    spec = corpus.corpus_spec(**{
+        k: getattr(args, k) for k in corpus.corpus_spec._fields})
+    with tempfile.TemporaryDirectory() as temp_dir:
+        corpus_dir = args.corpus_dir or os.path.join(temp_dir, "corpus")
+        paths = prepare_corpus(corpus_dir=corpus_dir, spec=spec)
+        output_path = os.path.join(temp_dir, "output")
+        os.makedirs(output_path)
+        stages = run_stages(
+            xlsform_path=paths["xlsforms"], instances_path=paths["instances"],
+            output_path=output_path, output_format_name=args.output_format,
+            workers=args.workers, chunk_size=args.chunk_size,
+            io_threads=args.io_threads)
+    file_count = next(x.items for x in stages if x.stage == "discovery")
+    summary = summarise(
+        spec=spec, args=args, stages=stages, file_count=file_count)
+    previous = read_previous_result(
+        results_path=args.results_path, summary=summary)
+    print(format_report(summary=summary, previous=previous))
+    if not args.no_save:
+        save_result(results_path=args.results_path, summary=summary)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""
+Time how long the GUI takes to import, before the window can appear.
+
+Usage (from the repository root):
+python -m benchmarks.startup --runs 5
+
+The GUI module is imported in a new Python process with "-X importtime",
+so that the time for each module imported is known, and modules imported
+by an earlier run aren't re-used. Each run's result is appended to the same
+results file as benchmarks.run, and compared with the last startup result
+for the same module.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Tuple, Union
+
+from benchmarks.run import DEFAULT_RESULTS_PATH, save_result
+from odk_aggregation_tool import __version__
+
+
+GUI_MODULE = "odk_aggregation_tool.gui.gui"
+# These are only needed once a task is run, so the GUI shouldn't import them.
+DEFERRED_MODULES = ["odk_aggregation_tool.aggregation", "xlrd", "xmltodict"]
+# Each level of nesting is indented by 2 more spaces, after the first one.
+IMPORT_TIME_LINE = re.compile(
+    r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times(module: str) -> List[Tuple[str, int, int]]:
+    """
+    Return the name, time taken (in microseconds, including the modules it
+    imported) and nesting depth of each module imported, when importing
+    module in a new process.
+
+    The modules are in the order their imports finished, so each module is
+    after the modules it imported. Those imported by Python itself at
+    startup are included too, and are listed first.
+    """
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stderr=subprocess.PIPE, universal_newlines=True, env=env,
+        check=True, cwd=REPO_DIR)
+    times = list()
+    for line in process.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is not None:
+            times.append((match.group(4), int(match.group(2)),
+                          len(match.group(3)) // 2))
+    return times
+
+
+def direct_imports(times: List[Tuple[str, int, int]], module: str
+                   ) -> List[Tuple[str, int]]:
+    """Return the name and time of each module that module imported."""
+    index = next(i for i, x in enumerate(times) if x[0] == module)
+    depth = times[index][2]
+    imports = list()
+    for name, microseconds, import_depth in reversed(times[:index]):
+        if import_depth <= depth:
+            break
+        if import_depth == depth + 1:
+            imports.append((name, microseconds))
+    return imports[::-1]
+
+
+def measure_startup(module: str = GUI_MODULE, runs: int = 3) -> OrderedDict:
+    """
+    Import the module in runs new processes, and return the fastest run's
+    import time, its slowest direct imports, and any deferred modules that
+    it imported.
+    """
+    runs_times = [import_times(module=module) for _ in range(runs)]
+    fastest = min(runs_times, key=lambda x: next(
+        t for name, t, _ in x if name == module))
+    import_us = next(t for name, t, _ in fastest if name == module)
+    slowest = sorted(direct_imports(times=fastest, module=module),
+                     key=lambda x: x[1], reverse=True)
+    deferred = [name for name, _, _ in fastest if any(
+        name == x or name.startswith(x + ".") for x in DEFERRED_MODULES)]
+    return OrderedDict([
+        ("benchmark", "startup"),
+        ("timestamp", datetime.now().isoformat(timespec="seconds")),
+        ("version", __version__),
+        ("python", platform.python_version()),
+        ("platform", platform.platform()),
+        ("module", module),
+        ("runs", runs),
+        ("import_ms", round(import_us / 1000, 1)),
+        ("modules", len(fastest)),
+        ("slowest", OrderedDict(
+            (name, round(t / 1000, 1)) for name, t in slowest[:5])),
+        ("deferred_modules", deferred),
+    ])
+
+
+def read_previous_result(results_path: str, summary: OrderedDict
+                         ) -> Union[OrderedDict, None]:
+    """Return the last saved startup result for the same module, if any."""
+    previous = None
+    if not os.path.isfile(results_path):
+        return previous
+    with open(results_path, encoding="UTF-8") as results_file:
+        for line in results_file:
+            if not line.strip():
+                continue
+            result = json.loads(line, object_pairs_hook=OrderedDict)
+            if result.get("benchmark") == "startup" and \
+                    result.get("module") == summary["module"]:
+                previous = result
+    return previous
+
+
+def format_report(summary: OrderedDict, previous: OrderedDict = None) -> str:
+    """Return the import time, compared to previous if given."""
+    change = ""
+    if previous is not None and previous["import_ms"]:
+        change = " ({0:+.1%})".format(
+            summary["import_ms"] / previous["import_ms"] - 1)
+    lines = ["Import time for {0}: {1} ms{2}".format(
+        summary["module"], summary["import_ms"], change)]
+    lines.append("Slowest direct imports (ms): {0}".format(
+        ", ".join("{0}: {1}".format(k, v)
+                  for k, v in summary["slowest"].items())))
+    if summary["deferred_modules"]:
+        lines.append("Modules imported that should wait for a task to run: "
+                     "{0}".format(", ".join(summary["deferred_modules"])))
+    if previous is not None:
+        lines.append("Compared with the run at {0}.".format(
+            previous["timestamp"]))
+    return "\n".join(lines)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Prepare the command line argument parser."""
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.startup",
+        description="Time how long the GUI module takes to import.")
+    parser.add_argument("--module", default=GUI_MODULE)
+    parser.add_argument(
+        "--runs", type=int, default=3,
+        help="Imports to run, keeping the fastest (default: %(default)s).")
+    parser.add_argument(
+        "--results", dest="results_path", default=DEFAULT_RESULTS_PATH,
+        help="File to append results to (default: %(default)s).")
+    parser.add_argument(
+        "--no-save", action="store_true",
+        help="Compare with previous results, but don't save this one.")
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Time the import, report and save the result. Return 1 if the module
+    imported any deferred modules, otherwise 0.
+    """
+    args = build_parser().parse_args(argv)
+    summary = measure_startup(module=args.module, runs=args.runs)
+    previous = read_previous_result(
+        results_path=args.results_path, summary=summary)
+    print(format_report(summary=summary, previous=previous))
+    if not args.no_save:
+        save_result(results_path=args.results_path, summary=summary)
+    return 1 if summary["deferred_modules"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import tempfile
+from collections import OrderedDict, deque
+from typing import Any, Callable, Iterable, Iterator, List
+import logging
+from odk_aggregation_tool import __version__
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+# Change this whenever the cached data, or how it is read, changes (e.g. a
+# different digest), so that cache files written before are not re-used.
+CACHE_FORMAT = 2
+DIGEST_BLOCK_SIZE = 1024 * 1024
+
+
+class FileCache:
+    """
+    A persistent cache of data read from files, in a SQLite database table.
+
+    Each entry is keyed by the path of the file that the data was read from,
+    and also records the size, modification time and content digest (see
+    file_digest) of the file at the time. An entry is only fresh while the
+    file still has the same size, modification time and digest. Entries for
+    files that no longer exist can be removed with prune(), and all entries
+    can be removed with clear().
+
+    The cache file records the CACHE_FORMAT and version of the tool that
+    wrote it. If either is different, all the tables in it are dropped
+    when it is opened, so that data read by other versions isn't re-used.
+
+    The data is stored using pickle, so the cache file should be kept where
+    only the users of this tool can write to it.
+
+    Usage:
+    with FileCache(db_path="cache.sqlite", table="instances") as file_cache:
+        if file_cache.is_fresh(file_path=path, size=size, mtime=mtime,
+                               digest=digest):
+            data = file_cache.get(file_path=path)
+    """
+
+    def __init__(self, db_path: str, table: str, commit_every: int = 1000):
+        self.db_path = db_path
+        self.table = table
+        self.commit_every = commit_every
+        self.pending = 0
+        self.connection = sqlite3.connect(db_path)
+        self.check_format()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS {0} (path TEXT PRIMARY KEY, "
+            "size INTEGER, mtime INTEGER, digest TEXT, data BLOB)".format(
+                table))
+        self.stats = {
+            path: (size, mtime, digest) for path, size, mtime, digest in
+            self.connection.execute(
+                "SELECT path, size, mtime, digest FROM {0}".format(table))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.stats)
+
+    def check_format(self) -> None:
+        """Drop all the tables if the file was written by another version."""
+        cache_format = "{0}/{1}".format(CACHE_FORMAT, __version__)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache_format (format TEXT)")
+        row = self.connection.execute(
+            "SELECT format FROM cache_format").fetchone()
+        if row is not None and row[0] == cache_format:
+            return
+        tables = [name for name, in self.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name != 'cache_format'")]
+        if len(tables) > 0:
+            logger.info(
+                "The cache file was written by a different version, so its "
+                "data will be read again. Cache file: {0}".format(
+                    self.db_path))
+        for name in tables:
+            self.connection.execute("DROP TABLE {0}".format(name))
+        self.connection.execute("DELETE FROM cache_format")
+        self.connection.execute(
+            "INSERT INTO cache_format (format) VALUES (?)", (cache_format,))
+        self.connection.commit()
+
+    def is_fresh(self, file_path: str, size: int, mtime: int,
+                 digest: str) -> bool:
+        """Is there an entry for the file, with the same stats and digest?"""
+        return self.stats.get(file_path) == (size, mtime, digest)
+
+    def get(self, file_path: str) -> Any:
+        """Return the data cached for the file."""
+        row = self.connection.execute(
+            "SELECT data FROM {0} WHERE path = ?".format(self.table),
+            (file_path,)).fetchone()
+        if row is None:
+            raise KeyError(file_path)
+        return pickle.loads(row[0])
+
+    def put(self, file_path: str, size: int, mtime: int, digest: str,
+            data: Any) -> None:
+        """Add or replace the data cached for the file."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO {0} (path, size, mtime, digest, data) "
+            "VALUES (?, ?, ?, ?, ?)".format(self.table),
+            (file_path, size, mtime, digest,
+             pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.stats[file_path] = (size, mtime, digest)
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def prune(self, keep_paths: Iterable[str]) -> List[str]:
+        """Remove entries for files other than keep_paths, return removed."""
+        keep_paths = set(keep_paths)
+        removed = [x for x in self.stats if x not in keep_paths]
+        self.connection.executemany(
+            "DELETE FROM {0} WHERE path = ?".format(self.table),
+            ((x,) for x in removed))
+        for file_path in removed:
+            del self.stats[file_path]
+        self.commit()
+        return removed
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        self.connection.execute("DELETE FROM {0}".format(self.table))
+        self.stats.clear()
+        self.commit()
+
+    def commit(self) -> None:
+        """Save changes to the database file."""
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self) -> None:
+        """Save changes and close the database file."""
+        self.commit()
+        self.connection.close()
+
+
+class Spool:
+    """
+    Items grouped by key, in a temporary SQLite database file, so that the
+    items for one key at a time can be loaded back in to memory.
+
+    The items are stored using pickle, and are returned for each key in the
+    order they were added. The database file is removed by close().
+
+    Usage:
+    with Spool() as spool:
+        spool.extend(items=instances, key=lambda x: x["@id"])
+        for form_id in spool.counts:
+            form_instances = spool.get(key=form_id)
+    """
+
+    def __init__(self, dir_path: str = None):
+        handle, self.db_path = tempfile.mkstemp(
+            suffix=".sqlite", prefix="spool_", dir=dir_path)
+        os.close(handle)
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.execute(
+            "CREATE TABLE items (key TEXT, data BLOB)")
+        # Number of items for each key, in the order each key was first added.
+        self.counts = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def extend(self, items: Iterable, key: Callable) -> None:
+        """Add the items, grouped by key(item)."""
+
+        def rows():
+            for item in items:
+                item_key = key(item)
+                self.counts[item_key] = self.counts.get(item_key, 0) + 1
+                yield (item_key, pickle.dumps(
+                    item, protocol=pickle.HIGHEST_PROTOCOL))
+
+        self.connection.executemany(
+            "INSERT INTO items (key, data) VALUES (?, ?)", rows())
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS items_key ON items (key)")
+        self.connection.commit()
+
+    def get(self, key: str) -> List:
+        """Return the items for the key, in the order they were added."""
+        return [pickle.loads(data) for data, in self.connection.execute(
+            "SELECT data FROM items WHERE key = ? ORDER BY rowid", (key,))]
+
+    def close(self) -> None:
+        """Close and remove the database file."""
+        self.connection.close()
+        if os.path.isfile(self.db_path):
+            os.remove(self.db_path)
+
+
+class ExpandedKeys(list):
+    """The keys of the items that a file was expanded into, by read_through."""
+    pass
+
+
+def file_digest(file_path: str) -> str:
+    """Return the SHA-1 hex digest of the file's content."""
+    digest = hashlib.sha1()
+    with open(file_path, mode="rb") as f:
+        for block in iter(lambda: f.read(DIGEST_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_through(func: Callable, file_paths: Iterable[str], cache_path: str,
+                 table: str, map_func: Callable = map,
+                 expand: Callable = None) -> Iterator:
+    """
+    Yield func results for each file path, re-using results from the cache.
+
+    Only files that are new, or have a different size, modification time or
+    content digest to when they were cached, are passed to func (using
+    map_func), and those results are added to the cache, unless the result
+    is None. Each file is read to check its digest, which is much quicker
+    than func, and catches files re-written with the same size and
+    modification time. Cached results for files that weren't found are
+    removed from the cache.
+
+    If expand is given, it is called with each new or changed file path,
+    and returns either None, or (item, key) pairs to pass to func one item
+    at a time instead of the file path (e.g. for each file in an archive).
+    Each item's result is cached under its key, with the stats and digest
+    of the file, so that the file's results are streamed through, rather
+    than held all at once. The keys are cached under the file path once all
+    of its items are done.
+    """
+    with FileCache(db_path=cache_path, table=table) as file_cache:
+        # For each file or item, in order: whether it's stale, its key, and
+        # for an expanded file, its item keys (after all of its items).
+        found = deque()
+        seen = set()
+
+        def find_stale_items():
+            for file_path in file_paths:
+                stat = os.stat(file_path)
+                key = (file_path, stat.st_size, stat.st_mtime_ns,
+                       file_digest(file_path=file_path))
+                seen.add(file_path)
+                if file_cache.is_fresh(*key):
+                    found.append((False, key, None))
+                    continue
+                items = None if expand is None else expand(file_path)
+                if items is None:
+                    found.append((True, key, None))
+                    yield file_path
+                    continue
+                item_keys = ExpandedKeys()
+                for item, item_key in items:
+                    seen.add(item_key)
+                    item_keys.append(item_key)
+                    found.append((True, (item_key,) + key[1:], None))
+                    yield item
+                found.append((False, key, item_keys))
+
+        counts = dict(stale=0, cached=0)
+
+        def from_cache(key, item_keys):
+            if item_keys is not None:  # All of its items are done.
+                stats = key[1:]
+                file_cache.put(*key, data=ExpandedKeys(
+                    x for x in item_keys if file_cache.stats.get(x) == stats))
+                return
+            data = file_cache.get(file_path=key[0])
+            if not isinstance(data, ExpandedKeys):
+                counts["cached"] += 1
+                yield data
+                return
+            for item_key in data:
+                seen.add(item_key)
+                counts["cached"] += 1
+                yield file_cache.get(file_path=item_key)
+
+        for result in map_func(func, find_stale_items()):
+            stale, key, item_keys = found.popleft()
+            while not stale:
+                yield from from_cache(key=key, item_keys=item_keys)
+                stale, key, item_keys = found.popleft()
+            if result is not None:
+                file_cache.put(*key, data=result)
+            counts["stale"] += 1
+            yield result
+        while len(found) > 0:
+            stale, key, item_keys = found.popleft()
+            yield from from_cache(key=key, item_keys=item_keys)
+        removed = file_cache.prune(keep_paths=seen)
+        logger.info(
+            "Read {0} new or changed files, re-used cached data for {1} "
+            "files, and removed cached data for {2} files that were not "
+            "found. Cache file: {3}".format(
+                counts["stale"], counts["cached"], len(removed), cache_path))
+
+
+def clear_cache(cache_path: str) -> None:
+    """Remove the cache file, if it exists."""
+    if os.path.isfile(cache_path):
+        os.remove(cache_path)
+        logger.info("Removed cache file: {0}".format(cache_path))
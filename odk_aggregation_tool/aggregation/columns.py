@@ -0,0 +1,129 @@
+from array import array
+from collections import OrderedDict
+from itertools import repeat
+from typing import Any, Callable, Iterable, Iterator, List, Sequence, Tuple
+
+
+class ColumnarData:
+    """
+    Instance data held as a list of values per variable (column).
+
+    Holding a dict per instance takes a lot of memory when there are many
+    variables and instances, whereas here each instance only adds a value
+    to each column, and the index of its layout. A layout is the tuple of
+    variable names that an instance had, in its original order. Instances
+    from the same form version mostly share one layout, so each layout is
+    only kept once. Variables that an instance didn't have are None in the
+    column, and are left out when the instance is read back as a dict.
+
+    Usage:
+    data = ColumnarData()
+    data.append(keys=("a", "b"), values=["1", None])
+    a_values = data.column("a")
+    for a, b in data.iter_rows(names=["a", "b"]):
+        pass
+    """
+
+    def __init__(self):
+        self.columns = OrderedDict()
+        self.layouts = list()
+        self.layout_numbers = dict()
+        self.row_layouts = array('L')
+        # Per distinct keys tuple appended: see layout_plan.
+        self.layout_plans = dict()
+
+    def __len__(self):
+        return len(self.row_layouts)
+
+    def __iter__(self) -> Iterator[OrderedDict]:
+        for layout_number, values in self.iter_layout_rows():
+            yield OrderedDict(zip(self.layouts[layout_number], values))
+
+    def __getitem__(self, row_number: int) -> OrderedDict:
+        keys = self.layouts[self.row_layouts[row_number]]
+        return OrderedDict((k, self.columns[k][row_number]) for k in keys)
+
+    def layout_plan(self, keys: Tuple[str, ...]
+                    ) -> Tuple[int, List[int], List[List], List[List]]:
+        """
+        Return the layout number, value positions, and column lists for keys.
+
+        If a key is repeated, the last value is kept, at the first key's
+        position (the same as building an OrderedDict from the pairs).
+        """
+        plan = self.layout_plans.get(keys)
+        if plan is None:
+            positions = OrderedDict()
+            for i, k in enumerate(keys):
+                positions[k] = i
+            layout = tuple(positions.keys())
+            layout_number = self.layout_numbers.get(layout)
+            if layout_number is None:
+                for k in layout:
+                    if k not in self.columns:
+                        self.add_column(name=k)
+                layout_number = len(self.layouts)
+                self.layouts.append(layout)
+                self.layout_numbers[layout] = layout_number
+            present = set(layout)
+            plan = (layout_number, list(positions.values()),
+                    [self.columns[k] for k in layout],
+                    [v for k, v in self.columns.items() if k not in present])
+            self.layout_plans[keys] = plan
+        return plan
+
+    def add_column(self, name: str) -> None:
+        """Add a column, with None for the rows already added."""
+        self.columns[name] = [None] * len(self)
+        # The lists of columns missing from each layout are now out of date.
+        self.layout_plans.clear()
+
+    def append(self, keys: Sequence[str], values: Sequence[Any]) -> None:
+        """Add a row, given its variable names and values in the same order."""
+        layout_number, positions, present, missing = self.layout_plan(
+            keys=tuple(keys))
+        for position, column in zip(positions, present):
+            column.append(values[position])
+        for column in missing:
+            column.append(None)
+        self.row_layouts.append(layout_number)
+
+    def append_row(self, row: OrderedDict) -> None:
+        """Add a row, given as a dict of variable names and values."""
+        self.append(keys=tuple(row.keys()), values=list(row.values()))
+
+    def column(self, name: str) -> Sequence[Any]:
+        """Return the values for the variable, all None if it isn't known."""
+        values = self.columns.get(name)
+        if values is None:
+            values = [None] * len(self)
+        return values
+
+    def convert(self, name: str, func: Callable) -> None:
+        """Replace each value of the variable with func(value), if not None."""
+        values = self.columns.get(name)
+        if values is not None:
+            values[:] = [None if v is None else func(v) for v in values]
+
+    def iter_rows(self, names: Iterable[str]) -> Iterator[Tuple]:
+        """Yield a tuple per row of the values for the variable names."""
+        return zip(*[self.columns.get(name, repeat(None, len(self)))
+                     for name in names])
+
+    def iter_layout_rows(self) -> Iterator[Tuple[int, List[Any]]]:
+        """Yield the layout number and values in layout order, per row."""
+        columns = [[self.columns[k] for k in layout]
+                   for layout in self.layouts]
+        for row_number, layout_number in enumerate(self.row_layouts):
+            yield layout_number, [
+                x[row_number] for x in columns[layout_number]]
+
+
+def as_columnar(xform_data: Iterable[OrderedDict]) -> ColumnarData:
+    """Return the data as ColumnarData, converting it if needed."""
+    if isinstance(xform_data, ColumnarData):
+        return xform_data
+    data = ColumnarData()
+    for row in xform_data:
+        data.append_row(row=row)
+    return data
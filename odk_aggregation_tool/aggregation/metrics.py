@@ -0,0 +1,271 @@
+import cProfile
+import io
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterable, Iterator, Union
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+# In the order that they first start, for an aggregation run.
+STAGES = ["xlsforms", "discovery", "read", "dedupe", "partition", "prepare",
+          "serialize", "write"]
+# A tracemalloc snapshot is taken when the traced memory has grown this much.
+SNAPSHOT_GROWTH = 1.1
+
+
+def peak_rss_mb() -> Union[float, None]:
+    """Return the peak resident memory of this process so far, in MB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS gives bytes.
+    if sys.platform == "darwin":
+        peak = peak / 1024
+    return round(peak / 1024, 1)
+
+
+class RunMetrics:
+    """
+    Wall time, item counts and peak memory for each stage of a run.
+
+    The stages of an aggregation run are interleaved, since the instance
+    files are streamed through discovery, reading and de-duplication, and
+    the output is written while it is serialized. So each stage records its
+    own time only: while a stage is running, time spent in another stage
+    that it calls (or pulls items from) is counted for that other stage.
+    The peak memory is that of the process, up to the end of the stage.
+
+    If a profile_stage is given, that stage is profiled with cProfile, and
+    the memory allocated each time it runs is traced with tracemalloc. The
+    tracemalloc snapshot kept is from the end of the time that the stage
+    held the most memory (to within SNAPSHOT_GROWTH). The stats and the
+    snapshot are written to profile_path + ".prof" and ".tracemalloc" by
+    finish(), for reading with pstats and tracemalloc.Snapshot.load().
+
+    Stages must be started and ended on one thread.
+
+    Usage:
+    run_metrics = RunMetrics()
+    with measure_stage(run_metrics, "prepare") as stage:
+        stage["items"] += len(data)
+    run_metrics.finish()
+    run_metrics.write(metrics_path="metrics.json")
+    """
+
+    def __init__(self, profile_stage: str = None, profile_path: str = None):
+        self.started = datetime.now()
+        self.start_time = time.perf_counter()
+        self.seconds = None
+        self.stages = OrderedDict()
+        # For each stage currently running: name, start time, time in others.
+        self.running = list()
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path
+        self.profiler = None
+        self.snapshot = None
+        self.snapshot_size = 0
+        self.traced_peak = 0
+
+    def stage(self, name: str) -> dict:
+        """Return the metrics for the stage, adding the stage if needed."""
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = dict(seconds=0.0, items=0, peak_rss_mb=None)
+            self.stages[name] = stage
+        return stage
+
+    def start_stage(self, name: str) -> None:
+        """Start timing the stage, pausing the stage that is running now."""
+        if self.running and self.running[-1][0] == self.profile_stage:
+            self.pause_profile()
+        if name == self.profile_stage:
+            tracemalloc.start()
+            self.resume_profile()
+        self.running.append([name, time.perf_counter(), 0.0])
+
+    def end_stage(self, items: int = 0) -> None:
+        """Stop timing the stage most recently started."""
+        name, start, other_seconds = self.running.pop()
+        seconds = time.perf_counter() - start
+        if name == self.profile_stage:
+            self.pause_profile()
+            self.take_snapshot()
+            tracemalloc.stop()
+        stage = self.stage(name=name)
+        stage["seconds"] += seconds - other_seconds
+        stage["items"] += items
+        stage["peak_rss_mb"] = peak_rss_mb()
+        if self.running:
+            self.running[-1][2] += seconds
+            if self.running[-1][0] == self.profile_stage:
+                self.resume_profile()
+
+    def add_stages(self, stages: OrderedDict) -> None:
+        """Add the stage metrics from another run (e.g. a worker process)."""
+        for name, other in stages.items():
+            stage = self.stage(name=name)
+            stage["seconds"] += other["seconds"]
+            stage["items"] += other["items"]
+            peaks = [x for x in (stage["peak_rss_mb"], other["peak_rss_mb"])
+                     if x is not None]
+            stage["peak_rss_mb"] = max(peaks) if peaks else None
+
+    def resume_profile(self) -> None:
+        """Start or resume profiling."""
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def pause_profile(self) -> None:
+        """Pause profiling, e.g. while another stage runs."""
+        self.profiler.disable()
+
+    def take_snapshot(self) -> None:
+        """Take a tracemalloc snapshot, if it would be the largest so far."""
+        size, peak = tracemalloc.get_traced_memory()
+        self.traced_peak = max(self.traced_peak, peak)
+        if size > self.snapshot_size * SNAPSHOT_GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_size = size
+
+    def finish(self) -> None:
+        """Stop the run's clock, and write the profile data if any."""
+        self.seconds = time.perf_counter() - self.start_time
+        if self.profiler is None:
+            return
+        self.profiler.dump_stats(self.profile_path + ".prof")
+        if self.snapshot is not None:
+            self.snapshot.dump(self.profile_path + ".tracemalloc")
+        self.stage(name=self.profile_stage)["traced_peak_mb"] = round(
+            self.traced_peak / 1024 ** 2, 1)
+        logger.info("Wrote profile data for stage: {0}, to files at: "
+                    "{1}.*".format(self.profile_stage, self.profile_path))
+
+    def summary(self) -> OrderedDict:
+        """Return the metrics as a dict, ready to be saved as JSON."""
+        stages = list()
+        for name, stage in self.stages.items():
+            per_second = None
+            if stage["seconds"] > 0:
+                per_second = round(stage["items"] / stage["seconds"], 1)
+            summary = OrderedDict([
+                ("stage", name), ("seconds", round(stage["seconds"], 4)),
+                ("items", stage["items"]), ("items_per_second", per_second),
+                ("peak_rss_mb", stage["peak_rss_mb"])])
+            if "traced_peak_mb" in stage:
+                summary["traced_peak_mb"] = stage["traced_peak_mb"]
+            stages.append(summary)
+        return OrderedDict([
+            ("started", self.started.isoformat()),
+            ("seconds", None if self.seconds is None
+                else round(self.seconds, 4)),
+            ("peak_rss_mb", peak_rss_mb()),
+            ("profile_stage", self.profile_stage),
+            ("stages", stages),
+        ])
+
+    def write(self, metrics_path: str) -> None:
+        """Write the metrics summary to a JSON file."""
+        with open(metrics_path, mode="w", encoding="UTF-8") as metrics_file:
+            json.dump(self.summary(), metrics_file, indent=2)
+
+
+@contextmanager
+def measure_stage(run_metrics: Union[RunMetrics, None], name: str):
+    """
+    Time the stage for the body of the with statement, if run_metrics.
+
+    A dict with an "items" count is given to the with statement, for the
+    body to add to, and the count is added to the stage's metrics at the
+    end. If run_metrics is None, the stage isn't timed.
+    """
+    counts = dict(items=0)
+    if run_metrics is None:
+        yield counts
+        return
+    run_metrics.start_stage(name=name)
+    try:
+        yield counts
+    finally:
+        run_metrics.end_stage(items=counts["items"])
+
+
+def measure_iter(run_metrics: Union[RunMetrics, None], name: str,
+                 items: Iterable) -> Iterator:
+    """
+    Yield the items, timing how long each took to get, if run_metrics.
+
+    Each item yielded adds 1 to the stage's item count. If run_metrics is
+    None, the items are returned as is.
+    """
+    if run_metrics is None:
+        return items
+    return iter_measured(run_metrics=run_metrics, name=name, items=items)
+
+
+def iter_measured(run_metrics: RunMetrics, name: str,
+                  items: Iterable) -> Iterator:
+    """Yield the items, timing each next() call as the stage."""
+    items = iter(items)
+    while True:
+        run_metrics.start_stage(name=name)
+        try:
+            item = next(items)
+        except StopIteration:
+            run_metrics.end_stage()
+            return
+        except BaseException:
+            run_metrics.end_stage()
+            raise
+        run_metrics.end_stage(items=1)
+        yield item
+
+
+def open_measured(run_metrics: Union[RunMetrics, None], file_path: str,
+                  mode: str = "w", encoding: str = None, name: str = "write"):
+    """
+    Open a file for writing, timing the writes as a stage, if run_metrics.
+
+    Only the writes from the file's buffer to the operating system are timed
+    (and counted as bytes), rather than each write call, which would take
+    about as long to time as the call itself. If run_metrics is None, this
+    is the same as open().
+    """
+    if run_metrics is None:
+        return open(file_path, mode=mode, encoding=encoding)
+    raw = MeasuredFileIO(file_path, mode=mode.replace("b", ""),
+                         run_metrics=run_metrics, name=name)
+    buffered = io.BufferedWriter(raw)
+    if "b" in mode:
+        return buffered
+    return io.TextIOWrapper(buffered, encoding=encoding)
+
+
+class MeasuredFileIO(io.FileIO):
+    """A raw file that times each write as a stage, counting the bytes."""
+
+    def __init__(self, file_path: str, mode: str, run_metrics: RunMetrics,
+                 name: str):
+        io.FileIO.__init__(self, file_path, mode=mode)
+        self.run_metrics = run_metrics
+        self.stage_name = name
+
+    def write(self, data) -> int:
+        self.run_metrics.start_stage(name=self.stage_name)
+        written = 0
+        try:
+            written = io.FileIO.write(self, data)
+        finally:
+            self.run_metrics.end_stage(items=written or 0)
+        return written
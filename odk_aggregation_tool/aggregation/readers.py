@@ -1,50 +1,247 @@
 import os
+import codecs
+import hashlib
+import re
+import tarfile
+import zipfile
 import xlrd
+from xml.parsers import expat
 from xlrd import XLRDError
 from xlrd.book import Book
 from xlrd.sheet import Sheet
 from collections import OrderedDict
-from typing import Iterable, List, Dict, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Dict, Tuple, Union
+from odk_aggregation_tool.aggregation import cache
 import logging
 import traceback
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+# Enough to hide the latency of a network share, without flooding it.
+IO_THREADS = 8
+XML_ENCODING = re.compile(
+    rb"^(?:\xef\xbb\xbf)?<\?xml[^>]*?encoding\s*=\s*[\"']([A-Za-z0-9._-]+)")
+UTF16_BOMS = (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+
+
+def find_files(root_dir: str, extension: Union[str, Tuple[str, ...]],
+               threads: int = 1) -> Iterable[str]:
+    """
+    Find paths of files found recursively in root_dir, sorted by name.
+
+    If threads is more than 1, directories are listed by a pool of that many
+    threads. All of a directory's subdirectories are queued to be listed as
+    soon as it has been listed, so that on a network share, the waits for
+    each listing overlap. The paths are found in the same order either way.
+    """
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            yield from find_files_in_pool(
+                executor=executor, root_dir=root_dir, extension=extension,
+                listing=executor.submit(list_dir, root_dir))
+    else:
+        for name, path, is_dir in list_dir(path=root_dir):
+            if is_dir:
+                yield from find_files(root_dir=path, extension=extension)
+            elif name.endswith(extension):
+                yield path
+
+
+def find_files_in_pool(executor: ThreadPoolExecutor, root_dir: str,
+                       extension: Union[str, Tuple[str, ...]],
+                       listing: Future) -> Iterable[str]:
+    """Find paths of files in root_dir, given a pending list_dir result."""
+    entries = listing.result()
+    sub_listings = {path: executor.submit(list_dir, path)
+                    for name, path, is_dir in entries if is_dir}
+    for name, path, is_dir in entries:
+        if is_dir:
+            yield from find_files_in_pool(
+                executor=executor, root_dir=path, extension=extension,
+                listing=sub_listings.pop(path))
+        elif name.endswith(extension):
+            yield path
+
+
+def list_dir(path: str) -> List[Tuple[str, str, bool]]:
+    """Return the name, path and whether it's a directory, for each entry."""
+    return [(x.name, x.path, x.is_dir())
+            for x in sorted(os.scandir(path), key=lambda x: x.name)]
+
+
+def find_instance_files(path: str, threads: int = 1) -> Iterable[str]:
+    """
+    Find paths of instance XML files and archives of them, in path.
+
+    The path can also be an XML file or an archive itself.
+    """
+    if os.path.isfile(path):
+        yield path
+    else:
+        yield from find_files(
+            root_dir=path, extension=(".xml",) + ARCHIVE_EXTENSIONS,
+            threads=threads)
+
+
+def is_archive(file_path: str) -> bool:
+    """Is the file a zip or tar archive, going by the file name?"""
+    return file_path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_instances_path(path: str) -> bool:
+    """Is the path an existing directory, or an existing archive file?"""
+    return os.path.isdir(path) or \
+        (os.path.isfile(path) and is_archive(file_path=path))
+
+
+def read_archive_xml_files(archive_path: str) -> Iterator[Tuple[str, str]]:
+    """
+    Read the text of each XML file in a zip or tar archive, one at a time.
+
+    See read_archive_xml_data, which this decodes the data from, using the
+    encoding each file declares (see decode_xml).
+    """
+    for data, file_path in read_archive_xml_data(archive_path=archive_path):
+        yield decode_xml(data=data), file_path
+
+
+def read_archive_xml_data(archive_path: str) -> Iterator[Tuple[bytes, str]]:
+    """
+    Read the data of each XML file in a zip or tar archive, one at a time.
+
+    The files are not extracted, they are read straight from the archive.
+    Each file's path is the archive path joined with the file's path in the
+    archive. Zip archives are read in the same order that find_files finds
+    the files once extracted (by name, within each folder), but tar archives
+    are read in the order they are stored, so that the archive is read
+    through only once (rather than once per file, for compressed archives).
+
+    Newlines are translated the same way as for read_xml_data, so that a
+    file has the same content digest whether it's in an archive or not.
+    """
+    def member_path(name):
+        return os.path.normpath(os.path.join(archive_path, name))
+
+    if archive_path.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive_path) as archive:
+            # By each part of the path, the same order as find_files.
+            members = sorted(archive.infolist(),
+                             key=lambda x: x.filename.split("/"))
+            for member in members:
+                if member.filename.endswith(".xml"):
+                    data = translate_newlines(data=archive.read(member))
+                    yield data, member_path(member.filename)
+    else:
+        with tarfile.open(archive_path, mode="r|*") as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith(".xml"):
+                    data = translate_newlines(
+                        data=archive.extractfile(member).read())
+                    yield data, member_path(member.name)
+
+
+def read_xml_file(file_path: str) -> str:
+    """Read the text of an instance XML file."""
+    with open(file_path, mode='r', encoding="UTF-8") as f:
+        return f.read()
+
+
+def read_xml_data(file_path: str) -> bytes:
+    """
+    Read the data of an instance XML file, without decoding it.
+
+    Newlines are translated the same way as by read_xml_file (which reads in
+    text mode), so that the content digest is the same either way.
+    """
+    with open(file_path, mode='rb') as f:
+        return translate_newlines(data=f.read())
+
+
+def translate_newlines(data: bytes) -> bytes:
+    """
+    Translate CRLF and CR newlines to LF, the same as reading in text mode.
+
+    The data is only copied to do so if it has a carriage return. UTF-16
+    data is left as is.
+    """
+    if b"\r" in data and not data.startswith(UTF16_BOMS):
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    return data
+
+
+def xml_encoding(data: bytes) -> str:
+    """Return the encoding of XML data, from a BOM or its declaration."""
+    if data.startswith(UTF16_BOMS):
+        return "UTF-16"
+    match = XML_ENCODING.match(data)
+    if match is None:
+        return "UTF-8"
+    return match.group(1).decode("ASCII")
+
+
+def decode_xml(data: bytes) -> str:
+    """Return the text of XML data, decoded using its encoding."""
+    return data.decode(xml_encoding(data=data))
+
+
+def content_digest(data: Union[str, bytes]) -> str:
+    """Return a fixed size digest of the data (UTF-8 encoded, if text)."""
+    if isinstance(data, str):
+        data = data.encode("UTF-8")
+    return hashlib.sha1(data).hexdigest()
 
 
 def read_xml_files(root_dir: str) -> Iterable[Tuple[str, str]]:
-    """Read instance XML files found recursively in root_dir."""
-    for entry in os.scandir(path=root_dir):
-        if entry.is_dir():
-            yield from read_xml_files(root_dir=entry.path)
-        elif entry.name.endswith(".xml"):
-            with open(entry.path, mode='r', encoding="UTF-8") as f:
-                xml_file = f.read()
-            yield xml_file, entry.path
-
-
-def read_xlsform_definitions(root_dir: str) -> Iterable[OrderedDict]:
-    """Read XLSX files found recursively in root_dir"""
+    """Read instance XML files found recursively in root_dir, or archives."""
+    for file_path in find_instance_files(path=root_dir):
+        if is_archive(file_path=file_path):
+            yield from read_archive_xml_files(archive_path=file_path)
+        else:
+            yield read_xml_file(file_path=file_path), file_path
+
+
+def read_xlsform_definitions(root_dir: str, cache_path: str = None
+                             ) -> Iterable[OrderedDict]:
+    """
+    Read XLSX files found recursively in root_dir.
+
+    If a cache_path is given, the definitions are kept in a cache file there,
+    so that later runs only need to read XLSX files that are new or have
+    changed. Files that couldn't be read as an XLSForm are not cached.
+    """
+    file_paths = find_files(
+        root_dir=root_dir, extension=".xlsx", threads=IO_THREADS)
+    if cache_path is None:
+        form_defs = map(read_xlsform_file, file_paths)
+    else:
+        form_defs = cache.read_through(
+            func=read_xlsform_file, file_paths=file_paths,
+            cache_path=cache_path, table="xlsforms")
+    for form_def in form_defs:
+        if form_def is not None:
+            yield form_def
+
+
+def read_xlsform_file(file_path: str) -> Union[OrderedDict, None]:
+    """Read an XLSForm definition from an XLSX file, or None if it's not."""
     error_text = "Encountered an error while trying to read the XLSX file " \
                  "at the following path, and did not read from it: {0}.\n" \
                  "Error message was: {1}\n"
-    for entry in os.scandir(path=root_dir):
-        if entry.is_dir():
-            yield from read_xlsform_definitions(root_dir=entry.path)
-        elif entry.name.endswith(".xlsx"):
-            try:
-                workbook = xlrd.open_workbook(filename=entry.path)
-                form_def = read_xlsform_data(workbook=workbook)
-            except XLRDError as xle:
-                logger.info(error_text.format(entry.path, "{0}\n\n{1}".format(
-                    str(xle), ''.join(traceback.format_exc()))))
-                continue
-            except ValueError as ve:
-                logger.info(error_text.format(entry.path, "{0}\n\n{1}".format(
-                    str(ve), ''.join(traceback.format_exc()))))
-                continue
-            else:
-                yield form_def
+    try:
+        workbook = xlrd.open_workbook(filename=file_path)
+        form_def = read_xlsform_data(workbook=workbook)
+    except XLRDError as xle:
+        logger.info(error_text.format(file_path, "{0}\n\n{1}".format(
+            str(xle), ''.join(traceback.format_exc()))))
+        return None
+    except ValueError as ve:
+        logger.info(error_text.format(file_path, "{0}\n\n{1}".format(
+            str(ve), ''.join(traceback.format_exc()))))
+        return None
+    else:
+        return form_def
 
 
 def read_xlsform_data(workbook: Book) -> OrderedDict:
@@ -61,27 +258,27 @@ def read_xlsform_data(workbook: Book) -> OrderedDict:
             workbook.sheet_by_name(sheet_name='choices'))
     settings = xlrd_sheet_to_list_of_dict(
         workbook.sheet_by_name(sheet_name='settings'))
+    choices_by_list_name = dict()
+    for choice in choices:
+        choices_by_list_name.setdefault(choice['list_name'], []).append(choice)
     form_def = OrderedDict()
     form_def['@settings'] = settings[0]
     for item in survey:
         if item['type'].startswith('select'):
             select_type, choice_name = item['type'].split(' ')
-            choice_list = [x for x in choices
-                           if x['list_name'] == choice_name]
-            item['choices'] = choice_list
+            # Select items using the same list share the same choice list.
+            item['choices'] = choices_by_list_name.get(choice_name, [])
         form_def[item['name']] = item
     return form_def
 
 
 def xlrd_sheet_to_list_of_dict(sheet: Sheet) -> List[Dict]:
     """Convert an xlrd sheet into a list of dicts."""
-    keys = [sheet.cell(0, col_index).value for col_index in range(sheet.ncols)]
-    dict_list = []
-    for row_index in range(1, sheet.nrows):
-        d = {keys[col_index]: sheet.cell(row_index, col_index).value
-             for col_index in range(sheet.ncols)}
-        dict_list.append(d)
-    return dict_list
+    if sheet.nrows == 0:
+        return []
+    keys = sheet.row_values(0)
+    return [dict(zip(keys, sheet.row_values(row_index)))
+            for row_index in range(1, sheet.nrows)]
 
 
 def flatten_dict_leaf_nodes(dict_in: OrderedDict,
@@ -101,3 +298,64 @@ def flatten_dict_leaf_nodes(dict_in: OrderedDict,
         else:
             dict_out[k] = v
     return dict_out
+
+
+def flatten_xml(xml_data: Union[str, bytes]) -> OrderedDict:
+    """
+    Parse XML into a single-level dict with the leaf node key/values.
+
+    The XML can be text, or data as read from the file. Data is given to
+    expat as is, which decodes it using the encoding in the XML declaration
+    (or UTF-8), so there's no need to decode it first.
+
+    The result is the same as flatten_dict_leaf_nodes(xmltodict.parse(...)),
+    but the XML is read in one pass with expat, without building the nested
+    dicts first. So, keys are element names, or "@" and the attribute name.
+    Elements with text (stripped of whitespace, or None if empty) give their
+    text, and otherwise their attributes then their children's key/values,
+    with repeated children grouped at the first one's position. If a key is
+    repeated, the last value is kept, at the first key's position.
+
+    Repeated elements with text are handled the same as other elements,
+    whereas flatten_dict_leaf_nodes would raise an error for them.
+    """
+    # Open elements, each as: name, attributes, text parts, children's pairs.
+    stack = []
+    root_pairs = []
+
+    def start_element(name, attributes):
+        stack.append((name, attributes, [], OrderedDict()))
+
+    def end_element(_):
+        name, attributes, text_parts, children = stack.pop()
+        text = "".join(text_parts).strip() or None
+        if text is not None or (len(attributes) == 0 and len(children) == 0):
+            pairs = [(name, text)]
+        else:
+            pairs = [("@" + attributes[i], attributes[i + 1])
+                     for i in range(0, len(attributes), 2)]
+            for child_pairs in children.values():
+                pairs.extend(child_pairs)
+        if len(stack) == 0:
+            root_pairs.extend(pairs)
+        else:
+            siblings = stack[-1][3]
+            if name in siblings:
+                siblings[name].extend(pairs)
+            else:
+                siblings[name] = pairs
+
+    def character_data(data):
+        stack[-1][2].append(data)
+
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    # Don't expand entities, same as xmltodict.
+    parser.DefaultHandler = lambda x: None
+    parser.ExternalEntityRefHandler = lambda *x: 1
+    parser.Parse(xml_data, True)
+    return OrderedDict(root_pairs)
@@ -0,0 +1,90 @@
+from typing import Dict, Iterable, Tuple
+from collections import OrderedDict, namedtuple
+from odk_aggregation_tool.aggregation import columns
+
+
+int_range = namedtuple('IntRange', ['stata_type', 'min_value', 'max_value'])
+# Smallest first. Values outside these ranges are reserved for missing values.
+int_ranges = [
+    int_range('byte',   -127,          100),
+    int_range('int',    -32767,        32740),
+    int_range('long',   -2147483647,   2147483620),
+]
+MAX_STR_LEN = 2045
+
+
+def infer_stata_types(xform_data: Iterable[OrderedDict],
+                      stata_types: Dict[str, str],
+                      allow_strl: bool = False) -> Dict[str, str]:
+    """
+    Return the smallest Stata storage type that holds each variable's data.
+
+    The stata_types are the types that would otherwise be used for each
+    variable, which decides whether it is stored as a number or a string.
+    Numeric variables get the smallest integer type that holds all of their
+    values, or double if any value is not a whole number. Values which are
+    not numbers are ignored. String variables get a strN type for the longest
+    value (in UTF-8 bytes), up to str2045. Longer values need a strL, so if
+    allow_strl is False, these variables are left as str2045.
+
+    The data is read a column at a time, so if it isn't already ColumnarData
+    it is converted first (in a single pass, so it needn't be a list).
+    """
+    xform_data = columns.as_columnar(xform_data=xform_data)
+    inferred = dict()
+    for k, stata_type in stata_types.items():
+        values = [x for x in xform_data.column(name=k) if x is not None]
+        if stata_type.startswith('str'):
+            inferred[k] = smallest_string_type(
+                values=values, allow_strl=allow_strl)
+        else:
+            inferred[k] = smallest_numeric_type(
+                *numeric_range(values=values))
+    return inferred
+
+
+def smallest_string_type(values: Iterable[str], allow_strl: bool) -> str:
+    """Return the smallest Stata string type that holds the values."""
+    # Stata has no str0, so empty strings still need str1.
+    length = max(1, max((len(x.encode("UTF-8")) for x in values), default=1))
+    if length <= MAX_STR_LEN:
+        return 'str{0}'.format(length)
+    elif allow_strl:
+        return 'strL'
+    else:
+        return 'str{0}'.format(MAX_STR_LEN)
+
+
+def numeric_range(values: Iterable[str]) -> Tuple[float, float, bool]:
+    """Return the min and max of the numbers, and if they are all integers."""
+    min_value, max_value, is_integer = None, None, True
+    for value in values:
+        try:
+            number = int(value)
+        except ValueError:
+            try:
+                number = float(value)
+            except ValueError:
+                continue
+            if number.is_integer():
+                number = int(number)
+            else:
+                is_integer = False
+        if min_value is None or number < min_value:
+            min_value = number
+        if max_value is None or number > max_value:
+            max_value = number
+    return min_value, max_value, is_integer
+
+
+def smallest_numeric_type(min_value: float, max_value: float,
+                          is_integer: bool) -> str:
+    """Return the smallest Stata numeric type that holds the value range."""
+    if min_value is None:
+        return int_ranges[0].stata_type
+    if is_integer:
+        for x in int_ranges:
+            if x.min_value <= min_value and max_value <= x.max_value:
+                return x.stata_type
+    return 'double'
+
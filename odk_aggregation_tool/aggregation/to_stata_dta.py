@@ -0,0 +1,320 @@
+from typing import List, Dict, Tuple, Callable, Union
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from odk_aggregation_tool.aggregation import to_stata_xml, stata_types, \
+    columns, metrics
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+ListODict = List[OrderedDict]
+
+
+# Field sizes and encodings that differ between the supported .dta formats.
+# Ref: http://www.stata.com/help.cgi?dta
+dta_release = namedtuple('DTARelease', [
+    'release', 'encoding', 'nobs_fmt', 'data_label_fmt', 'varname_len',
+    'format_len', 'lblname_len', 'varlabel_len', 'gso_obs_fmt'])
+dta_releases = {
+    117: dta_release(117, 'latin-1', 'I', 'B', 33, 49, 33, 81, 'I'),
+    118: dta_release(118, 'UTF-8', 'Q', 'H', 129, 57, 129, 321, 'Q'),
+}
+
+# Storage type codes, struct formats, and (where relevant) missing values
+# and the range of non-missing values.
+numeric_type = namedtuple('NumericType', [
+    'code', 'struct_fmt', 'missing', 'min_value', 'max_value'])
+int_ranges = {x.stata_type: x for x in stata_types.int_ranges}
+numeric_types = {
+    'byte': numeric_type(65530, 'b', 101, *int_ranges['byte'][1:]),
+    'int': numeric_type(65529, 'h', 32741, *int_ranges['int'][1:]),
+    'long': numeric_type(65528, 'l', 2147483621, *int_ranges['long'][1:]),
+    'float': numeric_type(65527, 'f', struct.unpack('<f', struct.pack(
+        '<I', 0x7f000000))[0], None, None),
+    'double': numeric_type(65526, 'd', struct.unpack('<d', struct.pack(
+        '<Q', 0x7fe0000000000000))[0], None, None),
+}
+STRL_CODE = 32768
+DATA_LABEL = 'ODK data from Python'
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+MAP_SECTIONS = [
+    'stata_dta', 'map', 'variable_types', 'varnames', 'sortlist', 'formats',
+    'value_label_names', 'variable_labels', 'characteristics', 'data',
+    'strls', 'value_labels', '/stata_dta', 'eof']
+
+
+def write_stata_dta(form_id: str, form_def: OrderedDict,
+                    xform_data: ListODict, output_path: str,
+                    release: int = 118,
+                    run_metrics: metrics.RunMetrics = None) -> str:
+    """
+    Write a Stata binary (.dta) file out, named for the form_id, return path.
+
+    The variable metadata is the same as for the Stata XML output, from
+    to_stata_xml.prepare_xlsform_metadata, except that strings too long for
+    a str2045 are stored as a strL. Observations are written to the file
+    one at a time as fixed width rows. If run_metrics is given, writing to
+    the file is measured as the "write" stage.
+    """
+    spec = dta_releases[release]
+    stata_metadata = to_stata_xml.prepare_xlsform_metadata(
+        form_id=form_id, form_def=form_def, xform_data=xform_data,
+        allow_strl=True)
+    variables = prepare_dta_variables(stata_metadata=stata_metadata)
+    logger.info("Collected data for {0} observations for form_id: {1}".format(
+        len(xform_data), form_id))
+    write_path = os.path.join(output_path, '{0}.dta'.format(form_id))
+    with metrics.open_measured(run_metrics, write_path,
+                               mode='wb') as out_doc:
+        write_dta(out_doc=out_doc, spec=spec, variables=variables,
+                  xform_data=xform_data,
+                  value_labels=stata_metadata["value_labels"])
+    logger.info("Wrote form data for form_id: {0}, to a file at: "
+                " {1}.".format(form_id, write_path))
+    return write_path
+
+
+def prepare_dta_variables(stata_metadata: Dict[str, ListODict]
+                          ) -> List[Dict[str, str]]:
+    """Return a dict of metadata per variable, from the Stata XML metadata."""
+    def by_varname(key):
+        return {x["@varname"]: x["#text"] for x in stata_metadata[key]}
+    types = by_varname("var_types")
+    formats = by_varname("var_formats")
+    labels = by_varname("var_labels")
+    lblnames = by_varname("var_vallabel_map")
+    variables = list()
+    for var in stata_metadata["var_names"]:
+        name = var["@varname"]
+        label = labels.get(name)
+        variables.append(dict(
+            name=name, type=types[name], format=formats[name],
+            label='' if label is None else str(label),
+            lblname=lblnames.get(name, '')))
+    return variables
+
+
+def write_dta(out_doc, spec: dta_release, variables: List[Dict[str, str]],
+              xform_data: ListODict, value_labels: ListODict) -> None:
+    """Write a .dta file to the (binary) out_doc, per the release spec."""
+    nvar = len(variables)
+    offsets = dict(stata_dta=0)
+    out_doc.write(b'<stata_dta><header>')
+    out_doc.write(tag('release', str(spec.release).encode('ascii')))
+    out_doc.write(tag('byteorder', b'LSF'))
+    out_doc.write(tag('K', struct.pack('<H', nvar)))
+    out_doc.write(tag('N', struct.pack('<' + spec.nobs_fmt, len(xform_data))))
+    data_label = encode_text(DATA_LABEL, spec.encoding, 80)
+    out_doc.write(tag('label', struct.pack(
+        '<' + spec.data_label_fmt, len(data_label)) + data_label))
+    time_stamp = stata_time_stamp(datetime.now()).encode('ascii')
+    out_doc.write(tag('timestamp', struct.pack(
+        '<B', len(time_stamp)) + time_stamp))
+    out_doc.write(b'</header>')
+
+    # Offsets aren't known until the sections are written, so write zeros
+    # in the map for now, and come back to fill them in at the end.
+    offsets['map'] = out_doc.tell()
+    out_doc.write(tag('map', bytes(8 * len(MAP_SECTIONS))))
+
+    def section(name, content):
+        offsets[name] = out_doc.tell()
+        out_doc.write(tag(name, content))
+
+    section('variable_types', b''.join(
+        struct.pack('<H', stata_type_code(x['type'])) for x in variables))
+    section('varnames', b''.join(
+        fixed_text(x['name'], spec.encoding, spec.varname_len)
+        for x in variables))
+    section('sortlist', bytes(2 * (nvar + 1)))
+    section('formats', b''.join(
+        fixed_text(x['format'], spec.encoding, spec.format_len)
+        for x in variables))
+    section('value_label_names', b''.join(
+        fixed_text(x['lblname'], spec.encoding, spec.lblname_len)
+        for x in variables))
+    section('variable_labels', b''.join(
+        fixed_text(x['label'], spec.encoding, spec.varlabel_len)
+        for x in variables))
+    section('characteristics', b'')
+
+    offsets['data'] = out_doc.tell()
+    out_doc.write(b'<data>')
+    strls = list()
+    row_struct, converters = prepare_row_format(
+        variables=variables, spec=spec, strls=strls)
+    rows = columns.as_columnar(xform_data=xform_data).iter_rows(
+        names=[x['name'] for x in variables])
+    for row in rows:
+        out_doc.write(row_struct.pack(*[
+            convert(value) for value, convert in zip(row, converters)]))
+    out_doc.write(b'</data>')
+
+    section('strls', b''.join(strls))
+    offsets['value_labels'] = out_doc.tell()
+    out_doc.write(b'<value_labels>')
+    for value_label_set in value_labels:
+        out_doc.write(value_label_table(
+            value_label_set=value_label_set, spec=spec))
+    out_doc.write(b'</value_labels>')
+    offsets['/stata_dta'] = out_doc.tell()
+    out_doc.write(b'</stata_dta>')
+    offsets['eof'] = out_doc.tell()
+
+    out_doc.seek(offsets['map'] + len(b'<map>'))
+    out_doc.write(b''.join(
+        struct.pack('<Q', offsets[x]) for x in MAP_SECTIONS))
+    out_doc.seek(offsets['eof'])
+
+
+def tag(name: str, content: bytes) -> bytes:
+    """Wrap the content in a .dta section tag."""
+    return b''.join([
+        '<{0}>'.format(name).encode('ascii'), content,
+        '</{0}>'.format(name).encode('ascii')])
+
+
+def stata_time_stamp(when: datetime) -> str:
+    """Return a .dta time stamp, which must use English month names."""
+    return '{0:02d} {1} {2:04d} {3:02d}:{4:02d}'.format(
+        when.day, MONTHS[when.month - 1], when.year, when.hour, when.minute)
+
+
+def stata_type_code(stata_type: str) -> int:
+    """Return the .dta storage type code for a Stata type name."""
+    if stata_type == 'strL':
+        return STRL_CODE
+    elif stata_type.startswith('str'):
+        return int(stata_type[3:])
+    return numeric_types[stata_type].code
+
+
+def encode_text(text: str, encoding: str, max_bytes: int) -> bytes:
+    """Encode text, truncated (at a whole character) to max_bytes."""
+    encoded = text.encode(encoding, errors='replace')
+    if len(encoded) > max_bytes:
+        encoded = encoded[:max_bytes].decode(
+            encoding, errors='ignore').encode(encoding)
+    return encoded
+
+
+def fixed_text(text: str, encoding: str, length: int) -> bytes:
+    """Encode text in a null-terminated and null-padded fixed length field."""
+    return encode_text(text, encoding, length - 1).ljust(length, b'\0')
+
+
+def prepare_row_format(variables: List[Dict[str, str]], spec: dta_release,
+                       strls: List[bytes]) -> Tuple[struct.Struct,
+                                                    List[Callable]]:
+    """
+    Return a struct for packing rows, and a value converter per column.
+
+    Converters for strL columns add the values to strls (as GSO records), and
+    return a reference to it for the row.
+    """
+    row_fmt = ['<']
+    converters = list()
+    for var_number, var in enumerate(variables, start=1):
+        if var['type'] == 'strL':
+            row_fmt.append('8s')
+            converters.append(strl_converter(
+                var_number=var_number, spec=spec, strls=strls))
+        elif var['type'].startswith('str'):
+            length = int(var['type'][3:])
+            row_fmt.append('{0}s'.format(length))
+            converters.append(string_converter(
+                var_name=var['name'], encoding=spec.encoding, length=length))
+        else:
+            numeric = numeric_types[var['type']]
+            row_fmt.append(numeric.struct_fmt)
+            converters.append(numeric_converter(
+                var_name=var['name'], numeric=numeric))
+    return struct.Struct(''.join(row_fmt)), converters
+
+
+def string_converter(var_name: str, encoding: str, length: int) -> Callable:
+    """Return a function converting values to bytes for a str column."""
+    def convert(value: Union[str, None]) -> bytes:
+        if value is None:
+            return b''
+        encoded = value.encode(encoding, errors='replace')
+        if len(encoded) > length:
+            logger.warning(
+                "Truncated a value for variable: {0}, to the maximum length "
+                "of {1} bytes.".format(var_name, length))
+            encoded = encode_text(value, encoding, length)
+        return encoded
+    return convert
+
+
+def strl_converter(var_number: int, spec: dta_release, strls: List[bytes]
+                   ) -> Callable:
+    """Return a function converting values to references for a strL column."""
+    obs_number = [0]
+
+    def convert(value: Union[str, None]) -> bytes:
+        obs_number[0] += 1
+        if value is None or len(value) == 0:
+            return bytes(8)
+        encoded = value.encode(spec.encoding, errors='replace')
+        strls.append(b''.join([
+            b'GSO', struct.pack('<I', var_number),
+            struct.pack('<' + spec.gso_obs_fmt, obs_number[0]),
+            struct.pack('<BI', 130, len(encoded) + 1), encoded, b'\0']))
+        if spec.release == 117:
+            return struct.pack('<II', var_number, obs_number[0])
+        return struct.pack('<Q', var_number + (obs_number[0] << 16))
+    return convert
+
+
+def numeric_converter(var_name: str, numeric: numeric_type) -> Callable:
+    """Return a function converting values to numbers for a numeric column."""
+    is_integer = numeric.min_value is not None
+
+    def convert(value: Union[str, None]) -> Union[int, float]:
+        if value is None:
+            return numeric.missing
+        try:
+            number = float(value)
+            if is_integer:
+                if not number.is_integer():
+                    raise ValueError(value)
+                number = int(number)
+                if not numeric.min_value <= number <= numeric.max_value:
+                    raise ValueError(value)
+        except ValueError:
+            logger.warning(
+                "Could not store a value for variable: {0}, as a Stata "
+                "numeric value of that type, so it was set to missing. "
+                "Value: {1}".format(var_name, value))
+            return numeric.missing
+        return number
+    return convert
+
+
+def value_label_table(value_label_set: OrderedDict, spec: dta_release
+                      ) -> bytes:
+    """Return a .dta value label table (lbl) for a Stata XML vallab."""
+    labels = sorted(
+        ((int(x['@value']), encode_text(
+            '' if x['#text'] is None else str(x['#text']),
+            spec.encoding, 32000))
+         for x in value_label_set['label']), key=lambda x: x[0])
+    offsets = list()
+    text = bytearray()
+    for value, label in labels:
+        offsets.append(len(text))
+        text.extend(label + b'\0')
+    n = len(labels)
+    table = b''.join([
+        struct.pack('<ll', n, len(text)),
+        struct.pack('<{0}l'.format(n), *offsets),
+        struct.pack('<{0}l'.format(n), *[x[0] for x in labels]),
+        bytes(text)])
+    return tag('lbl', b''.join([
+        struct.pack('<l', len(table)),
+        fixed_text(value_label_set['@name'], spec.encoding, spec.lblname_len),
+        bytes(3), table]))
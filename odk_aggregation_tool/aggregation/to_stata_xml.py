@@ -1,24 +1,34 @@
-from typing import List, Union, Dict, Tuple
-from collections import OrderedDict, namedtuple, Counter
+from typing import List, Union, Dict, Tuple, Callable, Iterable, Iterator
+from collections import OrderedDict, namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, lru_cache
+from itertools import islice
 from datetime import datetime
-from odk_aggregation_tool.aggregation import readers
+from odk_aggregation_tool.aggregation import readers, cache, stata_types, \
+    columns, metrics
 import xmltodict
 from copy import copy
 import logging
 import os
 import re
+import threading
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
+# Running counts, for showing progress while a task runs. Not a summary.
+progress_logger = logging.getLogger(__name__ + ".progress")
+progress_logger.addHandler(logging.NullHandler())
+PROGRESS_EVERY = 1000
 ListODict = List[OrderedDict]
 DictODict = Dict[str, OrderedDict]
 
 
 type_map = namedtuple('TypeMap', ['xlsform_type', 'stata_type', 'stata_fmt'])
-# TODO: consider inspecting data to get a more accurate type for str and int.
-# This would benefit the .dta file size, as well as remove the need for
-# current assumptions around select items being always coded with integers.
+# These are the widest types needed for each XLSForm type. If data is given
+# to prepare_xlsform_metadata, the types are narrowed to fit the data.
+# TODO: consider inspecting data to remove the need for current assumptions
+# around select items being always coded with integers.
 type_mappings = [
     type_map('start',        'str26',    '%26s'),
     type_map('end',          'str26',    '%26s'),
@@ -27,7 +37,28 @@ type_mappings = [
     type_map('text',         'str2045',  '%30s'),
     type_map('integer',      'int',      '%10.0g')
 ]
+text_type_mapping = next(x for x in type_mappings if x.xlsform_type == 'text')
 STATA_ZERO_DATE = datetime.strptime("1960-01-01", "%Y-%m-%d")
+INVALID_NAME_CHARS = re.compile("[^A-z0-9_]")
+
+
+class AggregationCancelled(Exception):
+    """The aggregation task was cancelled before it finished."""
+    pass
+
+
+def check_cancelled(cancel: threading.Event = None) -> None:
+    """Raise AggregationCancelled if the cancel event has been set."""
+    if cancel is not None and cancel.is_set():
+        raise AggregationCancelled("The aggregation task was cancelled.")
+
+
+def iter_until_cancelled(items: Iterable,
+                         cancel: threading.Event = None) -> Iterator:
+    """Yield the items, checking before each one if the task is cancelled."""
+    for item in items:
+        check_cancelled(cancel=cancel)
+        yield item
 
 
 def variable_type(var_name: str, stata_type: str) -> OrderedDict:
@@ -144,42 +175,186 @@ def compose_xml(var_types: ListODict, var_names: ListODict,
     ])
 
 
-def to_stata_xml(xlsform_path: str, instances_path: str) -> Dict[str, str]:
+def to_stata_xml(xlsform_path: str, instances_path: str, workers: int = 1,
+                 chunk_size: int = 1000, cache_path: str = None
+                 ) -> Dict[str, str]:
     """Return Stata XML documents for all discovered XLSForms and XML data."""
-    form_defs = collate_xlsforms_by_form_id(xlsform_path=xlsform_path)
-    raw_data = collate_xform_instances(instances_path=instances_path)
-    instances = remove_duplicate_instances(instances=raw_data)
-
-    stata_docs = dict()
-    for form_id, form_def in form_defs.items():
-        xform_instances = [x for x in instances if x["@id"] == form_id]
+    return OrderedDict(iter_stata_docs(
+        xlsform_path=xlsform_path, instances_path=instances_path,
+        workers=workers, chunk_size=chunk_size, cache_path=cache_path))
+
+
+def iter_stata_docs(xlsform_path: str, instances_path: str, workers: int = 1,
+                    chunk_size: int = 1000, cache_path: str = None
+                    ) -> Iterator[Tuple[str, str]]:
+    """Yield a Stata XML document for each discovered XLSForm, with XML data."""
+    forms = iter_form_data(
+        xlsform_path=xlsform_path, instances_path=instances_path,
+        workers=workers, chunk_size=chunk_size, cache_path=cache_path)
+    for form_id, form_def, xform_data in forms:
+        stata_doc = prepare_stata_doc(
+            form_id=form_id, form_def=form_def, xform_data=xform_data)
+        del xform_data
+        yield form_id, xmltodict.unparse(stata_doc)
+
+
+def iter_form_data(xlsform_path: str, instances_path: str, workers: int = 1,
+                   chunk_size: int = 1000, cache_path: str = None,
+                   cancel: threading.Event = None,
+                   io_threads: int = readers.IO_THREADS
+                   ) -> Iterator[Tuple[str, OrderedDict, columns.ColumnarData]]:
+    """
+    Yield the form_id, form definition and prepared XForm data for each form.
+
+    Instances are streamed from the files into a temporary file, and each
+    form_id's instances are loaded and released once its data is prepared,
+    so only one form's instance data is held at a time (see
+    iter_form_instances).
+
+    If a cancel event is given, it is checked between each step (including
+    between instance files), and AggregationCancelled is raised once it is
+    set. Forms already yielded are unaffected.
+    """
+    forms = iter_form_instances(
+        xlsform_path=xlsform_path, instances_path=instances_path,
+        workers=workers, chunk_size=chunk_size, cache_path=cache_path,
+        cancel=cancel, io_threads=io_threads)
+    for form_id, form_def, xform_instances in forms:
+        form_data = prepare_form_data(
+            form_id=form_id, form_def=form_def,
+            xform_instances=xform_instances)
+        del xform_instances
+        yield form_data
+
+
+def iter_form_instances(xlsform_path: str, instances_path: str,
+                        workers: int = 1, chunk_size: int = 1000,
+                        cache_path: str = None, cancel: threading.Event = None,
+                        io_threads: int = readers.IO_THREADS,
+                        run_metrics: metrics.RunMetrics = None
+                        ) -> Iterator[Tuple[str, OrderedDict, ListODict]]:
+    """
+    Yield the form_id, form definition and XForm instances for each form.
+
+    All the instance files are read before the first form is yielded. As
+    they are read, the instances are written to a temporary file on disk
+    (see cache.Spool), grouped by form_id, and each form's instances are
+    loaded back from it only when that form is yielded. So, only one form's
+    instances are held in memory at a time, rather than all of them. The
+    index of content digests used to skip duplicates is still kept in
+    memory. The temporary file is removed once all the forms are yielded,
+    or if this generator is closed before then.
+
+    The cancel event is checked the same way as for iter_form_data. If
+    run_metrics is given, the stages up to partitioning the instances by
+    form are measured (see metrics.RunMetrics).
+    """
+    with metrics.measure_stage(run_metrics, "xlsforms") as stage:
+        form_defs = collate_xlsforms_by_form_id(
+            xlsform_path=xlsform_path, cache_path=cache_path)
+        stage["items"] += len(form_defs)
+    check_cancelled(cancel=cancel)
+    instances = iter_unique_instances(instances=iter_until_cancelled(
+        items=iter_xform_instances(
+            instances_path=instances_path, workers=workers,
+            chunk_size=chunk_size, cache_path=cache_path,
+            io_threads=io_threads, run_metrics=run_metrics),
+        cancel=cancel))
+    with cache.Spool() as spool:
+        with metrics.measure_stage(run_metrics, "partition") as stage:
+            instances = metrics.measure_iter(run_metrics, "dedupe", instances)
+            spool.extend(
+                items=(x for x in instances if x["@id"] in form_defs),
+                key=lambda x: x["@id"])
+            stage["items"] += sum(spool.counts.values())
+
+        for form_id, form_def in form_defs.items():
+            check_cancelled(cancel=cancel)
+            yield form_id, form_def, spool.get(key=form_id)
+
+
+def prepare_form_data(form_id: str, form_def: OrderedDict,
+                      xform_instances: ListODict,
+                      run_metrics: metrics.RunMetrics = None
+                      ) -> Tuple[str, OrderedDict, columns.ColumnarData]:
+    """
+    Return the form_id, tidied form definition and prepared XForm data.
+
+    If run_metrics is given, this is measured as the "prepare" stage.
+    """
+    with metrics.measure_stage(run_metrics, "prepare") as stage:
         logger.info("Collecting data for form_id: {0}".format(form_id))
         xform_data, unknown_vars = prepare_xform_data(
             xform_instances=xform_instances, form_def=form_def)
         form_def = tidy_form_def(
             form_id=form_id, form_def=form_def, unknown_vars=unknown_vars)
+        stage["items"] += len(xform_data)
+    return form_id, form_def, xform_data
+
+
+def prepare_stata_doc(form_id: str, form_def: OrderedDict,
+                      xform_data: ListODict, stream: bool = False
+                      ) -> OrderedDict:
+    """
+    Return a Stata XML document structure for the form's XForm data.
+
+    If stream is True, the observations in the document are a generator, so
+    that they are prepared one at a time while the document is unparsed.
+    """
+    if stream:
+        observations = iter_observations(
+            xform_data=xform_data, form_def=form_def)
+    else:
         observations = prepare_observations(
             xform_data=xform_data, form_def=form_def)
-        stata_metadata = prepare_xlsform_metadata(
-            form_id=form_id, form_def=form_def)
-        nvar = str(len([x["@varname"] for x in stata_metadata["var_names"]]))
-        nobs = str(len(observations))
-        logger.info("Collected data for {0} "
-                    "observations for form_id: {1}".format(nobs, form_id))
-        stata_doc = compose_xml(
-            observations=observations, nvar=nvar, nobs=nobs, **stata_metadata)
-        stata_docs[form_id] = xmltodict.unparse(stata_doc)
-
-    return stata_docs
+    stata_metadata = prepare_xlsform_metadata(
+        form_id=form_id, form_def=form_def, xform_data=xform_data)
+    nvar = str(len([x["@varname"] for x in stata_metadata["var_names"]]))
+    nobs = str(len(xform_data))
+    logger.info("Collected data for {0} "
+                "observations for form_id: {1}".format(nobs, form_id))
+    return compose_xml(
+        observations=observations, nvar=nvar, nobs=nobs, **stata_metadata)
+
+
+def partition_instances(instances: Iterable[OrderedDict],
+                        form_ids: Iterable[str]) -> Dict[str, ListODict]:
+    """Return a list of instances per form_id, dropping other form_ids."""
+    return partition(
+        items=instances, key=lambda x: x["@id"], keys=form_ids)
+
+
+def partition(items: Iterable, key: Callable, keys: Iterable = None
+              ) -> Dict[str, List]:
+    """
+    Return a list of items per key(item), in one pass over the items.
+
+    If keys are given, the result has a (possibly empty) list for each of
+    them in the same order, and items with other keys are dropped.
+    Otherwise, the result has a list for each key in the order found.
+    """
+    if keys is None:
+        buckets = OrderedDict()
+        for item in items:
+            buckets.setdefault(key(item), list()).append(item)
+    else:
+        buckets = OrderedDict((x, list()) for x in keys)
+        for item in items:
+            bucket = buckets.get(key(item))
+            if bucket is not None:
+                bucket.append(item)
+    return buckets
 
 
-def collate_xlsforms_by_form_id(xlsform_path: str) -> DictODict:
+def collate_xlsforms_by_form_id(xlsform_path: str, cache_path: str = None
+                                ) -> DictODict:
     """Return discovered form def metadata, from last of sorted versions."""
     logger.info("Looking for XLSForms to read.")
-    read_xlsforms = list(
-        readers.read_xlsform_definitions(root_dir=xlsform_path))
-    unique_form_ids = sorted(
-        set(x["@settings"]["form_id"] for x in read_xlsforms))
+    read_xlsforms = partition(
+        items=readers.read_xlsform_definitions(
+            root_dir=xlsform_path, cache_path=cache_path),
+        key=lambda x: x["@settings"]["form_id"])
+    unique_form_ids = sorted(read_xlsforms)
     if len(unique_form_ids) == 0:
         logger.warning("No XLSForms were read from the specified path. "
                        "Please check it and try again.")
@@ -189,14 +364,13 @@ def collate_xlsforms_by_form_id(xlsform_path: str) -> DictODict:
 
     form_dict = OrderedDict()
     for form_id in unique_form_ids:
-        form_defs = [x for x in read_xlsforms
-                     if x["@settings"]["form_id"] == form_id]
-        versions = sorted(set(x["@settings"]["version"] for x in form_defs),
-                          reverse=True)
+        form_defs = partition(
+            items=read_xlsforms[form_id],
+            key=lambda x: x["@settings"]["version"])
+        versions = sorted(form_defs, reverse=True)
         logger.info("Reading XLSForms for form_id: {0}, sorted by version "
                     "in order of: {1}".format(form_id, versions))
-        sorted_form_defs = sorted(
-            form_defs, key=lambda x: x["@settings"]["version"], reverse=True)
+        sorted_form_defs = (x for v in versions for x in form_defs[v])
         master_form_def = OrderedDict()
 
         for xlsform in sorted_form_defs:
@@ -210,8 +384,18 @@ def collate_xlsforms_by_form_id(xlsform_path: str) -> DictODict:
     return form_dict
 
 
-def prepare_xlsform_metadata(form_id: str, form_def: OrderedDict) -> DictODict:
-    """Return Stata metadata for the default language for each form item."""
+def prepare_xlsform_metadata(form_id: str, form_def: OrderedDict,
+                             xform_data: ListODict = None,
+                             allow_strl: bool = False) -> DictODict:
+    """
+    Return Stata metadata for the default language for each form item.
+
+    If the xform_data is given, the variable types are the smallest types
+    that hold the data (see stata_types.infer_stata_types), rather than the
+    widest type for each XLSForm type. XLSForm types that aren't mapped to
+    a Stata type, including select items with non-integer choices, are
+    treated as text.
+    """
     metadata = dict(
         var_types=list(), var_names=list(), var_formats=list(),
         var_labels=list(), var_vallabel_map=list(), value_labels=list())
@@ -240,7 +424,8 @@ def prepare_xlsform_metadata(form_id: str, form_def: OrderedDict) -> DictODict:
                     choices_added.append(choices_name)
                 var_type = 'integer'
         type_mapping = next(
-            (x for x in type_mappings if x.xlsform_type == var_type), '')
+            (x for x in type_mappings if x.xlsform_type == var_type),
+            text_type_mapping)
         metadata["var_names"].append(variable_name(var_name=k))
         metadata["var_types"].append(variable_type(
             var_name=k, stata_type=type_mapping.stata_type))
@@ -250,6 +435,13 @@ def prepare_xlsform_metadata(form_id: str, form_def: OrderedDict) -> DictODict:
         metadata["var_labels"].append(variable_label(
             var_name=k, description=v.get(
                 'name_description', label_column_value)))
+    if xform_data is not None:
+        inferred = stata_types.infer_stata_types(
+            xform_data=xform_data, allow_strl=allow_strl,
+            stata_types=OrderedDict(
+                (x["@varname"], x["#text"]) for x in metadata["var_types"]))
+        for var_type in metadata["var_types"]:
+            var_type["#text"] = inferred[var_type["@varname"]]
     return metadata
 
 
@@ -262,62 +454,279 @@ def maybe_language_column(metadata_name: str,
     return '{0}{1}'.format(metadata_name, maybe_lang)
 
 
-def collate_xform_instances(instances_path: str) -> ListODict:
+def collate_xform_instances(instances_path: str, workers: int = 1,
+                            chunk_size: int = 1000,
+                            keep_source_xml: bool = False,
+                            cache_path: str = None,
+                            io_threads: int = readers.IO_THREADS
+                            ) -> ListODict:
     """Return collated (parsed and flattened) XForm data."""
-    read_instances = list(readers.read_xml_files(root_dir=instances_path))
-    parsed = []
-    for xml_data, file_path in read_instances:
-        parsed_data = xmltodict.parse(xml_input=xml_data)
-        parsed_data["_source_file"] = os.path.normpath(file_path)
-        parsed_data["_source_xml"] = xml_data
-        parsed.append(parsed_data)
-    flattened = list()
+    return list(iter_xform_instances(
+        instances_path=instances_path, workers=workers, chunk_size=chunk_size,
+        keep_source_xml=keep_source_xml, cache_path=cache_path,
+        io_threads=io_threads))
+
+
+def iter_xform_instances(instances_path: str, workers: int = 1,
+                         chunk_size: int = 1000,
+                         keep_source_xml: bool = False,
+                         cache_path: str = None,
+                         io_threads: int = readers.IO_THREADS,
+                         run_metrics: metrics.RunMetrics = None
+                         ) -> Iterator[OrderedDict]:
+    """
+    Yield parsed and flattened XForm data, one instance at a time.
+
+    If workers is more than 1, the files are read, parsed and flattened by a
+    pool of that many processes, which are sent chunk_size files at a time.
+    Otherwise, if io_threads is more than 1, they are read by a pool of that
+    many threads, up to chunk_size files ahead, so that waiting for one file
+    to be read overlaps with parsing others. Directories are also listed by
+    a pool of io_threads threads. Either way, the data is yielded in the
+    order the files were found.
+
+    Each instance includes a digest of the file content ("_source_digest"),
+    and if keep_source_xml is True, the file content too ("_source_xml").
+
+    If a cache_path is given, the data is kept in a cache file there, so that
+    later runs only need to read files that are new or have changed. The
+    cache is not used if keep_source_xml is True.
+
+    The instances_path can include zip or tar archives of XML files (or be
+    one), which are read without extracting them. Each XML file in an
+    archive is read out one at a time, then parsed the same way as other
+    files (by the workers, if any), and is cached separately.
+
+    If run_metrics is given, finding the files is measured as the
+    "discovery" stage, and getting each file's data as the "read" stage,
+    which covers reading, parsing and flattening the file (or waiting for
+    a worker to do so).
+    """
+    file_paths = metrics.measure_iter(
+        run_metrics, "discovery", readers.find_instance_files(
+            path=instances_path, threads=io_threads))
+    read_func = partial(read_xform_item, keep_source_xml=keep_source_xml)
+    map_func = partial(map_in_workers, workers=workers, chunk_size=chunk_size,
+                       io_threads=io_threads)
+    if cache_path is None or keep_source_xml:
+        read_instances = map_func(
+            read_func, iter_xform_items(file_paths=file_paths))
+    else:
+        read_instances = cache.read_through(
+            func=read_func, file_paths=file_paths, cache_path=cache_path,
+            table="instances", map_func=map_func, expand=expand_archive)
     remove_keys = list()
-    for instance in parsed:
-        flat = readers.flatten_dict_leaf_nodes(instance)
-        for k in flat.keys():
-            if k.startswith("@") and k not in ["@id", "@version"]:
-                if k not in remove_keys:
-                    remove_keys.append(k)
-        for k in remove_keys:
-            if k in flat.keys():
-                del flat[k]
-        flattened.append(flat)
+    read_count = 0
+    for flat, removed_keys in metrics.measure_iter(
+            run_metrics, "read", read_instances):
+        for k in removed_keys:
+            if k not in remove_keys:
+                remove_keys.append(k)
+        read_count += 1
+        if read_count % PROGRESS_EVERY == 0:
+            progress_logger.info(
+                "Read {0} instance files so far.".format(read_count))
+        yield flat
+    logger.info("Read {0} instance files.".format(read_count))
     if len(remove_keys) > 0:
         logger.info(
             "Removed XML attributes from parsed data, for the following "
             "keys that were neither '@id' (form id) or '@version' "
             "(form version):\n{0}".format(", ".join(remove_keys)))
-    return flattened
+
+
+def map_in_workers(func: Callable, iterable: Iterable, workers: int = 1,
+                   chunk_size: int = 1000, io_threads: int = 1) -> Iterator:
+    """
+    Yield func results for each item, in a process pool if workers > 1.
+
+    Otherwise if io_threads > 1, the items are run in a thread pool instead.
+    """
+    if workers > 1:
+        return map_in_process_pool(
+            func=func, iterable=iterable, workers=workers,
+            chunk_size=chunk_size)
+    elif io_threads > 1:
+        return map_in_thread_pool(
+            func=func, iterable=iterable, threads=io_threads,
+            read_ahead=chunk_size)
+    else:
+        return map(func, iterable)
+
+
+def map_in_thread_pool(func: Callable, iterable: Iterable, threads: int,
+                       read_ahead: int) -> Iterator:
+    """
+    Yield func results for each item in iterable, using a thread pool.
+
+    Up to read_ahead items are submitted ahead of the result being yielded,
+    which bounds the number of results held. Results are yielded in the
+    same order as the items in iterable.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= read_ahead:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+
+def iter_xform_items(file_paths: Iterable[str]
+                     ) -> Iterator[Union[str, Tuple[bytes, str]]]:
+    """
+    Yield each file path, or for an archive, the data and path of each XML
+    file in it, ready for read_xform_item.
+    """
+    for file_path in file_paths:
+        members = expand_archive(file_path=file_path)
+        if members is None:
+            yield file_path
+        else:
+            yield from (item for item, _ in members)
+
+
+def expand_archive(file_path: str
+                   ) -> Union[Iterator[Tuple[Tuple[bytes, str], str]], None]:
+    """
+    Return None if the file isn't an archive. Otherwise, yield the data and
+    path of each XML file in it (as an item for read_xform_item), with the
+    path (as a cache key).
+    """
+    if not readers.is_archive(file_path=file_path):
+        return None
+    return (((data, member_path), member_path)
+            for data, member_path in readers.read_archive_xml_data(
+                archive_path=file_path))
+
+
+def read_xform_item(item: Union[str, Tuple[bytes, str]],
+                    keep_source_xml: bool = False
+                    ) -> Tuple[OrderedDict, List[str]]:
+    """
+    Return flattened XForm data, and removed attribute keys, from a file
+    path, or from the data and path of an XML file read from an archive.
+    """
+    if isinstance(item, str):
+        return read_xform_instance(
+            file_path=item, keep_source_xml=keep_source_xml)
+    xml_data, file_path = item
+    return parse_xform_instance(
+        xml_data=xml_data, file_path=file_path,
+        keep_source_xml=keep_source_xml)
+
+
+def read_xform_instance(file_path: str, keep_source_xml: bool = False
+                        ) -> Tuple[OrderedDict, List[str]]:
+    """Return flattened XForm data from a file, and removed attribute keys."""
+    xml_data = readers.read_xml_data(file_path=file_path)
+    return parse_xform_instance(
+        xml_data=xml_data, file_path=file_path,
+        keep_source_xml=keep_source_xml)
+
+
+def parse_xform_instance(xml_data: Union[str, bytes], file_path: str,
+                         keep_source_xml: bool = False
+                         ) -> Tuple[OrderedDict, List[str]]:
+    """
+    Return flattened XForm data from XML text or data, and removed attribute
+    keys.
+
+    XML data (bytes) is parsed and digested as is, and only decoded to text
+    if keep_source_xml is True.
+    """
+    flat = readers.flatten_xml(xml_data=xml_data)
+    flat["_source_file"] = os.path.normpath(file_path)
+    flat["_source_digest"] = readers.content_digest(data=xml_data)
+    if keep_source_xml:
+        if isinstance(xml_data, bytes):
+            xml_data = readers.decode_xml(data=xml_data)
+        flat["_source_xml"] = xml_data
+    removed_keys = [k for k in flat.keys()
+                    if k.startswith("@") and k not in ["@id", "@version"]]
+    for k in removed_keys:
+        del flat[k]
+    return flat, removed_keys
+
+
+def map_in_process_pool(func: Callable, iterable: Iterable, workers: int,
+                        chunk_size: int) -> Iterator:
+    """
+    Yield func results for each item in iterable, using a process pool.
+
+    Items are submitted in chunks so that the number of pending results is
+    bounded, while the next chunk is submitted before the results of the
+    current chunk are yielded so that the pool is kept busy. Results are
+    yielded in the same order as the items in iterable.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = None
+        for chunk in iter_chunks(iterable=iterable, chunk_size=chunk_size):
+            results = executor.map(
+                func, chunk, chunksize=max(1, len(chunk) // (workers * 4)))
+            if pending is not None:
+                yield from pending
+            pending = results
+        if pending is not None:
+            yield from pending
+
+
+def iter_chunks(iterable: Iterable, chunk_size: int) -> Iterator[List]:
+    """Yield lists of up to chunk_size items from iterable."""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, chunk_size))
+    while len(chunk) > 0:
+        yield chunk
+        chunk = list(islice(iterator, chunk_size))
 
 
 def prepare_xform_data(
         xform_instances: ListODict,
-        form_def: OrderedDict) -> Tuple[ListODict, List[str]]:
-    """Return a list of observation values. Convert dates to Stata format."""
-    exclude_variables = ["_source_xml"]
-    unknown_vars = list()
-    prepared_instances = list()
+        form_def: OrderedDict) -> Tuple[columns.ColumnarData, List[str]]:
+    """
+    Return the observation values by column. Convert dates to Stata format.
+
+    Instances from the same form version mostly have the same keys in the
+    same order, so the sanitised names and unknown variables for each key
+    layout are worked out once, and re-used for each instance with it.
+    """
+    exclude_variables = ["_source_digest", "_source_xml"]
+    form_columns = [k for k in form_def.keys() if k != "@settings"]
+    layouts = dict()
+    unknown_vars = OrderedDict()
+    prepared_instances = columns.ColumnarData()
     for instance in xform_instances:
-        for k, v in form_def.items():
-            if k == "@settings":
-                continue
-            elif k not in instance.keys():
-                # Expand all missing items so Stata considers them missing.
-                instance[k] = None
-            elif v.get("type") is not None:
-                # Convert dates to string integers using Stata's SIF.
-                if v["type"] == "date" and instance[k] is not None:
-                    date_parse = datetime.strptime(instance[k], "%Y-%m-%d")
-                    instance[k] = str((date_parse - STATA_ZERO_DATE).days)
-        for k, v in instance.items():
-            key_ok = k not in form_def.keys() and k not in exclude_variables
-            if key_ok and v is not None:
-                unknown_vars.append(re.sub("[^A-z0-9_]", "", k))
-        new_instance = OrderedDict(
-            (re.sub("[^A-z0-9_]", "", k), v) for k, v in instance.items())
-        prepared_instances.append(new_instance)
-    return prepared_instances, unknown_vars
+        keys = tuple(instance.keys())
+        layout = layouts.get(keys)
+        if layout is None:
+            # Expand all missing items so Stata considers them missing.
+            missing = tuple(k for k in form_columns if k not in instance)
+            names = tuple(INVALID_NAME_CHARS.sub("", k)
+                          for k in keys + missing)
+            unknown_indexes = [
+                i for i, k in enumerate(keys)
+                if k not in form_def and k not in exclude_variables]
+            layout = layouts[keys] = (names, unknown_indexes, len(missing))
+        names, unknown_indexes, missing_count = layout
+        values = list(instance.values())
+        values.extend([None] * missing_count)
+        for i in unknown_indexes:
+            if values[i] is not None:
+                unknown_vars[names[i]] = None
+        prepared_instances.append(keys=names, values=values)
+    for k in form_columns:
+        if form_def[k].get("type") == "date":
+            prepared_instances.convert(
+                name=INVALID_NAME_CHARS.sub("", k), func=stata_date)
+    return prepared_instances, list(unknown_vars)
+
+
+@lru_cache(maxsize=4096)
+def stata_date(value: str) -> str:
+    """Convert a date to a string integer using Stata's SIF."""
+    date_parse = datetime.strptime(value, "%Y-%m-%d")
+    return str((date_parse - STATA_ZERO_DATE).days)
 
 
 def tidy_form_def(form_id: str, form_def: OrderedDict, unknown_vars: List[str]
@@ -360,24 +769,63 @@ def tidy_form_def(form_id: str, form_def: OrderedDict, unknown_vars: List[str]
 
 def prepare_observations(
         xform_data: ListODict, form_def: OrderedDict) -> ListODict:
-    observations = list()
-    for instance in xform_data:
-        var_values = list()
-        for k, v in instance.items():
-            if k in form_def.keys():
-                var_values.append(observation_value(var_name=k, var_value=v))
-        observations.append(OrderedDict([('v', var_values)]))
-    return observations
+    return list(iter_observations(xform_data=xform_data, form_def=form_def))
+
+
+def iter_observations(
+        xform_data: ListODict, form_def: OrderedDict) -> Iterator[OrderedDict]:
+    """
+    Yield a Stata XML observation (o) element for each instance.
+
+    The positions of the instance keys that are in the form_def are worked
+    out once for each key layout, and re-used for each instance with it.
+    """
+    xform_data = columns.as_columnar(xform_data=xform_data)
+    layouts = [[(i, k) for i, k in enumerate(layout) if k in form_def]
+               for layout in xform_data.layouts]
+    for layout_number, values in xform_data.iter_layout_rows():
+        var_values = [observation_value(var_name=k, var_value=values[i])
+                      for i, k in layouts[layout_number]]
+        yield OrderedDict([('v', var_values)])
 
 
 def write_stata_docs(stata_docs: Dict[str, str], output_path: str) -> None:
     """Assuming the form_id is a valid basename, write the Stata docs out."""
     for form_id, document in stata_docs.items():
-        write_path = os.path.join(output_path, '{0}.xml'.format(form_id))
-        with open(write_path, mode='w', encoding="UTF-8") as out_doc:
-            out_doc.write(document)
-        logger.info("Wrote form data for form_id: {0}, to a file at: "
-                    " {1}.".format(form_id, write_path))
+        write_stata_doc(
+            form_id=form_id, document=document, output_path=output_path)
+
+
+def write_stata_doc(form_id: str, document: str, output_path: str) -> str:
+    """Write a Stata doc out, named for the form_id, and return the path."""
+    write_path = os.path.join(output_path, '{0}.xml'.format(form_id))
+    with open(write_path, mode='w', encoding="UTF-8") as out_doc:
+        out_doc.write(document)
+    logger.info("Wrote form data for form_id: {0}, to a file at: "
+                " {1}.".format(form_id, write_path))
+    return write_path
+
+
+def write_stata_xml(form_id: str, form_def: OrderedDict,
+                    xform_data: ListODict, output_path: str,
+                    run_metrics: metrics.RunMetrics = None) -> str:
+    """
+    Write a Stata XML doc out, named for the form_id, and return the path.
+
+    The document is streamed to the file one observation at a time, rather
+    than being composed in full first, but the output is the same as for
+    write_stata_doc with the document from iter_stata_docs. If run_metrics
+    is given, writing to the file is measured as the "write" stage.
+    """
+    stata_doc = prepare_stata_doc(
+        form_id=form_id, form_def=form_def, xform_data=xform_data, stream=True)
+    write_path = os.path.join(output_path, '{0}.xml'.format(form_id))
+    with metrics.open_measured(run_metrics, write_path, mode='w',
+                               encoding="UTF-8") as out_doc:
+        xmltodict.unparse(stata_doc, output=out_doc)
+    logger.info("Wrote form data for form_id: {0}, to a file at: "
+                " {1}.".format(form_id, write_path))
+    return write_path
 
 
 def choice_data_type_is_integer(choice_list: List[Dict]) -> bool:
@@ -397,17 +845,34 @@ def choice_data_type_is_integer(choice_list: List[Dict]) -> bool:
 
 def remove_duplicate_instances(instances: ListODict) -> ListODict:
     """Remove duplicate instances, logging a warning if so."""
-    counts = Counter(x.get("_source_xml") for x in instances)
-    dupes = {k: v for k, v in counts.items() if v != 1}
-    for k, v in dupes.items():
-        dupe_values = [x for x in instances if x.get("_source_xml") == k]
-        dupe_paths = list()
-        for i, dupe in enumerate(dupe_values):
-            dupe_paths.append(dupe.get("_source_file"))
-            if i > 0:
-                instances.remove(dupe)
+    return list(iter_unique_instances(instances=instances))
+
+
+def iter_unique_instances(
+        instances: Iterable[OrderedDict]) -> Iterator[OrderedDict]:
+    """
+    Yield the first instance with each content digest, logging duplicates.
+
+    Instances are checked against an index of the digests seen so far, so
+    they are processed in a single pass. The warnings for duplicates are
+    logged once all the instances have been seen, in the order that the
+    first copy of each duplicated instance was found.
+    """
+    seen = dict()
+    dupes = dict()
+    for instance in instances:
+        digest = instance.get("_source_digest")
+        if digest not in seen:
+            seen[digest] = (len(seen), instance.get("_source_file"))
+            yield instance
+        elif digest in dupes:
+            dupes[digest].append(instance.get("_source_file"))
+        else:
+            dupes[digest] = [seen[digest][1], instance.get("_source_file")]
+    for digest in sorted(dupes, key=lambda x: seen[x][0]):
+        dupe_paths = dupes[digest]
         logger.warning(
             "Found duplicate XML files. Only data from the first file listed "
             "below will be included in the output. Duplicates found: {0},\n"
-            "Source files:\n{1}".format(v, '\n'.join(dupe_paths)))
-    return instances
+            "Source files:\n{1}".format(
+                len(dupe_paths), '\n'.join(dupe_paths)))
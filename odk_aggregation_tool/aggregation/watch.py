@@ -0,0 +1,230 @@
+from collections import OrderedDict, deque
+from copy import deepcopy
+from typing import Dict, Iterable, List, Tuple
+import logging
+import os
+import threading
+import time
+from odk_aggregation_tool.aggregation import readers, to_stata_xml, writers
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+Snapshot = Dict[str, Tuple[int, int]]
+
+
+def stat_snapshot(file_paths: Iterable[str]) -> Snapshot:
+    """Return the size and modification time of each file, by path."""
+    snapshot = OrderedDict()
+    for file_path in file_paths:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:  # Removed since the directory was listed.
+            continue
+        snapshot[file_path] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+def compare_snapshots(before: Snapshot, after: Snapshot
+                      ) -> Tuple[List[str], List[str]]:
+    """Return the paths that are new or changed in after, and those removed."""
+    changed = [k for k, v in after.items() if before.get(k) != v]
+    removed = [k for k in before if k not in after]
+    return changed, removed
+
+
+class FormWatcher:
+    """
+    Keep the output files up to date as XLSForm and instance files arrive.
+
+    Each poll() takes a snapshot of the size and modification time of the
+    files in the XLSForm and instances paths. Once the snapshot has stayed
+    the same for debounce seconds, so that files still being copied in are
+    done as one batch, only the new or changed files are read, and only the
+    forms that they (or removed files) belong to are written out again.
+
+    The parsed instances are kept in memory between polls, so that each
+    form's output still has all of its instances. The output files are the
+    same as those from writers.write_forms, for the same files. The workers,
+    chunk_size and io_threads are for reading files, and form_workers for
+    writing forms, as for writers.write_forms.
+
+    Usage:
+    watcher = FormWatcher(xlsform_path="xlsforms", instances_path="xforms",
+                          output_path="output")
+    watcher.run(interval=10.0, cancel=threading.Event())
+    """
+
+    def __init__(self, xlsform_path: str, instances_path: str,
+                 output_path: str, output_format_name: str = 'xml',
+                 debounce: float = 5.0, workers: int = 1,
+                 form_workers: int = 1, chunk_size: int = 1000,
+                 io_threads: int = readers.IO_THREADS):
+        self.xlsform_path = xlsform_path
+        self.instances_path = instances_path
+        self.output_path = output_path
+        self.output_format_name = output_format_name
+        self.debounce = debounce
+        self.workers = workers
+        self.form_workers = form_workers
+        self.chunk_size = chunk_size
+        self.io_threads = io_threads
+        self.form_defs = OrderedDict()
+        # Flattened instances read from each file (archives can have many).
+        self.instances = dict()
+        # The snapshot that the form_defs and instances are up to date with.
+        self.snapshot = (OrderedDict(), OrderedDict())
+        # A newer snapshot waiting to settle, and when it was first seen.
+        self.pending = None
+        self.pending_since = None
+        # Forms to write out, kept until they have been written.
+        self.stale_forms = set()
+
+    def scan(self) -> Tuple[Snapshot, Snapshot]:
+        """Return snapshots of the XLSForm files and the instance files."""
+        xlsforms = stat_snapshot(readers.find_files(
+            root_dir=self.xlsform_path, extension=".xlsx",
+            threads=self.io_threads))
+        instances = stat_snapshot(readers.find_instance_files(
+            path=self.instances_path, threads=self.io_threads))
+        return xlsforms, instances
+
+    def poll(self, now: float = None, cancel: threading.Event = None
+             ) -> List[str]:
+        """
+        Scan the files, update the outputs if the changes have settled, and
+        return the paths of the files written (if any).
+
+        The time now defaults to time.monotonic().
+        """
+        if now is None:
+            now = time.monotonic()
+        snapshot = self.scan()
+        if snapshot == self.snapshot:
+            self.pending = None
+            if len(self.stale_forms) == 0:
+                return list()
+        elif snapshot != self.pending:
+            self.pending, self.pending_since = snapshot, now
+            if self.debounce > 0:
+                return list()
+        elif now - self.pending_since < self.debounce:
+            return list()
+        self.pending = None
+        return self.update(snapshot=snapshot, cancel=cancel)
+
+    def update(self, snapshot: Tuple[Snapshot, Snapshot],
+               cancel: threading.Event = None) -> List[str]:
+        """
+        Read the changes since the last update, write out the affected forms,
+        and return the paths of the files written.
+
+        The changed files are all read before anything is updated, so if
+        reading fails, the same changes are found again by the next poll.
+        """
+        xlsforms, instances = snapshot
+        form_defs = self.form_defs
+        if xlsforms != self.snapshot[0]:
+            form_defs = to_stata_xml.collate_xlsforms_by_form_id(
+                xlsform_path=self.xlsform_path)
+        changed, removed = compare_snapshots(
+            before=self.snapshot[1], after=instances)
+        logger.info(
+            "Found {0} new or changed instance files, and {1} removed "
+            "instance files.".format(len(changed), len(removed)))
+        read = self.read_instances(file_paths=changed, cancel=cancel)
+
+        for form_id, form_def in form_defs.items():
+            if self.form_defs.get(form_id) != form_def:
+                self.stale_forms.add(form_id)
+        for file_path in changed + removed:
+            self.stale_forms.update(
+                x["@id"] for x in self.instances.pop(file_path, list()))
+        for file_path, flats in zip(changed, read):
+            self.instances[file_path] = flats
+            self.stale_forms.update(x["@id"] for x in flats)
+        self.form_defs = form_defs
+        self.snapshot = snapshot
+        return self.write_stale_forms(cancel=cancel)
+
+    def read_instances(self, file_paths: List[str],
+                       cancel: threading.Event = None
+                       ) -> List[List[OrderedDict]]:
+        """
+        Return a list of the flattened instances in each file.
+
+        The XML files in an archive are parsed one at a time, the same as
+        other files, and the results are collected for the archive.
+        """
+        owners = deque()
+
+        def iter_items():
+            for file_path in file_paths:
+                for item in to_stata_xml.iter_xform_items([file_path]):
+                    owners.append(file_path)
+                    yield item
+
+        results = to_stata_xml.iter_until_cancelled(
+            items=to_stata_xml.map_in_workers(
+                func=to_stata_xml.read_xform_item, iterable=iter_items(),
+                workers=self.workers, chunk_size=self.chunk_size,
+                io_threads=self.io_threads),
+            cancel=cancel)
+        read = OrderedDict((x, list()) for x in file_paths)
+        for flat, _ in results:
+            read[owners.popleft()].append(flat)
+        return list(read.values())
+
+    def write_stale_forms(self, cancel: threading.Event = None) -> List[str]:
+        """Write out the forms with new, changed or removed data."""
+        form_ids = [x for x in self.form_defs if x in self.stale_forms]
+        # Forms without an XLSForm aren't written, as for a full run.
+        if len(form_ids) == 0:
+            self.stale_forms.clear()
+            return list()
+        logger.info("Writing out data for form_ids: {0}".format(form_ids))
+        # In the order found, the same as for a full run.
+        form_instances = OrderedDict((x, list()) for x in form_ids)
+        instances = (
+            flat for file_path in self.snapshot[1]
+            for flat in self.instances.get(file_path, list())
+            if flat["@id"] in form_instances)
+        for flat in to_stata_xml.iter_unique_instances(instances=instances):
+            form_instances[flat["@id"]].append(flat)
+        # Preparing the data tidies the form definition it is given.
+        forms = ((x, deepcopy(self.form_defs[x]), form_instances.pop(x))
+                 for x in form_ids)
+        written = writers.write_form_instances(
+            forms=forms, output_path=self.output_path,
+            output_format_name=self.output_format_name,
+            form_workers=self.form_workers, cancel=cancel)
+        self.stale_forms.clear()
+        return written
+
+    def run(self, interval: float = 10.0,
+            cancel: threading.Event = None) -> None:
+        """
+        Poll every interval seconds, until the cancel event is set.
+
+        If an update fails, the error is logged, and it is tried again at the
+        next poll.
+        """
+        if cancel is None:
+            cancel = threading.Event()
+        logger.info(
+            "Watching for changes to XLSForms in: {0}, and instance files "
+            "in: {1}".format(self.xlsform_path, self.instances_path))
+        while not cancel.is_set():
+            try:
+                written = self.poll(cancel=cancel)
+            except to_stata_xml.AggregationCancelled:
+                break
+            except Exception:
+                logger.exception(
+                    "Updating the output files failed, error(s) below. This "
+                    "will be tried again at the next check for changes.")
+            else:
+                if len(written) > 0:
+                    logger.info("Updated {0} output files.".format(
+                        len(written)))
+            cancel.wait(interval)
+        logger.info("Stopped watching for changes.")
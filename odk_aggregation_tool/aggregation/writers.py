@@ -0,0 +1,194 @@
+from typing import List
+from collections import OrderedDict, namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import logging
+import logging.handlers
+import threading
+from odk_aggregation_tool.aggregation import readers, to_stata_xml, \
+    to_stata_dta, metrics
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+AGGREGATION_LOGGER = "odk_aggregation_tool.aggregation"
+
+
+output_format = namedtuple('OutputFormat', ['name', 'label', 'writer'])
+output_formats = OrderedDict((x.name, x) for x in [
+    output_format('xml', 'Stata XML', to_stata_xml.write_stata_xml),
+    output_format('dta', 'Stata DTA', to_stata_dta.write_stata_dta),
+])
+
+
+def write_form_data(form_id: str, form_def: OrderedDict,
+                    xform_data: List[OrderedDict], output_path: str,
+                    output_format_name: str = 'xml',
+                    run_metrics: metrics.RunMetrics = None) -> str:
+    """
+    Write the form data out using the named format's writer.
+
+    If run_metrics is given, this is measured as the "serialize" stage, and
+    writing to the file as the "write" stage.
+    """
+    writer = output_formats[output_format_name].writer
+    with metrics.measure_stage(run_metrics, "serialize") as stage:
+        write_path = writer(
+            form_id=form_id, form_def=form_def, xform_data=xform_data,
+            output_path=output_path, run_metrics=run_metrics)
+        stage["items"] += len(xform_data)
+    return write_path
+
+
+def write_forms(xlsform_path: str, instances_path: str, output_path: str,
+                output_format_name: str = 'xml', workers: int = 1,
+                form_workers: int = 1, chunk_size: int = 1000,
+                cache_path: str = None, cancel: threading.Event = None,
+                io_threads: int = readers.IO_THREADS,
+                run_metrics: metrics.RunMetrics = None) -> List[str]:
+    """
+    Write out the data for each form, and return the paths written.
+
+    The workers, chunk_size, cache_path and io_threads are for reading the
+    instance files (see to_stata_xml.iter_xform_instances). If form_workers
+    is more than 1, once the files are read, each form's data is prepared
+    and written out by a pool of that many processes. Each form's file is
+    written as soon as it is ready, and the form's log messages are logged
+    here once it is done, in form order, so the logs read the same as if
+    the forms were done one at a time.
+
+    If run_metrics is given, each stage is measured (see metrics.RunMetrics).
+    The stages done by form_workers are measured in the worker processes,
+    and added up, so they can add up to more than the elapsed time.
+    """
+    forms = to_stata_xml.iter_form_instances(
+        xlsform_path=xlsform_path, instances_path=instances_path,
+        workers=workers, chunk_size=chunk_size, cache_path=cache_path,
+        cancel=cancel, io_threads=io_threads, run_metrics=run_metrics)
+    return write_form_instances(
+        forms=forms, output_path=output_path,
+        output_format_name=output_format_name, form_workers=form_workers,
+        cancel=cancel, run_metrics=run_metrics)
+
+
+def write_form_instances(forms, output_path: str,
+                         output_format_name: str = 'xml',
+                         form_workers: int = 1,
+                         cancel: threading.Event = None,
+                         run_metrics: metrics.RunMetrics = None) -> List[str]:
+    """
+    Prepare and write out each form's instances, and return the paths written.
+
+    The forms are (form_id, form_def, xform_instances) tuples, like those from
+    to_stata_xml.iter_form_instances. See write_forms for form_workers.
+    """
+    if form_workers > 1:
+        return write_forms_in_process_pool(
+            forms=forms, output_path=output_path,
+            output_format_name=output_format_name, workers=form_workers,
+            cancel=cancel, run_metrics=run_metrics)
+    written = list()
+    for form_id, form_def, xform_instances in forms:
+        form_id, form_def, xform_data = to_stata_xml.prepare_form_data(
+            form_id=form_id, form_def=form_def,
+            xform_instances=xform_instances, run_metrics=run_metrics)
+        del xform_instances
+        written.append(write_form_data(
+            form_id=form_id, form_def=form_def, xform_data=xform_data,
+            output_path=output_path, output_format_name=output_format_name,
+            run_metrics=run_metrics))
+    return written
+
+
+def write_forms_in_process_pool(forms, output_path: str,
+                                output_format_name: str, workers: int,
+                                cancel: threading.Event = None,
+                                run_metrics: metrics.RunMetrics = None
+                                ) -> List[str]:
+    """
+    Prepare and write each form in a process pool, replaying the logs.
+
+    Forms are only taken from forms as workers become free, so that at most
+    workers forms (plus one waiting for each) are held in memory at a time.
+    """
+    log_level = logging.getLogger(AGGREGATION_LOGGER).getEffectiveLevel()
+    written = list()
+    pending = deque()
+    forms = iter(forms)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        def submit_next():
+            for form_id, form_def, xform_instances in islice(forms, 1):
+                pending.append(executor.submit(
+                    write_form_task, form_id=form_id, form_def=form_def,
+                    xform_instances=xform_instances, output_path=output_path,
+                    output_format_name=output_format_name,
+                    log_level=log_level, measure=run_metrics is not None))
+
+        try:
+            for _ in range(workers * 2):
+                submit_next()
+            while len(pending) > 0:
+                to_stata_xml.check_cancelled(cancel=cancel)
+                write_path, records, stages = pending.popleft().result()
+                submit_next()
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if stages is not None:
+                    run_metrics.add_stages(stages=stages)
+                written.append(write_path)
+        finally:
+            for future in pending:
+                future.cancel()
+    return written
+
+
+def write_form_task(form_id: str, form_def: OrderedDict,
+                    xform_instances: List[OrderedDict], output_path: str,
+                    output_format_name: str, log_level: int,
+                    measure: bool = False):
+    """
+    Prepare and write a form's data, return the path and the log records.
+
+    This runs in a worker process. The aggregation logs are recorded instead
+    of going to the usual handlers, so that they can be sent back. If
+    measure is True, the stage metrics are sent back too, otherwise None.
+    """
+    agg_logger = logging.getLogger(AGGREGATION_LOGGER)
+    recorder = RecordingHandler()
+    run_metrics = metrics.RunMetrics() if measure else None
+    handlers, level, propagate = \
+        agg_logger.handlers, agg_logger.level, agg_logger.propagate
+    agg_logger.handlers = [recorder]
+    agg_logger.setLevel(log_level)
+    agg_logger.propagate = False
+    try:
+        form_id, form_def, xform_data = to_stata_xml.prepare_form_data(
+            form_id=form_id, form_def=form_def,
+            xform_instances=xform_instances, run_metrics=run_metrics)
+        del xform_instances
+        write_path = write_form_data(
+            form_id=form_id, form_def=form_def, xform_data=xform_data,
+            output_path=output_path, output_format_name=output_format_name,
+            run_metrics=run_metrics)
+    finally:
+        agg_logger.handlers = handlers
+        agg_logger.setLevel(level)
+        agg_logger.propagate = propagate
+    stages = None if run_metrics is None else run_metrics.stages
+    return write_path, recorder.records, stages
+
+
+class RecordingHandler(logging.handlers.QueueHandler):
+    """
+    A logging handler that keeps a list of records, ready to be pickled.
+
+    The records are prepared the same way as by QueueHandler, so that the
+    message is already formatted, and any exception info is text.
+    """
+
+    def __init__(self):
+        logging.handlers.QueueHandler.__init__(self, queue=None)
+        self.records = list()
+
+    def enqueue(self, record):
+        self.records.append(record)
@@ -0,0 +1,211 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+from typing import List
+from odk_aggregation_tool import __version__
+from odk_aggregation_tool.aggregation import readers, writers, cache, \
+    metrics, watch
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def existing_dir(path: str) -> str:
+    """Argument type for a path to a directory that must already exist."""
+    path = os.path.normpath(path)
+    if not os.path.isdir(path):
+        raise argparse.ArgumentTypeError(
+            "{0} does not correspond to an existing directory.".format(path))
+    return path
+
+
+def existing_instances_path(path: str) -> str:
+    """Argument type for a directory or archive file that must exist."""
+    path = os.path.normpath(path)
+    if not readers.is_instances_path(path=path):
+        raise argparse.ArgumentTypeError(
+            "{0} does not correspond to an existing directory, or an "
+            "existing archive ({1}) file.".format(
+                path, ", ".join(readers.ARCHIVE_EXTENSIONS)))
+    return path
+
+
+def positive_int(value: str) -> int:
+    """Argument type for a whole number that is 1 or more."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "{0} is not a whole number of 1 or more.".format(value))
+    return number
+
+
+def seconds(value: str) -> float:
+    """Argument type for a number of seconds that is 0 or more."""
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(
+            "{0} is not a number of seconds of 0 or more.".format(value))
+    return number
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Prepare the command line argument parser."""
+    parser = argparse.ArgumentParser(
+        prog="odk_aggregation_tool",
+        description="Aggregate ODK XML data into a file per XLSForm.")
+    parser.add_argument(
+        "xlsforms_path", type=existing_dir,
+        help="Directory to search for XLSForm definitions (.xlsx).")
+    parser.add_argument(
+        "xforms_path", type=existing_instances_path,
+        help="Directory to search for XForm data (.xml), or an archive "
+             "(.zip, .tar, .tar.gz, .tgz) of XForm data files.")
+    parser.add_argument(
+        "output_path", type=existing_dir,
+        help="Directory to write the output files to.")
+    parser.add_argument(
+        "--format", dest="output_format", default="xml",
+        choices=list(writers.output_formats.keys()),
+        help="Output file format (default: %(default)s).")
+    parser.add_argument(
+        "--workers", type=positive_int, default=1,
+        help="Number of processes for reading XForm data files "
+             "(default: %(default)s).")
+    parser.add_argument(
+        "--form-workers", type=positive_int, default=1,
+        help="Number of processes for preparing and writing each form's "
+             "output file (default: %(default)s).")
+    parser.add_argument(
+        "--io-threads", type=positive_int, default=readers.IO_THREADS,
+        help="Number of threads for listing directories, and for reading "
+             "XForm data files if --workers is 1 (default: %(default)s).")
+    parser.add_argument(
+        "--chunk-size", type=positive_int, default=1000,
+        help="Number of files sent to each worker process at a time "
+             "(default: %(default)s).")
+    parser.add_argument(
+        "--cache", dest="cache_path", default=None,
+        help="Cache file to keep parsed data in, so that later runs only "
+             "read files that are new or have changed.")
+    parser.add_argument(
+        "--clear-cache", action="store_true",
+        help="Remove the cache file before running.")
+    parser.add_argument(
+        "--metrics", dest="metrics_path", default=None,
+        help="File to write the time, item count and peak memory for each "
+             "stage of the run to, as JSON.")
+    parser.add_argument(
+        "--profile-stage", default=None, choices=metrics.STAGES,
+        help="Stage to profile with cProfile and tracemalloc. The data is "
+             "written to files named like the --metrics file, with the "
+             "stage name and .prof or .tracemalloc added.")
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="Keep running, and each time XLSForm or XForm data files are "
+             "added, changed or removed, write out the affected forms' "
+             "output files again. Stop with Ctrl+C.")
+    parser.add_argument(
+        "--interval", type=seconds, default=10.0,
+        help="With --watch, seconds between checks for changed files "
+             "(default: %(default)s).")
+    parser.add_argument(
+        "--debounce", type=seconds, default=5.0,
+        help="With --watch, seconds that the files must stay unchanged "
+             "for, before the output files are written out "
+             "(default: %(default)s).")
+    parser.add_argument(
+        "--quiet", action="store_true",
+        help="Only show warnings and errors.")
+    parser.add_argument(
+        "--version", action="version",
+        version="%(prog)s {0}".format(__version__))
+    return parser
+
+
+def run(xlsforms_path: str, xforms_path: str, output_path: str,
+        output_format: str = "xml", workers: int = 1, form_workers: int = 1,
+        chunk_size: int = 1000, cache_path: str = None,
+        clear_cache: bool = False,
+        io_threads: int = readers.IO_THREADS,
+        run_metrics: metrics.RunMetrics = None) -> List[str]:
+    """Run the aggregation task, and return the paths of files written."""
+    if clear_cache and cache_path is not None:
+        cache.clear_cache(cache_path=cache_path)
+    return writers.write_forms(
+        xlsform_path=xlsforms_path, instances_path=xforms_path,
+        output_path=output_path, output_format_name=output_format,
+        workers=workers, form_workers=form_workers, chunk_size=chunk_size,
+        cache_path=cache_path, io_threads=io_threads,
+        run_metrics=run_metrics)
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Run the aggregation task from the command line, and return an exit code.
+
+    Log messages are written to stderr. The exit code is 0 if the task
+    completed, 1 if it failed, and 2 if the arguments were invalid. With
+    --watch, it runs until stopped with Ctrl+C, and the exit code is 0.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.clear_cache and args.cache_path is None:
+        parser.error("--clear-cache requires --cache.")
+    if args.profile_stage is not None and args.metrics_path is None:
+        parser.error("--profile-stage requires --metrics.")
+    if args.watch and (args.cache_path or args.metrics_path):
+        parser.error("--cache and --metrics can't be used with --watch.")
+    run_metrics = None
+    if args.metrics_path is not None:
+        run_metrics = metrics.RunMetrics(
+            profile_stage=args.profile_stage,
+            profile_path="{0}.{1}".format(
+                os.path.splitext(args.metrics_path)[0], args.profile_stage))
+
+    app_logger = logging.getLogger("odk_aggregation_tool")
+    handler = logging.StreamHandler(stream=sys.stderr)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    app_logger.addHandler(handler)
+    app_logger.setLevel("WARNING" if args.quiet else "INFO")
+    try:
+        if args.watch:
+            watcher = watch.FormWatcher(
+                xlsform_path=args.xlsforms_path,
+                instances_path=args.xforms_path,
+                output_path=args.output_path,
+                output_format_name=args.output_format,
+                debounce=args.debounce, workers=args.workers,
+                form_workers=args.form_workers, chunk_size=args.chunk_size,
+                io_threads=args.io_threads)
+            try:
+                watcher.run(interval=args.interval)
+            except KeyboardInterrupt:
+                logger.info("Stopped watching for changes.")
+            return 0
+        written = run(
+            xlsforms_path=args.xlsforms_path, xforms_path=args.xforms_path,
+            output_path=args.output_path, output_format=args.output_format,
+            workers=args.workers, form_workers=args.form_workers,
+            chunk_size=args.chunk_size,
+            cache_path=args.cache_path, clear_cache=args.clear_cache,
+            io_threads=args.io_threads, run_metrics=run_metrics)
+        logger.info("Aggregation completed, wrote {0} files.".format(
+            len(written)))
+        return 0
+    except Exception:
+        logger.exception("Aggregation not completed, error(s) below.")
+        return 1
+    finally:
+        if run_metrics is not None:
+            run_metrics.finish()
+            run_metrics.write(metrics_path=args.metrics_path)
+            logger.info("Wrote run metrics to a file at: {0}".format(
+                args.metrics_path))
+        app_logger.removeHandler(handler)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import logging
+import logging.handlers
+import queue
+import threading
+
+
+class BackgroundTask:
+    """
+    Run a task function on a worker thread, collecting its log messages.
+
+    Log records from the named logger are put on a thread-safe queue while
+    the task runs, so that the GUI thread can show them as they arrive by
+    calling read_messages() periodically (e.g. with Tk's "after"). The task
+    function is called with a "cancel" keyword argument (a threading.Event),
+    which is set by cancel(). The task function's return value is kept in
+    the "result" attribute once the task is done.
+
+    Usage:
+    task = BackgroundTask(func=my_func, logger_name="logger_name", x=1)
+    task.start()
+    messages, done = task.read_messages()
+    """
+
+    def __init__(self, func, logger_name, **kwargs):
+        self.func = func
+        self.kwargs = kwargs
+        self.logger = logging.getLogger(logger_name)
+        self.messages = queue.Queue()
+        self.handler = logging.handlers.QueueHandler(self.messages)
+        self.cancel_event = threading.Event()
+        self.result = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Attach the queue log handler and start the worker thread."""
+        self.logger.addHandler(self.handler)
+        self.thread.start()
+
+    def run(self):
+        """Call the task function. Runs on the worker thread."""
+        try:
+            self.result = self.func(cancel=self.cancel_event, **self.kwargs)
+        finally:
+            self.logger.removeHandler(self.handler)
+            self.messages.put(None)  # Marks the end of the task's messages.
+
+    def cancel(self):
+        """Ask the task to stop. It is up to the task function to check."""
+        self.cancel_event.set()
+
+    def is_running(self):
+        """Has the task started and not finished yet?"""
+        return self.thread.is_alive()
+
+    def read_messages(self):
+        """
+        Return log messages not yet read, and whether the task is done.
+
+        This doesn't wait for new messages, so if there aren't any then the
+        list is empty.
+
+        :return: list of str, bool
+        """
+        messages = []
+        done = False
+        while True:
+            try:
+                record = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if record is None:
+                done = True
+                break
+            messages.append(record.getMessage())
+        return messages, done
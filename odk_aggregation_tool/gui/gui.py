@@ -1,10 +1,11 @@
+import threading
 import tkinter
 import tkinter.filedialog
 import tkinter.messagebox
 from functools import partial
 from tkinter import ttk
-from odk_aggregation_tool.gui.wrappers import aggregation_stata
 from odk_aggregation_tool.gui import preferences
+from odk_aggregation_tool.gui.background_task import BackgroundTask
 
 
 class ODKToolsGui:
@@ -22,8 +23,10 @@ class ODKToolsGui:
         prefs = preferences.Preferences()
         master.title(prefs.app_title)
         ttk.Style().configure('.', font=prefs.font)
+        master.task = None
         ODKToolsGui.build_aggregation_stata(master=master, prefs=prefs)
         ODKToolsGui.build_output_box(master=master, prefs=prefs)
+        master.after(prefs.warm_imports_delay, ODKToolsGui.warm_imports)
 
     @staticmethod
     def build_aggregation_stata(master, prefs):
@@ -48,6 +51,19 @@ class ODKToolsGui:
                 master=master, xlsforms_path=xlsforms_path,
                 xforms_path=xforms_path, output_path=output_path),
             pre_msg=prefs.generic_pre_msg.format("Aggregation to Stata XML"))
+        master.aggregation_to_stata_dta = ODKToolsGui.build_action_frame(
+            master=master, label_text="Aggregation to Stata DTA",
+            label_width=prefs.label_width,
+            command=lambda: ODKToolsGui.aggregation_to_stata_xml(
+                master=master, xlsforms_path=xlsforms_path,
+                xforms_path=xforms_path, output_path=output_path,
+                output_format="dta"),
+            pre_msg=prefs.generic_pre_msg.format("Aggregation to Stata DTA"))
+        master.cancel_task = ODKToolsGui.build_action_frame(
+            master=master, label_text="Cancel running task",
+            label_width=prefs.label_width, button_text="Cancel",
+            command=lambda: ODKToolsGui.cancel_task(master=master))
+        master.cancel_task.button.state(['disabled'])
 
     @staticmethod
     def build_output_box(master, prefs):
@@ -74,17 +90,19 @@ class ODKToolsGui:
     @staticmethod
     def textbox_pre_message(event, message):
         """Clear the output Text field and insert the provided message."""
+        if event.widget.instate(['disabled']):
+            return
         event.widget.master.master.output.textbox.delete("1.0", tkinter.END)
         event.widget.master.master.output.textbox.insert(tkinter.END, message)
 
     @staticmethod
     def build_action_frame(master, label_text, label_width, command,
-                           pre_msg=None):
+                           pre_msg=None, button_text="Run"):
         """
         Generate a frame with a button for executing a command.
 
         The frame contains a grid row, with 3 columns: a label and a button
-        labelled "Run" which executes the command on click.
+        labelled "Run" (or button_text) which executes the command on click.
 
         The command / function passed in should be a lambda which doesn't
         return or require any input parameters; in the above layout code the
@@ -104,7 +122,8 @@ class ODKToolsGui:
         :param label_width: int. How wide the label should be.
         :param command: function. What to do when the button is clicked.
         :param pre_msg: str. Message to display in textbox on button press.
-        :return: path frame (tk Frame), path variable (tk StringVar)
+        :param button_text: str. The text to display on the button.
+        :return: action frame (tk Frame)
         """
         frame = ttk.Frame(master=master)
         frame.grid(sticky='w')
@@ -114,7 +133,8 @@ class ODKToolsGui:
             master=frame, text=label_text, width=label_width)
         frame.row_label.grid(row=0, column=0, padx=5, sticky="w")
 
-        frame.button = ttk.Button(master=frame, text="Run", command=command)
+        frame.button = ttk.Button(
+            master=frame, text=button_text, command=command)
         frame.button.grid(row=0, column=1, padx=5)
         if pre_msg is not None:
             frame.button.bind(
@@ -195,12 +215,91 @@ class ODKToolsGui:
 
     @staticmethod
     def aggregation_to_stata_xml(
-            master, xlsforms_path, xforms_path, output_path):
-        """Run Aggregation to Stata XML task, put results in main textbox."""
-        result = aggregation_stata.wrapper(
+            master, xlsforms_path, xforms_path, output_path,
+            output_format="xml"):
+        """
+        Start the Aggregation to Stata task on a worker thread.
+
+        The GUI stays responsive while the task runs. Log messages are shown
+        in the main textbox as they arrive, then replaced by the task results.
+        """
+        task = BackgroundTask(
+            func=ODKToolsGui.run_aggregation_stata,
+            logger_name="odk_aggregation_tool.aggregation",
             xlsforms_path=xlsforms_path.get(), xforms_path=xforms_path.get(),
-            output_path=output_path.get())
-        master.output.textbox.insert(tkinter.END, result)
+            output_path=output_path.get(), output_format=output_format)
+        master.task = task
+        ODKToolsGui.set_task_running(master=master, running=True)
+        task.start()
+        ODKToolsGui.poll_task(master=master, task=task)
+
+    @staticmethod
+    def import_aggregation_stata():
+        """
+        Import and return the Aggregation to Stata task module.
+
+        The aggregation modules (and the libraries they use) take a while to
+        import, so they are imported when first needed rather than when the
+        GUI starts, so that the window appears sooner.
+        """
+        from odk_aggregation_tool.gui.wrappers import aggregation_stata
+        return aggregation_stata
+
+    @staticmethod
+    def run_aggregation_stata(**kwargs):
+        """Run the Aggregation to Stata task. Runs on the worker thread."""
+        return ODKToolsGui.import_aggregation_stata().wrapper(**kwargs)
+
+    @staticmethod
+    def warm_imports():
+        """Import the aggregation modules on a background thread."""
+        thread = threading.Thread(
+            target=ODKToolsGui.import_aggregation_stata, daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def poll_task(master, task, interval=100, max_lines=500):
+        """
+        Show new task messages, and check again after interval (ms).
+
+        Only the last max_lines lines are kept in the textbox while the task
+        runs, so that it doesn't slow down when there are many messages.
+        """
+        messages, done = task.read_messages()
+        textbox = master.output.textbox
+        if len(messages) > 0:
+            textbox.insert(tkinter.END, "".join(
+                "{0}\n".format(x) for x in messages[-max_lines:]))
+            lines = int(textbox.index("end-1c").split(".")[0])
+            if lines > max_lines:
+                textbox.delete("1.0", "{0}.0".format(lines - max_lines + 1))
+            textbox.see(tkinter.END)
+        if done:
+            textbox.delete("1.0", tkinter.END)
+            textbox.insert(tkinter.END, task.result)
+            master.task = None
+            ODKToolsGui.set_task_running(master=master, running=False)
+        else:
+            master.after(interval, ODKToolsGui.poll_task, master, task)
+
+    @staticmethod
+    def cancel_task(master):
+        """Ask the running task to stop, at the end of its current step."""
+        if master.task is not None and master.task.is_running():
+            master.task.cancel()
+            master.output.textbox.insert(
+                tkinter.END, "Cancelling task, please wait...\n")
+
+    @staticmethod
+    def set_task_running(master, running):
+        """Only allow one task at a time, and cancel while one is running."""
+        run_state, cancel_state = ['disabled'], ['!disabled']
+        if not running:
+            run_state, cancel_state = cancel_state, run_state
+        master.aggregation_to_stata_xml.button.state(run_state)
+        master.aggregation_to_stata_dta.button.state(run_state)
+        master.cancel_task.button.state(cancel_state)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 import logging
 import collections
+import re
 
 
 class CapturingHandler(logging.Handler):
@@ -27,12 +28,7 @@ class CapturingHandler(logging.Handler):
         self.watcher = _LoggingWatcher([], [])
         if name is not None:
             self.name = name
-        existing_capture = [x for x in logger.handlers if x.name == name]
-        if len(existing_capture) == 0:
-            logger.addHandler(self)
-        else:
-            logger.info("Skipped adding handler '{0}', a logging handler "
-                        "with the same name is already attached.".format(name))
+        add_unique_handler(logger=logger, handler=self)
 
     def flush(self):
         pass
@@ -41,3 +37,112 @@ class CapturingHandler(logging.Handler):
         self.watcher.records.append(record)
         msg = self.format(record)
         self.watcher.output.append(msg)
+
+
+class StreamingLogHandler(logging.Handler):
+    """
+    A logging handler writing logs to a file, keeping only a summary.
+
+    Each record is written to the log file as it arrives, so the full logs
+    aren't kept in memory. What is kept is:
+    - messages: the last max_messages formatted messages.
+    - level_counts: the number of records for each level name.
+    - category_counts: the number of warnings (or worse) for each category,
+      which is the start of the message, up to the first ":", "." or new
+      line (e.g. "Found duplicate XML files").
+    Once max_repeats warnings of a category have been kept in messages,
+    later ones are only counted (and written to the file), and summary()
+    says how many more there were.
+
+    Usage:
+    handler = StreamingLogHandler(logger=my_logger, log_path="log.txt")
+    log_messages = [*handler.messages, *handler.summary()]
+    my_logger.removeHandler(hdlr=handler)
+    handler.close()
+    """
+
+    def __init__(self, logger, log_path, name=None, max_messages=200,
+                 max_repeats=3):
+        logging.Handler.__init__(self)
+        self.log_path = log_path
+        self.log_file = open(log_path, mode="w", encoding="UTF-8")
+        self.messages = collections.deque(maxlen=max_messages)
+        self.max_repeats = max_repeats
+        self.message_count = 0
+        self.level_counts = collections.Counter()
+        self.category_counts = collections.Counter()
+        if name is not None:
+            self.name = name
+        add_unique_handler(logger=logger, handler=self)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if not self.log_file.closed:
+                self.log_file.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            self.log_file.close()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+    def emit(self, record):
+        msg = self.format(record)
+        self.log_file.write(msg)
+        self.log_file.write("\n")
+        self.level_counts[record.levelname] += 1
+        if record.levelno >= logging.WARNING:
+            category = message_category(msg)
+            self.category_counts[category] += 1
+            if self.category_counts[category] > self.max_repeats:
+                return
+        self.messages.append(msg)
+        self.message_count += 1
+
+    def summary(self):
+        """
+        Return lines saying what isn't in messages, and the level counts.
+
+        :return: list of str
+        """
+        lines = list()
+        dropped = self.message_count - len(self.messages)
+        if dropped > 0:
+            lines.append("{0} earlier messages are not shown here.".format(
+                dropped))
+        for category, count in self.category_counts.items():
+            if count > self.max_repeats:
+                lines.append(
+                    "{0} more warnings are not shown here, like: {1}".format(
+                        count - self.max_repeats, category))
+        lines.append("Log message counts: {0}.".format(", ".join(
+            "{0}: {1}".format(k, v) for k, v in self.level_counts.items())))
+        return lines
+
+
+CATEGORY_END = re.compile("[:.\n]")
+
+
+def message_category(message):
+    """Return the start of the message, up to the first ':', '.' or newline."""
+    return CATEGORY_END.split(message, maxsplit=1)[0]
+
+
+def add_unique_handler(logger, handler):
+    """
+    Add the handler to the logger, unless one with the same name is there.
+
+    If a handler with the same name is already attached, this is logged.
+    """
+    name = handler.name
+    existing_capture = [x for x in logger.handlers if x.name == name]
+    if len(existing_capture) == 0:
+        logger.addHandler(handler)
+    else:
+        logger.info("Skipped adding handler '{0}', a logging handler "
+                    "with the same name is already attached.".format(name))
@@ -11,3 +11,6 @@ class Preferences:
     dir_browse = {'mustexist': True}
     generic_pre_msg = "{0} task initiated, please wait...\n\n"
     font = ('Arial', 8)
+    # Milliseconds after the window appears to start importing the
+    # aggregation modules, so that they are ready by the time Run is clicked.
+    warm_imports_delay = 500
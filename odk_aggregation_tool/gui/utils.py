@@ -1,4 +1,5 @@
 import os
+from odk_aggregation_tool.aggregation import readers
 
 WRAP_CHARS = "\" \r\n\t"
 
@@ -28,6 +29,19 @@ def folder_exists(variable_name, path):
     return valid, msg
 
 
+def folder_or_archive_exists(variable_name, path):
+    if readers.is_instances_path(path=path):
+        valid = True
+        msg = None
+    else:
+        valid = False
+        msg = "{0} does not correspond to an existing directory, or an " \
+              "existing archive ({1}) file.\n" \
+              "Please check the path and try again."
+        msg = msg.format(variable_name, ", ".join(readers.ARCHIVE_EXTENSIONS))
+    return valid, msg
+
+
 def clean_path(path):
     if path is None:
         path = ""
@@ -42,18 +56,20 @@ def validations(variable_name, cleaned_path):
     yield folder_exists(variable_name=variable_name, path=cleaned_path)
 
 
-def validate_path(variable_name, path):
+def validate_path(variable_name, path, allow_archive=False):
     """
     Check if the input path is valid, and raise ValueError(s) if not.
 
     Parameters.
     :param variable_name: str. Name of variable to state in error messages.
     :param path: str. Path to check.
+    :param allow_archive: bool. Whether the path can be an archive file.
     :return: str. valid path to do further work with.
     """
     cleaned_path = clean_path(path=path)
     kw = {"variable_name": variable_name, "path": cleaned_path}
-    checks = [(not_empty, kw), (folder_exists, kw)]
+    exists = folder_or_archive_exists if allow_archive else folder_exists
+    checks = [(not_empty, kw), (exists, kw)]
     for func, kwargs in checks:
         valid, message = func(**kwargs)
         if not valid:
@@ -1,46 +1,69 @@
 from odk_aggregation_tool.gui import utils
-from odk_aggregation_tool.gui.log_capturing_handler import CapturingHandler
+from odk_aggregation_tool.gui.log_capturing_handler import \
+    StreamingLogHandler
 import logging
-from odk_aggregation_tool.aggregation import to_stata_xml
+from odk_aggregation_tool.aggregation import to_stata_xml, writers
 import os
 import traceback
 
 
-def wrapper(xlsforms_path, xforms_path, output_path):
-    """Run the Aggregation to Stata task and return any result messages."""
+def wrapper(xlsforms_path, xforms_path, output_path, output_format="xml",
+            cancel=None):
+    """
+    Run the Aggregation to Stata task and return any result messages.
+
+    If a cancel event (threading.Event) is given and it is set while the task
+    runs, the task stops before the next step and says so in the result.
+
+    The log messages are written to "log.txt" in the output path as the task
+    runs. The result only has the most recent messages, with the first few
+    of each kind of warning, and a count of the messages by level.
+    """
+    label = writers.output_formats[output_format].label
     agg_logger = logging.getLogger("odk_aggregation_tool.aggregation")
-    agg_capture = CapturingHandler(logger=agg_logger, name="agg_capture")
-    agg_logger.setLevel("DEBUG")
-    agg_logger.parent = None  # Disables logger propagation to "root" stdout.
+    agg_capture = None
+    agg_propagate = agg_logger.propagate
     try:
         valid_xlsform_path = utils.validate_path(
             "XLSForm definitions path", xlsforms_path)
         valid_xforms_path = utils.validate_path(
-            "XForm data path", xforms_path)
+            "XForm data path", xforms_path, allow_archive=True)
         valid_output_path = utils.validate_path(
             "Output path", output_path)
-        header = "Aggregation to Stata XML task was run. Output below."
-        stata_docs = to_stata_xml.to_stata_xml(
-            xlsform_path=valid_xlsform_path, instances_path=valid_xforms_path)
-        to_stata_xml.write_stata_docs(
-            stata_docs=stata_docs, output_path=valid_output_path)
-        content = agg_capture.watcher.output
+        log_file = os.path.join(valid_output_path, 'log.txt')
+        agg_capture = StreamingLogHandler(
+            logger=agg_logger, log_path=log_file, name="agg_capture")
+        # Progress counts are only for watching the task run, not the result.
+        agg_capture.addFilter(
+            lambda x: x.name != to_stata_xml.progress_logger.name)
+        agg_logger.setLevel("DEBUG")
+        # Disables logger propagation to "root" stdout, while the task runs.
+        agg_logger.propagate = False
+        header = "Aggregation to {0} task was run. Output below.".format(
+            label)
+        writers.write_forms(
+            xlsform_path=valid_xlsform_path, instances_path=valid_xforms_path,
+            output_path=valid_output_path, output_format_name=output_format,
+            cancel=cancel)
+        content = [*agg_capture.messages, *agg_capture.summary(),
+                   "All of the log messages were written to a file at: "
+                   "{0}".format(log_file)]
+        result = utils.format_output(header=header, content=content)
+    except to_stata_xml.AggregationCancelled as e:
+        header = "Aggregation to {0} task was cancelled. Output up to " \
+                 "that point below.".format(label)
+        content = [*agg_capture.messages, *agg_capture.summary(), str(e)]
         result = utils.format_output(header=header, content=content)
-        agg_logger.removeHandler(agg_capture)
-        if len(result) > 2500:
-            log_file = os.path.join(valid_output_path, 'log.txt')
-            message = "A large amount of log data (over 2000 characters) " \
-                      "was generated. A copy of the logs will be written " \
-                      "to a file at: {0}".format(log_file)
-            with open(log_file, mode="w", encoding="UTF-8") as log:
-                log.write(result)
-            result = "{0}\n\n{1}".format(message, result)
     except Exception as e:
-        header = "Aggregation to Stata XML task not completed. Error(s) below."
+        header = "Aggregation to {0} task not completed. " \
+                 "Error(s) below.".format(label)
         content = "{0}\n\n{1}".format(str(e), ''.join(traceback.format_exc()))
         result = utils.format_output(header=header, content=content)
     finally:
         # If not definitely removed, no messages will be shown on re-run,
-        # because CapturingHandler won't attach if there's a duplicate name.
-        agg_logger.removeHandler(agg_capture)
+        # because the handler won't attach if there's a duplicate name.
+        if agg_capture is not None:
+            agg_logger.removeHandler(agg_capture)
+            agg_capture.close()
+        agg_logger.propagate = agg_propagate
     return result
@@ -8,7 +8,17 @@ setup(
     url="https://github.com/lindsay-stevens/",
     author="Lindsay Stevens",
     author_email="lindsay.stevens.au@gmail.com",
-    packages=['odk_aggregation_tool'],
+    packages=[
+        'odk_aggregation_tool',
+        'odk_aggregation_tool.aggregation',
+        'odk_aggregation_tool.gui',
+        'odk_aggregation_tool.gui.wrappers',
+    ],
+    entry_points={
+        'console_scripts': [
+            'odk_aggregation_tool=odk_aggregation_tool.cli:main',
+        ],
+    },
     test_suite='tests',
     include_package_data=True,
     license="MIT",
@@ -0,0 +1,142 @@
+import os
+import tempfile
+import sqlite3
+import unittest
+from odk_aggregation_tool.aggregation import cache
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.temp_dir.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_put_then_get_persists_data(self):
+        """Should return the data put in the cache, after re-opening it."""
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            file_cache.put(file_path="a.xml", size=1, mtime=2, digest="d",
+                           data={"k": 1})
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            self.assertTrue(file_cache.is_fresh(
+                file_path="a.xml", size=1, mtime=2, digest="d"))
+            self.assertEqual({"k": 1}, file_cache.get(file_path="a.xml"))
+
+    def test_is_fresh_false_if_stats_or_digest_changed(self):
+        """Should not consider an entry fresh if the file changed."""
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            file_cache.put(file_path="a.xml", size=1, mtime=2, digest="d",
+                           data=None)
+            self.assertFalse(file_cache.is_fresh(
+                file_path="a.xml", size=3, mtime=2, digest="d"))
+            self.assertFalse(file_cache.is_fresh(
+                file_path="a.xml", size=1, mtime=3, digest="d"))
+            self.assertFalse(file_cache.is_fresh(
+                file_path="a.xml", size=1, mtime=2, digest="e"))
+            self.assertFalse(file_cache.is_fresh(
+                file_path="b.xml", size=1, mtime=2, digest="d"))
+
+    def test_other_cache_format_is_dropped(self):
+        """Should drop all the data if the cache format is different."""
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            file_cache.put(file_path="a.xml", size=1, mtime=1, digest="d",
+                           data=1)
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            self.assertEqual(1, len(file_cache))
+        connection = sqlite3.connect(self.db_path)
+        connection.execute("UPDATE cache_format SET format = 'old'")
+        connection.commit()
+        connection.close()
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            self.assertEqual(0, len(file_cache))
+
+    def test_read_through_reads_file_again_if_content_changed(self):
+        """Should not re-use data if the content changed, but not stats."""
+        file_path = os.path.join(self.temp_dir.name, "a.txt")
+
+        def read(path):
+            with open(path, encoding="UTF-8") as text_file:
+                return text_file.read()
+
+        for content in ("abc", "xyz"):
+            stat = os.stat(file_path) if os.path.isfile(file_path) else None
+            with open(file_path, mode="w", encoding="UTF-8") as f:
+                f.write(content)
+            if stat is not None:
+                os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            observed = list(cache.read_through(
+                func=read, file_paths=[file_path], cache_path=self.db_path, table="t"))
+            self.assertEqual([content], observed)
+
+    def test_prune_removes_entries_not_kept(self):
+        """Should remove entries for paths not in keep_paths."""
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            for path in ["a.xml", "b.xml", "c.xml"]:
+                file_cache.put(file_path=path, size=1, mtime=1, digest="d",
+                           data=path)
+            removed = file_cache.prune(keep_paths=["b.xml"])
+        self.assertEqual(["a.xml", "c.xml"], sorted(removed))
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            self.assertEqual(1, len(file_cache))
+            with self.assertRaises(KeyError):
+                file_cache.get(file_path="a.xml")
+
+    def test_clear_removes_all_entries(self):
+        """Should remove all entries."""
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            file_cache.put(file_path="a.xml", size=1, mtime=1, digest="d",
+                           data=1)
+            file_cache.clear()
+            self.assertEqual(0, len(file_cache))
+
+    def test_clear_cache_removes_cache_file(self):
+        """Should remove the cache file, and not fail if it doesn't exist."""
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            file_cache.put(file_path="a.xml", size=1, mtime=1, digest="d",
+                           data=1)
+        cache.clear_cache(cache_path=self.db_path)
+        self.assertFalse(os.path.exists(self.db_path))
+        cache.clear_cache(cache_path=self.db_path)
+
+    def test_spool_returns_items_per_key_in_order_added(self):
+        """Should return each key's items in order, and remove the file."""
+        with cache.Spool(dir_path=self.temp_dir.name) as spool:
+            spool.extend(items=iter(["b1", "a1", "b2", "c1", "a2"]),
+                         key=lambda x: x[0])
+            spool.extend(items=iter(["a3"]), key=lambda x: x[0])
+            self.assertTrue(os.path.isfile(spool.db_path))
+            self.assertEqual(["b", "a", "c"], list(spool.counts))
+            self.assertEqual(["a1", "a2", "a3"], spool.get(key="a"))
+            self.assertEqual(["b1", "b2"], spool.get(key="b"))
+            self.assertEqual([], spool.get(key="d"))
+        self.assertFalse(os.path.exists(spool.db_path))
+
+    def test_read_through_caches_each_expanded_item(self):
+        """Should pass each item to func, and re-use each item's result."""
+        file_path = os.path.join(self.temp_dir.name, "batch.txt")
+        with open(file_path, mode="w", encoding="UTF-8") as f:
+            f.write("a b c")
+
+        def expand(path):
+            with open(path, encoding="UTF-8") as batch:
+                words = batch.read().split()
+            return ((x, path + "/" + x) for x in words)
+
+        read = list()
+
+        def func(item):
+            read.append(item)
+            return item.upper()
+
+        for expected_read in (["a", "b", "c"], []):
+            del read[:]
+            observed = list(cache.read_through(
+                func=func, file_paths=[file_path], cache_path=self.db_path,
+                table="t", expand=expand))
+            self.assertEqual(["A", "B", "C"], observed)
+            self.assertEqual(expected_read, read)
+        with cache.FileCache(db_path=self.db_path, table="t") as file_cache:
+            self.assertEqual(4, len(file_cache))
+            self.assertEqual("B", file_cache.get(file_path + "/b"))
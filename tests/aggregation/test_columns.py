@@ -0,0 +1,47 @@
+import unittest
+from collections import OrderedDict
+from odk_aggregation_tool.aggregation import columns
+
+
+class TestColumnarData(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [
+            OrderedDict([("a", "1"), ("b", "x")]),
+            OrderedDict([("c", "2"), ("a", None)]),
+            OrderedDict([("a", "3"), ("b", "y")])]
+        self.data = columns.as_columnar(xform_data=self.rows)
+
+    def test_iter_returns_rows_with_original_keys_in_order(self):
+        """Should give back each row as it was added."""
+        self.assertEqual(3, len(self.data))
+        self.assertEqual(self.rows, [x for x in self.data])
+        self.assertEqual(
+            list(self.rows[1].items()), list(self.data[1].items()))
+
+    def test_columns_fill_missing_values_with_none(self):
+        """Should hold a value per row in each column, None if missing."""
+        self.assertEqual(["1", None, "3"], self.data.column(name="a"))
+        self.assertEqual(["x", None, "y"], self.data.column(name="b"))
+        self.assertEqual([None, "2", None], self.data.column(name="c"))
+        self.assertEqual([None, None, None], self.data.column(name="d"))
+        self.assertEqual(2, len(self.data.layouts))
+
+    def test_iter_rows_returns_values_for_names(self):
+        """Should yield a tuple of the named values per row."""
+        observed = list(self.data.iter_rows(names=["c", "d", "a"]))
+        self.assertEqual(
+            [(None, None, "1"), ("2", None, None), (None, None, "3")],
+            observed)
+
+    def test_append_repeated_key_keeps_last_value_first_position(self):
+        """Should treat repeated keys the same as OrderedDict does."""
+        data = columns.ColumnarData()
+        data.append(keys=("a", "b", "a"), values=["1", "2", "3"])
+        self.assertEqual([("a", "3"), ("b", "2")], list(data[0].items()))
+
+    def test_convert_skips_none_values(self):
+        """Should replace values with the function result, except None."""
+        self.data.convert(name="a", func=int)
+        self.assertEqual([1, None, 3], self.data.column(name="a"))
+        self.assertEqual(1, self.data[0]["a"])
@@ -0,0 +1,95 @@
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import tracemalloc
+import unittest
+from tests.aggregation import FixturePaths
+from odk_aggregation_tool.aggregation import metrics, writers
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def test_nested_stage_time_is_not_counted_twice(self):
+        """Should count time in a nested stage for that stage only."""
+        run_metrics = metrics.RunMetrics()
+        with metrics.measure_stage(run_metrics, "outer") as stage:
+            stage["items"] += 2
+            with metrics.measure_stage(run_metrics, "inner"):
+                time.sleep(0.05)
+        outer, inner = run_metrics.stages["outer"], run_metrics.stages["inner"]
+        self.assertEqual(2, outer["items"])
+        self.assertLess(outer["seconds"], 0.05)
+        self.assertGreaterEqual(inner["seconds"], 0.05)
+
+    def test_measure_iter_counts_items(self):
+        """Should time getting each item, and count them."""
+        run_metrics = metrics.RunMetrics()
+        items = metrics.measure_iter(run_metrics, "items", range(5))
+        self.assertEqual([0, 1, 2, 3, 4], list(items))
+        self.assertEqual(5, run_metrics.stages["items"]["items"])
+
+    def test_measure_without_run_metrics_is_a_no_op(self):
+        """Should return the items as is, and still run the with body."""
+        items = [1, 2]
+        self.assertIs(items, metrics.measure_iter(None, "items", items))
+        with metrics.measure_stage(None, "stage") as stage:
+            stage["items"] += 1
+
+    def test_open_measured_counts_bytes_written(self):
+        """Should write the same content as open(), counting the bytes."""
+        run_metrics = metrics.RunMetrics()
+        file_path = os.path.join(self.temp_dir, "out.bin")
+        with metrics.open_measured(run_metrics, file_path, mode="wb") as out:
+            out.write(b"abc")
+            out.seek(0)
+            out.write(b"x")
+            out.seek(0, os.SEEK_END)
+        with open(file_path, mode="rb") as written:
+            self.assertEqual(b"xbc", written.read())
+        self.assertEqual(4, run_metrics.stages["write"]["items"])
+
+    def test_write_forms_measures_each_stage(self):
+        """Should record each stage, and write the summary as JSON."""
+        fixtures = FixturePaths()
+        run_metrics = metrics.RunMetrics()
+        writers.write_forms(
+            xlsform_path=fixtures.files["xlsforms"],
+            instances_path=fixtures.files["instances"],
+            output_path=self.temp_dir, run_metrics=run_metrics)
+        run_metrics.finish()
+        metrics_path = os.path.join(self.temp_dir, "metrics.json")
+        run_metrics.write(metrics_path=metrics_path)
+        with open(metrics_path, encoding="UTF-8") as metrics_file:
+            summary = json.load(metrics_file)
+        stages = {x["stage"]: x for x in summary["stages"]}
+        self.assertEqual(sorted(metrics.STAGES), sorted(stages.keys()))
+        self.assertEqual(2, stages["xlsforms"]["items"])
+        self.assertEqual(
+            stages["discovery"]["items"], stages["read"]["items"])
+        self.assertEqual(
+            stages["prepare"]["items"], stages["serialize"]["items"])
+        self.assertLessEqual(
+            sum(x["seconds"] for x in summary["stages"]), summary["seconds"])
+
+    def test_profile_stage_writes_profile_data(self):
+        """Should write cProfile stats and a tracemalloc snapshot."""
+        profile_path = os.path.join(self.temp_dir, "run.prepare")
+        run_metrics = metrics.RunMetrics(
+            profile_stage="prepare", profile_path=profile_path)
+        with metrics.measure_stage(run_metrics, "prepare"):
+            data = [str(x) for x in range(10000)]
+        run_metrics.finish()
+        self.assertFalse(tracemalloc.is_tracing())
+        stats = pstats.Stats(profile_path + ".prof")
+        self.assertLess(0, stats.total_calls)
+        snapshot = tracemalloc.Snapshot.load(profile_path + ".tracemalloc")
+        self.assertLess(0, len(snapshot.traces))
+        self.assertLess(0, run_metrics.stages["prepare"]["traced_peak_mb"])
+        del data
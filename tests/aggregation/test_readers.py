@@ -1,7 +1,12 @@
+import os
+import tempfile
 import unittest
+import zipfile
 from tests.aggregation import FixturePaths
 from odk_aggregation_tool.aggregation import readers
 from collections import OrderedDict
+import xlrd
+import xmltodict
 
 
 class TestODKInstanceAggregate(unittest.TestCase):
@@ -54,6 +59,44 @@ class TestODKInstanceAggregate(unittest.TestCase):
         observed = readers.flatten_dict_leaf_nodes(input_dict)
         self.assertDictEqual(OrderedDict(expected), observed)
 
+    def test_flatten_xml_same_as_flatten_dict_leaf_nodes(self):
+        """Should flatten XML the same as xmltodict then flattening."""
+        xml_data = '''<data id="f" version="1" xmlns:jr="http://x">
+            <a> 1 </a><g jr:template=""><b>2</b><c/></g><g><b>3</b>
+            <d>4</d></g><e k="v"/><f k="v">t</f><g><h>5</h></g></data>'''
+        paths = readers.find_files(
+            root_dir=self.fixtures.files["instances"], extension=".xml")
+        for xml in [xml_data, *map(readers.read_xml_file, paths)]:
+            expected = readers.flatten_dict_leaf_nodes(xmltodict.parse(xml))
+            observed = readers.flatten_xml(xml_data=xml)
+            self.assertEqual(list(expected.items()), list(observed.items()))
+
+    def test_find_files_with_threads_same_as_without(self):
+        """Should find the same files in the same order, with threads."""
+        root_dir = self.fixtures.dir
+        expected = list(readers.find_files(
+            root_dir=root_dir, extension=(".xml", ".xlsx")))
+        observed = list(readers.find_files(
+            root_dir=root_dir, extension=(".xml", ".xlsx"), threads=4))
+        self.assertEqual(expected, observed)
+        self.assertGreater(len(observed), 30)
+
+    def test_read_xlsform_data_matches_choices_by_list_name(self):
+        """Should give each select item the choices from its list."""
+        file_path = next(readers.find_files(
+            root_dir=self.xlsform_root, extension=".xlsx"))
+        workbook = xlrd.open_workbook(filename=file_path)
+        choices = readers.xlrd_sheet_to_list_of_dict(
+            workbook.sheet_by_name(sheet_name="choices"))
+        form_def = readers.read_xlsform_data(workbook=workbook)
+        selects = [x for x in form_def.values()
+                   if x.get("type", "").startswith("select")]
+        self.assertGreater(len(selects), 0)
+        for item in selects:
+            list_name = item["type"].split(" ")[1]
+            expected = [x for x in choices if x["list_name"] == list_name]
+            self.assertEqual(expected, item["choices"])
+
     def test_read_xlsform_definitions_handles_phony_xlsx(self):
         """Should not choke on invalid XLSX files."""
         logger_name = "odk_aggregation_tool.aggregation.readers"
@@ -69,3 +112,90 @@ class TestODKInstanceAggregate(unittest.TestCase):
             list(readers.read_xlsform_definitions(
                 root_dir=self.fixtures.files["xlsform_with_plain_xlsx"]))
         self.assertIn("required sheets for an XLSForm", logs.output[0])
+
+    def test_content_digest_same_for_same_content(self):
+        """Should return the same fixed size digest for the same content."""
+        first = readers.content_digest(data=self.read_xml[0][0])
+        again = readers.content_digest(data=self.read_xml[0][0])
+        other = readers.content_digest(data=self.read_xml[1][0])
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+        self.assertEqual(len(first), len(other))
+
+    def test_read_xml_data_same_digest_and_data_as_text(self):
+        """Should give the same digest and parsed data as reading text."""
+        xml = '<?xml version="1.0"?>\r\n<data id="f">\r\n<a>caf\u00e9' \
+              '\r\nb</a></data>'
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_path = os.path.join(temp_dir, "crlf.xml")
+            with open(file_path, mode="w", encoding="UTF-8",
+                      newline="") as f:
+                f.write(xml)
+            text = readers.read_xml_file(file_path=file_path)
+            data = readers.read_xml_data(file_path=file_path)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(readers.content_digest(data=text),
+                         readers.content_digest(data=data))
+        self.assertEqual(readers.flatten_xml(xml_data=text),
+                         readers.flatten_xml(xml_data=data))
+        self.assertEqual(text, readers.decode_xml(data=data))
+
+    def test_flatten_xml_data_uses_declared_encoding(self):
+        """Should decode XML data using the encoding it declares."""
+        xml = '<?xml version="1.0" encoding="{0}"?><data><a>caf\u00e9</a>' \
+              '</data>'
+        for encoding in ["ISO-8859-1", "UTF-16", "UTF-8"]:
+            data = xml.format(encoding).encode(encoding)
+            self.assertEqual(encoding, readers.xml_encoding(data=data))
+            observed = readers.flatten_xml(xml_data=data)
+            self.assertEqual("caf\u00e9", observed["a"])
+            self.assertEqual(xml.format(encoding),
+                             readers.decode_xml(data=data))
+
+    def test_read_archive_xml_data_zip_in_same_order_as_folder(self):
+        """Should read zip members in the order find_files finds them."""
+        names = ["a-b.xml", "a/c.xml", "a/b/d.xml", "a0.xml"]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            folder = os.path.join(temp_dir, "folder")
+            for name in names:
+                file_path = os.path.join(folder, *name.split("/"))
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, mode="wb") as f:
+                    f.write(b"<data/>")
+            zip_path = os.path.join(temp_dir, "batch.zip")
+            with zipfile.ZipFile(zip_path, mode="w") as archive:
+                for name in names:
+                    archive.writestr(name, b"<data/>")
+            expected = [os.path.relpath(x, folder) for x in
+                        readers.find_files(root_dir=folder, extension=".xml")]
+            observed = [os.path.relpath(x, zip_path) for _, x in
+                        readers.read_archive_xml_data(archive_path=zip_path)]
+        self.assertEqual(expected, observed)
+
+    def test_read_archive_xml_files_uses_declared_encoding(self):
+        """Should decode archived XML using the encoding it declares."""
+        xml = '<?xml version="1.0" encoding="ISO-8859-1"?><data><a>caf\u00e9' \
+              '</a></data>'
+        with tempfile.TemporaryDirectory() as temp_dir:
+            zip_path = os.path.join(temp_dir, "batch.zip")
+            with zipfile.ZipFile(zip_path, mode="w") as archive:
+                archive.writestr("latin.xml", xml.encode("ISO-8859-1"))
+            observed = list(readers.read_archive_xml_files(
+                archive_path=zip_path))
+        self.assertEqual([(xml, os.path.join(zip_path, "latin.xml"))],
+                         observed)
+
+    def test_read_xlsform_definitions_with_cache_reuses_definitions(self):
+        """Should return the same definitions, read from the cache."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_path = os.path.join(temp_dir, "cache.sqlite")
+            first = list(readers.read_xlsform_definitions(
+                root_dir=self.xlsform_root, cache_path=cache_path))
+            logger_name = "odk_aggregation_tool.aggregation"
+            with self.assertLogs(logger=logger_name, level="INFO") as logs:
+                second = list(readers.read_xlsform_definitions(
+                    root_dir=self.xlsform_root, cache_path=cache_path))
+        self.assertListEqual(self.read_xlsform, first)
+        self.assertListEqual(self.read_xlsform, second)
+        self.assertIn("Read 0 new or changed files, re-used cached data for "
+                      "3 files", logs.output[0])
@@ -0,0 +1,111 @@
+import unittest
+from tests.aggregation import FixturePaths
+from odk_aggregation_tool.aggregation import to_stata_xml, to_stata_dta
+import struct
+import tempfile
+
+
+class TestStataDTAWriter(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fixtures = FixturePaths()
+        cls.instances_root = cls.fixtures.files['instances']
+        cls.xlsform_root = cls.fixtures.files['xlsforms']
+
+    def write_forms(self, output_path, release=118):
+        """Write the fixture forms and return the form data and file paths."""
+        forms = to_stata_xml.iter_form_data(
+            xlsform_path=self.xlsform_root, instances_path=self.instances_root)
+        written = list()
+        for form_id, form_def, xform_data in forms:
+            write_path = to_stata_dta.write_stata_dta(
+                form_id=form_id, form_def=form_def, xform_data=xform_data,
+                output_path=output_path, release=release)
+            written.append((form_def, xform_data, write_path))
+        return written
+
+    def test_write_stata_dta_header_and_map(self):
+        """Should write the header counts, and a map pointing to sections."""
+        for release in [117, 118]:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                written = self.write_forms(output_path=temp_dir,
+                                           release=release)
+                form_def, xform_data, write_path = written[0]
+                with open(write_path, mode="rb") as f:
+                    content = f.read()
+            spec = to_stata_dta.dta_releases[release]
+            self.assertTrue(content.startswith(
+                "<stata_dta><header><release>{0}</release>"
+                "<byteorder>LSF</byteorder><K>".format(release).encode()))
+            k_at = content.index(b"<K>") + 3
+            nvar = struct.unpack_from("<H", content, k_at)[0]
+            self.assertEqual(len(form_def) - 1, nvar)
+            n_at = content.index(b"<N>") + 3
+            nobs = struct.unpack_from("<" + spec.nobs_fmt, content, n_at)[0]
+            self.assertEqual(len(xform_data), nobs)
+            map_at = content.index(b"<map>") + 5
+            offsets = struct.unpack_from("<14Q", content, map_at)
+            for name, offset in zip(to_stata_dta.MAP_SECTIONS, offsets):
+                if name == "eof":
+                    self.assertEqual(len(content), offset)
+                else:
+                    self.assertEqual("<{0}>".format(name).encode(),
+                                     content[offset:offset + len(name) + 2])
+
+    def test_write_stata_dta_data_rows_are_fixed_width(self):
+        """Should write one fixed width row per observation."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            written = self.write_forms(output_path=temp_dir)
+            for form_def, xform_data, write_path in written:
+                with open(write_path, mode="rb") as f:
+                    content = f.read()
+                stata_metadata = to_stata_xml.prepare_xlsform_metadata(
+                    form_id="", form_def=form_def, xform_data=xform_data,
+                    allow_strl=True)
+                variables = to_stata_dta.prepare_dta_variables(
+                    stata_metadata=stata_metadata)
+                row_struct, converters = to_stata_dta.prepare_row_format(
+                    variables=variables, strls=list(),
+                    spec=to_stata_dta.dta_releases[118])
+                start = content.index(b"<data>") + 6
+                end = content.index(b"</data>")
+                self.assertEqual(len(xform_data) * row_struct.size,
+                                 end - start)
+                first = row_struct.unpack_from(content, start)
+                names = [x["name"] for x in variables]
+                sid = xform_data[0]["sid"].encode()
+                self.assertEqual(sid, first[names.index("sid")].rstrip(b"\0"))
+
+    def test_numeric_converter_sets_invalid_values_to_missing(self):
+        """Should convert to numbers, with missing for invalid values."""
+        numeric = to_stata_dta.numeric_types["byte"]
+        convert = to_stata_dta.numeric_converter(
+            var_name="v", numeric=numeric)
+        self.assertEqual(5, convert("5"))
+        self.assertEqual(numeric.missing, convert(None))
+        logger_name = "odk_aggregation_tool.aggregation"
+        with self.assertLogs(logger=logger_name, level="WARNING") as logs:
+            self.assertEqual(numeric.missing, convert("1.5"))
+            self.assertEqual(numeric.missing, convert("101"))
+            self.assertEqual(numeric.missing, convert("abc"))
+        self.assertEqual(3, len(logs.output))
+
+    def test_fixed_text_truncates_at_whole_characters(self):
+        """Should not split a multi-byte character when truncating."""
+        observed = to_stata_dta.fixed_text("aé", "UTF-8", 3)
+        self.assertEqual(b"a\0\0", observed)
+        observed = to_stata_dta.fixed_text("aé", "UTF-8", 4)
+        self.assertEqual("aé\0".encode(), observed)
+
+    def test_strl_converter_collects_gso_records(self):
+        """Should return strL references, and add the values as GSOs."""
+        strls = list()
+        convert = to_stata_dta.strl_converter(
+            var_number=2, spec=to_stata_dta.dta_releases[118], strls=strls)
+        self.assertEqual(bytes(8), convert(None))
+        reference = struct.unpack("<Q", convert("abc"))[0]
+        self.assertEqual((2, 2), (reference & 0xFFFF, reference >> 16))
+        self.assertEqual(1, len(strls))
+        self.assertEqual(b"GSO" + struct.pack("<IQBI", 2, 2, 130, 4) +
+                         b"abc\0", strls[0])
@@ -0,0 +1,44 @@
+import unittest
+from odk_aggregation_tool.aggregation import stata_types
+
+
+class TestStataTypes(unittest.TestCase):
+
+    def test_infer_stata_types_smallest_numeric_types(self):
+        """Should return the smallest numeric type holding all values."""
+        xform_data = [
+            {"a": "1", "b": "-200", "c": "40000", "d": "1.5", "e": None},
+            {"a": "100", "b": "3.0", "c": None, "d": "2", "e": "abc"}]
+        types = {"a": "int", "b": "int", "c": "int", "d": "int", "e": "int"}
+        observed = stata_types.infer_stata_types(
+            xform_data=iter(xform_data), stata_types=types)
+        expected = {"a": "byte", "b": "int", "c": "long", "d": "double",
+                    "e": "byte"}
+        self.assertDictEqual(expected, observed)
+
+    def test_infer_stata_types_str_length_in_utf8_bytes(self):
+        """Should return strN for the longest value, counting UTF-8 bytes."""
+        xform_data = [{"a": "abc", "b": None}, {"a": "éé"}]
+        types = {"a": "str2045", "b": "str2045"}
+        observed = stata_types.infer_stata_types(
+            xform_data=xform_data, stata_types=types)
+        self.assertDictEqual({"a": "str4", "b": "str1"}, observed)
+
+    def test_infer_stata_types_all_empty_str_is_str1(self):
+        """Should return str1, not str0, if all the values are empty."""
+        xform_data = [{"a": ""}, {"a": ""}]
+        types = {"a": "str2045"}
+        observed = stata_types.infer_stata_types(
+            xform_data=xform_data, stata_types=types)
+        self.assertEqual("str1", observed["a"])
+
+    def test_infer_stata_types_long_str_strl_if_allowed(self):
+        """Should use strL for values over 2045 bytes, only if allowed."""
+        xform_data = [{"a": "x" * 2046}]
+        types = {"a": "str2045"}
+        observed = stata_types.infer_stata_types(
+            xform_data=xform_data, stata_types=types)
+        self.assertEqual("str2045", observed["a"])
+        observed = stata_types.infer_stata_types(
+            xform_data=xform_data, stata_types=types, allow_strl=True)
+        self.assertEqual("strL", observed["a"])
@@ -1,9 +1,18 @@
 import unittest
+from collections import OrderedDict
 from tests.aggregation import FixturePaths
-from odk_aggregation_tool.aggregation import to_stata_xml
+from odk_aggregation_tool.aggregation import cache, to_stata_xml
 from odk_aggregation_tool.gui.log_capturing_handler import CapturingHandler
 from operator import eq
+import operator
 import logging
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+import threading
+import xmltodict
 
 
 class TestStataXMLWriter(unittest.TestCase):
@@ -121,8 +130,10 @@ class TestStataXMLWriter(unittest.TestCase):
             instances_path=xforms_path)
         logger_name = "odk_aggregation_tool.aggregation"
         agg_logs = logging.getLogger(logger_name)
-        agg_logs.parent = None
+        agg_logs.propagate = False
+        self.addCleanup(setattr, agg_logs, "propagate", True)
         agg_capture = CapturingHandler(logger=agg_logs, name="test_dupes")
+        self.addCleanup(agg_logs.removeHandler, agg_capture)
         observed = to_stata_xml.remove_duplicate_instances(
             instances=instances)
         self.assertEqual(0, len(agg_capture.watcher.output))
@@ -187,6 +198,32 @@ class TestStataXMLWriter(unittest.TestCase):
         self.assertEqual("-5392", var_ds[0])
         self.assertEqual("18494", var_ds[1])
 
+    def test_prepare_xform_data_handles_different_key_layouts(self):
+        """Should prepare each instance by its own keys, if they differ."""
+        form_def = OrderedDict([
+            ("@settings", OrderedDict()),
+            ("a", OrderedDict([("name", "a"), ("type", "date")])),
+            ("b", OrderedDict([("name", "b"), ("type", "text")]))])
+        instances = [
+            OrderedDict([("a", "1960-01-02"), ("b", "x")]),
+            OrderedDict([("b", "y"), ("c-1", "z"), ("a", "1959-12-31")]),
+            OrderedDict([("d", None), ("a", None)]),
+            OrderedDict([("a", "1960-01-02"), ("b", "x")])]
+        xform_data, unknown_vars = to_stata_xml.prepare_xform_data(
+            xform_instances=instances, form_def=form_def)
+        self.assertEqual(
+            [[("a", "1"), ("b", "x")],
+             [("b", "y"), ("c1", "z"), ("a", "-1")],
+             [("d", None), ("a", None), ("b", None)],
+             [("a", "1"), ("b", "x")]],
+            [list(x.items()) for x in xform_data])
+        self.assertEqual(["c1"], unknown_vars)
+        observations = to_stata_xml.prepare_observations(
+            xform_data=xform_data, form_def=form_def)
+        self.assertEqual(
+            [["a", "b"], ["b", "a"], ["a", "b"], ["a", "b"]],
+            [[v["@varname"] for v in x["v"]] for x in observations])
+
     def test_prepare_observations_includes_id_and_version_values(self):
         """Should include form_id and form_version in observation data."""
         xlsform_path = self.fixtures.files["xlsform_unknown_variable"]
@@ -205,3 +242,222 @@ class TestStataXMLWriter(unittest.TestCase):
         self.assertIn("id", output_keys)
         self.assertIn("version", output_keys)
 
+    def test_collate_xform_instances_parallel_same_as_serial(self):
+        """Should return the same data in the same order using a pool."""
+        serial = to_stata_xml.collate_xform_instances(
+            instances_path=self.instances_root)
+        parallel = to_stata_xml.collate_xform_instances(
+            instances_path=self.instances_root, workers=2, chunk_size=4)
+        self.assertEqual(15, len(parallel))
+        self.assertListEqual(serial, parallel)
+
+    def test_iter_chunks_yields_all_items_in_order(self):
+        """Should yield lists of up to chunk_size items, in original order."""
+        observed = list(to_stata_xml.iter_chunks(
+            iterable=iter(range(7)), chunk_size=3))
+        self.assertListEqual([[0, 1, 2], [3, 4, 5], [6]], observed)
+
+    def test_map_in_thread_pool_yields_results_in_order(self):
+        """Should yield func results in item order, reading ahead a bit."""
+        submitted = list()
+
+        def items():
+            for i in range(10):
+                submitted.append(i)
+                yield i
+
+        results = to_stata_xml.map_in_thread_pool(
+            func=str, iterable=items(), threads=3, read_ahead=4)
+        self.assertEqual("0", next(results))
+        self.assertEqual(4, len(submitted))
+        self.assertEqual([str(x) for x in range(1, 10)], list(results))
+
+    def test_partition_instances_drops_unknown_form_ids(self):
+        """Should list instances per form_id, without unrequested form_ids."""
+        instances = iter([{"@id": "a", "n": 1}, {"@id": "b", "n": 2},
+                          {"@id": "a", "n": 3}])
+        observed = to_stata_xml.partition_instances(
+            instances=instances, form_ids=["a", "c"])
+        self.assertEqual(["a", "c"], list(observed))
+        self.assertEqual([1, 3], [x["n"] for x in observed["a"]])
+        self.assertEqual([], observed["c"])
+
+    def test_iter_stata_docs_yields_a_doc_per_form_id(self):
+        """Should lazily yield a Stata XML document for each form_id."""
+        docs = to_stata_xml.iter_stata_docs(
+            xlsform_path=self.xlsform_root, instances_path=self.instances_root)
+        observed = [form_id for form_id, document in docs]
+        self.assertEqual(["Q1302_BEHAVE", "R1302_BEHAVE"], observed)
+
+    def test_iter_form_data_stops_between_forms_when_cancelled(self):
+        """Should raise AggregationCancelled at the next step once set."""
+        cancel = threading.Event()
+        forms = to_stata_xml.iter_form_data(
+            xlsform_path=self.xlsform_root, instances_path=self.instances_root,
+            cancel=cancel)
+        form_id, form_def, xform_data = next(forms)
+        self.assertEqual("Q1302_BEHAVE", form_id)
+        cancel.set()
+        with self.assertRaises(to_stata_xml.AggregationCancelled):
+            next(forms)
+
+    def test_collate_xform_instances_reads_zip_and_tar_archives(self):
+        """Should read instances from archives the same as from files."""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        zip_path = shutil.make_archive(
+            base_name=os.path.join(temp_dir, "a", "batch"), format="zip",
+            root_dir=self.instances_root)
+        tar_path = shutil.make_archive(
+            base_name=os.path.join(temp_dir, "b", "batch"), format="gztar",
+            root_dir=self.instances_root)
+        expected = to_stata_xml.collate_xform_instances(
+            instances_path=self.instances_root)
+        for path in (zip_path, tar_path, temp_dir):
+            observed = to_stata_xml.collate_xform_instances(
+                instances_path=path, workers=2)
+            self.assertTrue(all(
+                x["_source_file"].startswith(zip_path) or
+                x["_source_file"].startswith(tar_path) for x in observed))
+            key = operator.itemgetter("_source_digest")
+            copies = 2 if path == temp_dir else 1
+            self.assertEqual(
+                sorted(list(map(key, expected)) * copies),
+                sorted(map(key, observed)))
+
+    def test_crlf_instance_has_same_digest_loose_and_in_archive(self):
+        """Should treat a CRLF file and its copy in a zip as duplicates."""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        source = os.path.join(
+            self.instances_root, "Q1302_BEHAVE_2015-02-27_07-49-24.xml")
+        with open(source, mode="rb") as f:
+            data = f.read().replace(b"><", b">\r\n<")
+        with open(os.path.join(temp_dir, "loose.xml"), mode="wb") as f:
+            f.write(data)
+        with zipfile.ZipFile(os.path.join(temp_dir, "batch.zip"),
+                             mode="w") as archive:
+            archive.writestr("zipped.xml", data)
+        instances = to_stata_xml.collate_xform_instances(
+            instances_path=temp_dir)
+        self.assertEqual(2, len(instances))
+        self.assertEqual(instances[0]["_source_digest"],
+                         instances[1]["_source_digest"])
+        self.assertEqual(1, len(to_stata_xml.remove_duplicate_instances(
+            instances=instances)))
+
+    def test_collate_xform_instances_keeps_digest_not_source_xml(self):
+        """Should include a content digest, and only keep XML if requested."""
+        instances_path = self.fixtures.files["instances_duplicates"]
+        instances = to_stata_xml.collate_xform_instances(
+            instances_path=instances_path)
+        self.assertTrue(all(len(x["_source_digest"]) == 40 for x in instances))
+        self.assertFalse(any("_source_xml" in x for x in instances))
+        kept = to_stata_xml.collate_xform_instances(
+            instances_path=instances_path, keep_source_xml=True)
+        self.assertTrue(all(x["_source_xml"].startswith("<") for x in kept))
+
+    def test_iter_unique_instances_keeps_first_seen_order(self):
+        """Should keep the first of each duplicate, and list all their paths."""
+        instances = [{"_source_digest": d, "_source_file": f} for d, f in
+                     [("b", "1"), ("a", "2"), ("b", "3"), ("a", "4"),
+                      ("c", "5"), ("b", "6")]]
+        logger_name = "odk_aggregation_tool.aggregation"
+        with self.assertLogs(logger=logger_name, level="WARNING") as logs:
+            observed = list(to_stata_xml.iter_unique_instances(
+                instances=iter(instances)))
+        self.assertEqual(["1", "2", "5"], [x["_source_file"] for x in observed])
+        self.assertEqual(2, len(logs.output))
+        self.assertIn("Duplicates found: 3,\nSource files:\n1\n3\n6",
+                      logs.output[0])
+        self.assertIn("Duplicates found: 2,\nSource files:\n2\n4",
+                      logs.output[1])
+
+    def test_partition_without_keys_lists_keys_in_order_found(self):
+        """Should list items per key, in the order each key was first found."""
+        observed = to_stata_xml.partition(
+            items=iter(["b1", "a1", "b2", "c1", "a2"]), key=lambda x: x[0])
+        self.assertEqual(["b", "a", "c"], list(observed))
+        self.assertEqual(["b1", "b2"], observed["b"])
+        self.assertEqual(["a1", "a2"], observed["a"])
+
+    def test_collate_xform_instances_cache_reads_only_changed_files(self):
+        """Should re-use cached data, and drop data for deleted files."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            instances_path = os.path.join(temp_dir, "instances")
+            shutil.copytree(self.instances_root, instances_path)
+            cache_path = os.path.join(temp_dir, "cache.sqlite")
+            expected = to_stata_xml.collate_xform_instances(
+                instances_path=instances_path)
+            first = to_stata_xml.collate_xform_instances(
+                instances_path=instances_path, cache_path=cache_path)
+            self.assertListEqual(expected, first)
+            os.remove(first[0]["_source_file"])
+            logger_name = "odk_aggregation_tool.aggregation"
+            with self.assertLogs(logger=logger_name, level="INFO") as logs:
+                second = to_stata_xml.collate_xform_instances(
+                    instances_path=instances_path, cache_path=cache_path,
+                    workers=2, chunk_size=4)
+        self.assertListEqual(expected[1:], second)
+        self.assertIn("Read 0 new or changed files, re-used cached data for "
+                      "14 files, and removed cached data for 1 files",
+                      "\n".join(logs.output))
+
+    def test_collate_xform_instances_cache_keeps_each_archive_member(self):
+        """Should cache each file in an archive, and re-use them all."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            zip_path = shutil.make_archive(
+                base_name=os.path.join(temp_dir, "batch"), format="zip",
+                root_dir=self.instances_root)
+            cache_path = os.path.join(temp_dir, "cache.sqlite")
+            expected = to_stata_xml.collate_xform_instances(
+                instances_path=zip_path)
+            first = to_stata_xml.collate_xform_instances(
+                instances_path=zip_path, cache_path=cache_path, workers=2)
+            logger_name = "odk_aggregation_tool.aggregation"
+            with self.assertLogs(logger=logger_name, level="INFO") as logs:
+                second = to_stata_xml.collate_xform_instances(
+                    instances_path=zip_path, cache_path=cache_path)
+            with cache.FileCache(db_path=cache_path,
+                                 table="instances") as file_cache:
+                cached = len(file_cache)
+        self.assertListEqual(expected, first)
+        self.assertListEqual(expected, second)
+        self.assertEqual(len(expected) + 1, cached)
+        self.assertIn("Read 0 new or changed files, re-used cached data for "
+                      "{0} files".format(len(expected)),
+                      "\n".join(logs.output))
+
+    def test_write_stata_xml_same_as_unparsed_stata_doc(self):
+        """Should stream the same output as unparsing the whole document."""
+        forms = to_stata_xml.iter_form_data(
+            xlsform_path=self.xlsform_root, instances_path=self.instances_root)
+        time_stamp = re.compile("<time_stamp>.*?</time_stamp>")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for form_id, form_def, xform_data in forms:
+                expected = xmltodict.unparse(to_stata_xml.prepare_stata_doc(
+                    form_id=form_id, form_def=form_def, xform_data=xform_data))
+                write_path = to_stata_xml.write_stata_xml(
+                    form_id=form_id, form_def=form_def, xform_data=xform_data,
+                    output_path=temp_dir)
+                with open(write_path, mode="r", encoding="UTF-8") as f:
+                    observed = f.read()
+                self.assertIn("<o><v varname=", observed)
+                self.assertEqual(time_stamp.sub("", expected),
+                                 time_stamp.sub("", observed))
+
+    def test_prepare_xlsform_metadata_with_data_narrows_types(self):
+        """Should use the smallest types that hold the data, if given."""
+        xlsform_path = self.fixtures.files["xlsform_date_variable"]
+        form_def = to_stata_xml.collate_xlsforms_by_form_id(
+            xlsform_path=xlsform_path)["xlsform"]
+        raw_data = to_stata_xml.collate_xform_instances(
+            instances_path=xlsform_path)
+        xform_data, unknown_vars = to_stata_xml.prepare_xform_data(
+            xform_instances=raw_data, form_def=form_def)
+        observed = to_stata_xml.prepare_xlsform_metadata(
+            form_id="xlsform", form_def=form_def, xform_data=xform_data)
+        var_types = {x["@varname"]: x["#text"] for x in observed["var_types"]}
+        self.assertEqual("int", var_types["var_d"])
+        self.assertNotEqual("str2045", var_types["var_t"])
+        self.assertTrue(var_types["var_t"].startswith("str"))
@@ -0,0 +1,110 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from tests.aggregation import FixturePaths
+from odk_aggregation_tool.aggregation import watch, writers
+
+
+TIME_STAMP = re.compile("<time_stamp>.*?</time_stamp>")
+
+
+class TestFormWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = FixturePaths()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.xlsforms = os.path.join(self.temp_dir, "xlsforms")
+        self.instances = os.path.join(self.temp_dir, "instances")
+        self.output_path = os.path.join(self.temp_dir, "output")
+        shutil.copytree(self.fixtures.files["xlsforms"], self.xlsforms)
+        os.makedirs(self.instances)
+        os.makedirs(self.output_path)
+        self.source = self.fixtures.files["instances"]
+        self.add_instance("site_A/Q1302_BEHAVE_2015-02-12_14-27-58.xml")
+        self.add_instance("site_A/R1302_BEHAVE_2015-02-18_10-05-55.xml")
+        self.watcher = watch.FormWatcher(
+            xlsform_path=self.xlsforms, instances_path=self.instances,
+            output_path=self.output_path, debounce=0)
+
+    def add_instance(self, name):
+        dest = os.path.join(self.instances, name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy(os.path.join(self.source, name), dest)
+        return dest
+
+    def poll(self, **kwargs):
+        return sorted(os.path.basename(x)
+                      for x in self.watcher.poll(**kwargs))
+
+    def assert_same_as_full_run(self):
+        """Should have the same output as writing out all the forms."""
+        full_path = os.path.join(self.temp_dir, "full")
+        os.makedirs(full_path)
+        writers.write_forms(
+            xlsform_path=self.xlsforms, instances_path=self.instances,
+            output_path=full_path)
+        for name in sorted(os.listdir(full_path)):
+            with open(os.path.join(full_path, name), encoding="UTF-8") as f:
+                expected = TIME_STAMP.sub("", f.read())
+            with open(os.path.join(self.output_path, name),
+                      encoding="UTF-8") as f:
+                observed = TIME_STAMP.sub("", f.read())
+            self.assertEqual(expected, observed)
+
+    def test_first_poll_writes_all_forms(self):
+        """Should write every form, then nothing until files change."""
+        self.assertEqual(
+            ["Q1302_BEHAVE.xml", "R1302_BEHAVE.xml"], self.poll())
+        self.assertEqual([], self.poll())
+        self.assert_same_as_full_run()
+
+    def test_new_instance_rewrites_only_its_form(self):
+        """Should read the new file, and write out only its form."""
+        self.poll()
+        self.add_instance("site_A/Q1302_BEHAVE_2015-02-26_15-41-23.xml")
+        self.assertEqual(["Q1302_BEHAVE.xml"], self.poll())
+        self.assertEqual(3, len(self.watcher.instances))
+        self.assert_same_as_full_run()
+
+    def test_removed_instance_rewrites_its_form(self):
+        """Should drop the removed file's data, and write out its form."""
+        self.poll()
+        os.remove(os.path.join(
+            self.instances, "site_A/R1302_BEHAVE_2015-02-18_10-05-55.xml"))
+        self.assertEqual(["R1302_BEHAVE.xml"], self.poll())
+        self.assert_same_as_full_run()
+
+    def test_changes_wait_for_debounce(self):
+        """Should only update once the files have stayed the same a while."""
+        self.watcher.debounce = 5
+        self.assertEqual([], self.poll(now=0))
+        self.add_instance("site_A/Q1302_BEHAVE_2015-02-26_15-41-23.xml")
+        self.assertEqual([], self.poll(now=3))
+        self.assertEqual([], self.poll(now=7))
+        self.assertEqual(
+            ["Q1302_BEHAVE.xml", "R1302_BEHAVE.xml"], self.poll(now=8))
+
+    def test_new_xlsform_writes_its_form(self):
+        """Should write out a form once its XLSForm is added."""
+        r_xlsform = os.path.join(self.xlsforms, "v1", "R1302_BEHAVE.xlsx")
+        moved = os.path.join(self.temp_dir, "R1302_BEHAVE.xlsx")
+        shutil.move(r_xlsform, moved)
+        self.assertEqual(["Q1302_BEHAVE.xml"], self.poll())
+        shutil.move(moved, r_xlsform)
+        self.assertEqual(["R1302_BEHAVE.xml"], self.poll())
+        self.assert_same_as_full_run()
+
+    def test_failed_read_is_tried_again(self):
+        """Should keep the last good state if a file can't be read."""
+        self.poll()
+        broken = os.path.join(self.instances, "broken.xml")
+        with open(broken, mode="w", encoding="UTF-8") as f:
+            f.write("<Q1302_BEHAVE id=")
+        with self.assertRaises(Exception):
+            self.watcher.poll()
+        self.assertEqual(2, len(self.watcher.instances))
+        os.remove(broken)
+        self.assertEqual([], self.poll())
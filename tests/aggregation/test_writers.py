@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+from tests.aggregation import FixturePaths
+from odk_aggregation_tool.aggregation import writers, metrics
+
+
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = FixturePaths()
+        self.output_paths = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        for path in self.output_paths:
+            self.addCleanup(shutil.rmtree, path)
+
+    def write_forms(self, output_path, form_workers):
+        logger_name = "odk_aggregation_tool.aggregation"
+        with self.assertLogs(logger=logger_name, level="INFO") as logs:
+            written = writers.write_forms(
+                xlsform_path=self.fixtures.files["xlsforms"],
+                instances_path=self.fixtures.files["instances"],
+                output_path=output_path, output_format_name="dta",
+                form_workers=form_workers)
+        messages = [x.replace(output_path, "") for x in logs.output]
+        return written, messages
+
+    def test_write_forms_in_process_pool_same_as_serial(self):
+        """Should write the same files, and log the same messages in order."""
+        serial, serial_logs = self.write_forms(
+            output_path=self.output_paths[0], form_workers=1)
+        pooled, pooled_logs = self.write_forms(
+            output_path=self.output_paths[1], form_workers=2)
+        self.assertEqual(
+            [os.path.basename(x) for x in serial],
+            [os.path.basename(x) for x in pooled])
+        self.assertEqual(
+            ["Q1302_BEHAVE.dta", "R1302_BEHAVE.dta"],
+            sorted(os.listdir(self.output_paths[1])))
+        self.assertEqual(serial_logs, pooled_logs)
+        self.assertIn("Wrote form data for form_id: R1302_BEHAVE",
+                      pooled_logs[-1])
+
+    def test_write_forms_in_process_pool_adds_worker_metrics(self):
+        """Should add up the stage metrics sent back by the workers."""
+        run_metrics = metrics.RunMetrics()
+        writers.write_forms(
+            xlsform_path=self.fixtures.files["xlsforms"],
+            instances_path=self.fixtures.files["instances"],
+            output_path=self.output_paths[0], output_format_name="dta",
+            form_workers=2, run_metrics=run_metrics)
+        for stage in ("prepare", "serialize", "write"):
+            self.assertLess(0, run_metrics.stages[stage]["items"])
+        self.assertEqual(run_metrics.stages["partition"]["items"],
+                         run_metrics.stages["prepare"]["items"])
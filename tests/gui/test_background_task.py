@@ -0,0 +1,40 @@
+from odk_aggregation_tool.gui.background_task import BackgroundTask
+import logging
+import unittest
+
+
+def logging_task(cancel, count):
+    """Log some messages, then return whether the task was cancelled."""
+    task_logger = logging.getLogger("test_background_task")
+    task_logger.setLevel("INFO")
+    for i in range(count):
+        task_logger.info("Message {0}".format(i))
+    return cancel.is_set()
+
+
+class TestBackgroundTask(unittest.TestCase):
+
+    def run_task(self, task):
+        task.start()
+        task.thread.join(timeout=10)
+        return task.read_messages()
+
+    def test_read_messages_collects_logs_and_result(self):
+        """Should return the task's log messages in order, and the result."""
+        task = BackgroundTask(
+            func=logging_task, logger_name="test_background_task", count=3)
+        messages, done = self.run_task(task)
+        self.assertTrue(done)
+        self.assertEqual(["Message 0", "Message 1", "Message 2"], messages)
+        self.assertFalse(task.result)
+        self.assertNotIn(task.handler, task.logger.handlers)
+
+    def test_cancel_sets_event_passed_to_task(self):
+        """Should pass the cancel event to the task function."""
+        task = BackgroundTask(
+            func=logging_task, logger_name="test_background_task", count=0)
+        task.cancel()
+        messages, done = self.run_task(task)
+        self.assertTrue(done)
+        self.assertTrue(task.result)
+        self.assertFalse(task.is_running())
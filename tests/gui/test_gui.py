@@ -0,0 +1,14 @@
+from odk_aggregation_tool.gui.gui import ODKToolsGui
+import sys
+import unittest
+
+
+class TestODKToolsGui(unittest.TestCase):
+
+    def test_warm_imports_imports_aggregation_stata(self):
+        """Should import the task module on a background thread."""
+        thread = ODKToolsGui.warm_imports()
+        thread.join(timeout=30)
+        self.assertFalse(thread.is_alive())
+        self.assertIn("odk_aggregation_tool.gui.wrappers.aggregation_stata",
+                      sys.modules)
@@ -1,6 +1,10 @@
 import unittest
 import logging
-from odk_aggregation_tool.gui.log_capturing_handler import CapturingHandler
+import os
+import shutil
+import tempfile
+from odk_aggregation_tool.gui.log_capturing_handler import CapturingHandler, \
+    StreamingLogHandler
 
 test_logger = logging.getLogger(__name__)
 test_logger.addHandler(logging.NullHandler())
@@ -28,3 +32,57 @@ class TestCapturingHandler(unittest.TestCase):
         self.assertIn(message, capture.watcher.output[0])
         self.assertIn(capture, test_logger.handlers)
         self.assertEqual(2, len(test_logger.handlers))
+
+
+class TestStreamingLogHandler(unittest.TestCase):
+    """Tests for the StreamingLogHandler class."""
+
+    def setUp(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.log_path = os.path.join(temp_dir, "log.txt")
+
+    def capture(self, **kwargs):
+        handler = StreamingLogHandler(
+            logger=test_logger, log_path=self.log_path, name="streaming",
+            **kwargs)
+        self.addCleanup(handler.close)
+        self.addCleanup(test_logger.removeHandler, handler)
+        return handler
+
+    def read_log(self):
+        with open(self.log_path, encoding="UTF-8") as log_file:
+            return log_file.read().splitlines()
+
+    def test_streaming_handler_writes_all_messages_to_file(self):
+        """Should write every message to the file, keeping only the last."""
+        handler = self.capture(max_messages=2)
+        for i in range(5):
+            test_logger.info("message {0}".format(i))
+        handler.flush()
+        self.assertEqual(
+            ["message {0}".format(i) for i in range(5)], self.read_log())
+        self.assertEqual(["message 3", "message 4"], list(handler.messages))
+        self.assertEqual(
+            ["3 earlier messages are not shown here.",
+             "Log message counts: INFO: 5."], handler.summary())
+
+    def test_streaming_handler_collapses_repeated_warnings(self):
+        """Should keep the first few of each kind of warning, and count."""
+        handler = self.capture(max_repeats=2)
+        for i in range(4):
+            test_logger.warning(
+                "Found duplicate XML files. File: {0}".format(i))
+        test_logger.warning("Truncated a value for variable: x")
+        test_logger.info("Done.")
+        handler.close()
+        self.assertEqual(6, len(self.read_log()))
+        self.assertEqual(
+            ["Found duplicate XML files. File: 0",
+             "Found duplicate XML files. File: 1",
+             "Truncated a value for variable: x", "Done."],
+            list(handler.messages))
+        self.assertEqual(
+            ["2 more warnings are not shown here, like: "
+             "Found duplicate XML files",
+             "Log message counts: WARNING: 5, INFO: 1."], handler.summary())
@@ -1,5 +1,9 @@
 from tests.aggregation import FixturePaths
 from odk_aggregation_tool.gui.wrappers import aggregation_stata
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 from unittest.mock import MagicMock, patch
 
@@ -8,18 +12,77 @@ class TestAggregateStata(unittest.TestCase):
 
     def setUp(self):
         self.fixtures = FixturePaths()
+        self.output_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_path)
 
     def test_run_generate_images_captures_normal_logs(self):
         """Should capture normal info logs."""
         xlsforms_path = self.fixtures.files["xlsforms"]
         xforms_path = self.fixtures.files["instances"]
-        output_path = self.fixtures.dir
+        output_path = self.output_path
 
         mock_write = 'odk_aggregation_tool.aggregation' \
-                     '.to_stata_xml.write_stata_docs'
+                     '.writers.write_form_data'
         with patch(mock_write, MagicMock()):
             observed = aggregation_stata.wrapper(
                 xlsforms_path=xlsforms_path, xforms_path=xforms_path,
                 output_path=output_path)
         expected = "Collecting data for"
         self.assertIn(expected, observed)
+
+    def test_run_dta_output_format_names_format_in_header(self):
+        """Should run the task with the DTA writer, and say so."""
+        mock_write = 'odk_aggregation_tool.aggregation' \
+                     '.writers.write_form_data'
+        with patch(mock_write, MagicMock()) as mock:
+            observed = aggregation_stata.wrapper(
+                xlsforms_path=self.fixtures.files["xlsforms"],
+                xforms_path=self.fixtures.files["instances"],
+                output_path=self.output_path, output_format="dta")
+        self.assertIn("Aggregation to Stata DTA task was run", observed)
+        self.assertEqual("dta", mock.call_args[1]["output_format_name"])
+
+    def test_run_cancelled_says_so_in_result(self):
+        """Should stop before writing anything, and say it was cancelled."""
+        cancel = threading.Event()
+        cancel.set()
+        mock_write = 'odk_aggregation_tool.aggregation' \
+                     '.writers.write_form_data'
+        with patch(mock_write, MagicMock()) as mock:
+            observed = aggregation_stata.wrapper(
+                xlsforms_path=self.fixtures.files["xlsforms"],
+                xforms_path=self.fixtures.files["instances"],
+                output_path=self.output_path, cancel=cancel)
+        self.assertIn("Aggregation to Stata XML task was cancelled", observed)
+        self.assertFalse(mock.called)
+
+    def test_run_writes_all_logs_to_file_and_summarises(self):
+        """Should write the logs to log.txt, and collapse repeat warnings."""
+        mock_write = 'odk_aggregation_tool.aggregation' \
+                     '.writers.write_form_data'
+        with patch(mock_write, MagicMock()):
+            observed = aggregation_stata.wrapper(
+                xlsforms_path=self.fixtures.files["xlsforms"],
+                xforms_path=self.fixtures.files["instances_duplicates"],
+                output_path=self.output_path)
+        log_path = os.path.join(self.output_path, "log.txt")
+        with open(log_path, encoding="UTF-8") as log_file:
+            log_text = log_file.read()
+        self.assertIn("Found duplicate XML files", log_text)
+        self.assertIn("Collecting data for", log_text)
+        self.assertIn("Log message counts: INFO:", observed)
+        self.assertIn("written to a file at: {0}".format(log_path), observed)
+
+    def test_run_reads_instances_from_an_archive(self):
+        """Should accept a zip of XForm data files as the XForm data path."""
+        zip_path = shutil.make_archive(
+            base_name=os.path.join(self.output_path, "instances"),
+            format="zip", root_dir=self.fixtures.files["instances"])
+        mock_write = 'odk_aggregation_tool.aggregation' \
+                     '.writers.write_form_data'
+        with patch(mock_write, MagicMock()) as mock:
+            observed = aggregation_stata.wrapper(
+                xlsforms_path=self.fixtures.files["xlsforms"],
+                xforms_path=zip_path, output_path=self.output_path)
+        self.assertNotIn("Input Error", observed)
+        self.assertEqual(2, mock.call_count)
@@ -0,0 +1,70 @@
+from benchmarks import corpus, run, startup
+from odk_aggregation_tool.aggregation import readers, to_stata_xml, metrics
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.spec = corpus.DEFAULT_SPEC._replace(
+            instances=40, duplicates=0.25, repeats=2, depth=3)
+
+    def test_generated_corpus_is_readable(self):
+        """Should generate XLSForms and instances that aggregate cleanly."""
+        paths = corpus.generate_corpus(root_dir=self.temp_dir, spec=self.spec)
+        form_defs = to_stata_xml.collate_xlsforms_by_form_id(
+            xlsform_path=paths["xlsforms"])
+        self.assertEqual(["FORM_0", "FORM_1"], list(form_defs.keys()))
+        files = list(readers.find_instance_files(path=paths["instances"]))
+        self.assertLess(40, len(files))
+        instances = list(to_stata_xml.iter_unique_instances(
+            instances=to_stata_xml.iter_xform_instances(
+                instances_path=paths["instances"])))
+        self.assertEqual(40, len(instances))
+        forms = dict(to_stata_xml.to_stata_xml(
+            xlsform_path=paths["xlsforms"],
+            instances_path=paths["instances"]))
+        self.assertIn('<variable varname="var_20"', forms["FORM_0"])
+        self.assertIn('<vallab name="var_2_choices"', forms["FORM_0"])
+
+    def test_main_saves_and_compares_results(self):
+        """Should append a result per run, comparing with the last one."""
+        results_path = os.path.join(self.temp_dir, "results.jsonl")
+        args = ["--instances", "20", "--results", results_path,
+                "--corpus-dir", os.path.join(self.temp_dir, "corpus")]
+        for _ in range(2):
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                self.assertEqual(0, run.main(args))
+        self.assertIn("Compared with the run at", stdout.getvalue())
+        with open(results_path, encoding="UTF-8") as results_file:
+            results = [json.loads(x) for x in results_file]
+        self.assertEqual(2, len(results))
+        self.assertEqual(
+            metrics.STAGES, [x["stage"] for x in results[1]["stages"]])
+        self.assertEqual(20, results[1]["files"])
+
+    def test_gui_starts_without_aggregation_modules(self):
+        """Should import the GUI without the modules a task needs."""
+        summary = startup.measure_startup(runs=1)
+        self.assertEqual([], summary["deferred_modules"])
+        self.assertLess(0, summary["import_ms"])
+        self.assertIn("tkinter", summary["slowest"])
+
+    def test_startup_main_saves_and_compares_results(self):
+        """Should append a startup result, and compare with the last one."""
+        results_path = os.path.join(self.temp_dir, "results.jsonl")
+        for _ in range(2):
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                self.assertEqual(0, startup.main(
+                    ["--runs", "1", "--results", results_path]))
+        self.assertIn("Compared with the run at", stdout.getvalue())
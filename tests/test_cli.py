@@ -0,0 +1,123 @@
+from tests.aggregation import FixturePaths
+from odk_aggregation_tool import cli
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.fixtures = FixturePaths()
+        self.output_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_path)
+
+    def run_main(self, *args):
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            try:
+                code = cli.main([
+                    self.fixtures.files["xlsforms"],
+                    self.fixtures.files["instances"],
+                    self.output_path, *args])
+            except SystemExit as e:
+                code = e.code
+        return code, stderr.getvalue()
+
+    def test_main_writes_output_files_and_returns_zero(self):
+        """Should write a file per form in the chosen format, and return 0."""
+        code, output = self.run_main("--format", "dta")
+        self.assertEqual(0, code)
+        self.assertEqual(
+            ["Q1302_BEHAVE.dta", "R1302_BEHAVE.dta"],
+            sorted(os.listdir(self.output_path)))
+        self.assertIn("Aggregation completed, wrote 2 files.", output)
+
+    def test_main_with_cache_creates_cache_file(self):
+        """Should keep parsed data in the cache file, if one is given."""
+        cache_path = os.path.join(self.output_path, "cache.sqlite")
+        code, output = self.run_main(
+            "--cache", cache_path, "--clear-cache", "--workers", "2")
+        self.assertEqual(0, code)
+        self.assertTrue(os.path.isfile(cache_path))
+
+    def test_main_with_metrics_writes_metrics_and_profile_files(self):
+        """Should write the stage metrics, and profile data for a stage."""
+        metrics_path = os.path.join(self.output_path, "run.json")
+        code, output = self.run_main(
+            "--metrics", metrics_path, "--profile-stage", "read")
+        self.assertEqual(0, code)
+        with open(metrics_path, encoding="UTF-8") as metrics_file:
+            summary = json.load(metrics_file)
+        self.assertEqual("read", summary["profile_stage"])
+        self.assertIn("read", [x["stage"] for x in summary["stages"]])
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.output_path, "run.read.prof")))
+
+    def test_main_profile_stage_requires_metrics(self):
+        """Should exit with usage code 2 if --metrics is missing."""
+        code, output = self.run_main("--profile-stage", "read")
+        self.assertEqual(2, code)
+        self.assertIn("--profile-stage requires --metrics", output)
+
+    def test_main_returns_non_zero_on_failure(self):
+        """Should log the error and return 1 if the task fails."""
+        with patch("odk_aggregation_tool.cli.run", MagicMock(
+                side_effect=OSError("boom"))):
+            code, output = self.run_main()
+        self.assertEqual(1, code)
+        self.assertIn("boom", output)
+
+    def test_main_returns_2_for_invalid_arguments(self):
+        """Should exit with usage code 2 if an argument is invalid."""
+        code, output = self.run_main("--workers", "0")
+        self.assertEqual(2, code)
+        self.assertIn("--workers", output)
+
+    def test_main_watch_runs_until_interrupted(self):
+        """Should write the output files, and return 0 when stopped."""
+        with patch("odk_aggregation_tool.aggregation.watch.threading") as t:
+            t.Event.return_value.is_set.return_value = False
+            t.Event.return_value.wait.side_effect = KeyboardInterrupt
+            code, output = self.run_main("--watch", "--debounce", "0")
+        self.assertEqual(0, code)
+        self.assertEqual(
+            ["Q1302_BEHAVE.xml", "R1302_BEHAVE.xml"],
+            sorted(os.listdir(self.output_path)))
+        self.assertIn("Stopped watching for changes.", output)
+
+    def test_main_watch_cannot_use_cache(self):
+        """Should exit with usage code 2 if --cache is used with --watch."""
+        code, output = self.run_main("--watch", "--cache", "cache.sqlite")
+        self.assertEqual(2, code)
+        self.assertIn("can't be used with --watch", output)
+
+    def test_main_reads_instances_from_an_archive(self):
+        """Should accept a zip of XForm data files as the instances path."""
+        zip_path = shutil.make_archive(
+            base_name=os.path.join(self.output_path, "instances"),
+            format="zip", root_dir=self.fixtures.files["instances"])
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            code = cli.main([
+                self.fixtures.files["xlsforms"], zip_path, self.output_path])
+        self.assertEqual(0, code)
+        self.assertIn("Aggregation completed, wrote 2 files.",
+                      stderr.getvalue())
+
+    def test_main_rejects_instances_file_that_is_not_an_archive(self):
+        """Should exit with usage code 2 if the instances path is a file."""
+        file_path = os.path.join(self.output_path, "instances.txt")
+        open(file_path, mode="w").close()
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            with self.assertRaises(SystemExit) as exit_info:
+                cli.main([self.fixtures.files["xlsforms"], file_path,
+                          self.output_path])
+        self.assertEqual(2, exit_info.exception.code)
+        self.assertIn("existing archive", stderr.getvalue())